@@ -1,35 +1,97 @@
 #include "GoodLumiFilter.h"
 
-bool
-GoodLumiFilter::isGoodLumi(unsigned run, unsigned lumi) const
+#include <algorithm>
+
+namespace {
+  struct RangeLess {
+    template<class R>
+    bool operator()(R const& r, std::pair<unsigned, unsigned> const& k) const { return r.run < k.first || (r.run == k.first && r.begin < k.second); }
+    template<class R>
+    bool operator()(std::pair<unsigned, unsigned> const& k, R const& r) const { return k.first < r.run || (k.first == r.run && k.second < r.begin); }
+    template<class R>
+    bool operator()(R const& r1, R const& r2) const { return r1.run < r2.run || (r1.run == r2.run && r1.begin < r2.begin); }
+  };
+}
+
+void
+GoodLumiFilter::addLumiRange(unsigned _run, unsigned _begin, unsigned _end)
 {
-  if (goodLumiList_.size() == 0)
-    return true;
+  if (_end < _begin)
+    return;
+
+  // usually appending at the end of the list
+  auto pos(std::upper_bound(ranges_.begin(), ranges_.end(), std::make_pair(_run, _begin), RangeLess()));
+  unsigned iR(pos - ranges_.begin());
+  ranges_.insert(pos, LumiRange{_run, _begin, _end});
+
+  // merge with the previous range if touching
+  merge_(iR == 0 ? 0 : iR - 1);
+}
+
+void
+GoodLumiFilter::addLumiRanges(unsigned _n, unsigned const* _runs, unsigned const* _begins, unsigned const* _ends)
+{
+  ranges_.reserve(ranges_.size() + _n);
+  for (unsigned i(0); i != _n; ++i) {
+    if (_ends[i] >= _begins[i])
+      ranges_.push_back(LumiRange{_runs[i], _begins[i], _ends[i]});
+  }
+
+  std::sort(ranges_.begin(), ranges_.end(), RangeLess());
 
-  if (run == currentRun_ && lumi == currentLumi_)
-    return currentStatus_;
+  merge_(0);
+}
 
-  currentRun_ = run;
-  currentLumi_ = lumi;
+void
+GoodLumiFilter::merge_(unsigned _first)
+{
+  // merge overlapping or adjacent ranges of the same run starting from _first
+  if (ranges_.size() < 2)
+    return;
 
-  auto rItr(goodLumiList_.find(run));
-  if (rItr != goodLumiList_.end()) {
-    auto lItr(rItr->second.find(lumi));
-    if (lItr != rItr->second.end()) {
-      currentStatus_ = true;
-      return currentStatus_;
+  unsigned iOut(_first);
+  for (unsigned iR(_first + 1); iR != ranges_.size(); ++iR) {
+    auto& current(ranges_[iOut]);
+    auto& next(ranges_[iR]);
+    if (next.run == current.run && next.begin <= current.end + 1) {
+      if (next.end > current.end)
+        current.end = next.end;
     }
+    else
+      ranges_[++iOut] = next;
   }
 
-  currentStatus_ = false;
-  return currentStatus_;
+  ranges_.resize(iOut + 1);
+}
+
+bool
+GoodLumiFilter::isGoodLumi(unsigned _run, unsigned _lumi) const
+{
+  if (ranges_.size() == 0)
+    return true;
+
+  // first range starting after the lumi; the candidate is the one before
+  auto rItr(std::upper_bound(ranges_.begin(), ranges_.end(), std::make_pair(_run, _lumi), RangeLess()));
+  if (rItr == ranges_.begin())
+    return false;
+
+  --rItr;
+  return rItr->run == _run && _lumi <= rItr->end;
+}
+
+void
+GoodLumiFilter::isGoodLumi(unsigned _n, unsigned const* _runs, unsigned const* _lumis, unsigned char* _result) const
+{
+  for (unsigned i(0); i != _n; ++i)
+    _result[i] = isGoodLumi(_runs[i], _lumis[i]) ? 1 : 0;
 }
 
 bool
-GoodLumiFilter::hasGoodLumi(unsigned run) const
+GoodLumiFilter::hasGoodLumi(unsigned _run) const
 {
-  if (goodLumiList_.size() == 0)
+  if (ranges_.size() == 0)
     return true;
 
-  return goodLumiList_.find(run) != goodLumiList_.end();
+  auto rItr(std::lower_bound(ranges_.begin(), ranges_.end(), std::make_pair(_run, 0u), RangeLess()));
+  return rItr != ranges_.end() && rItr->run == _run;
 }
@@ -1,23 +1,35 @@
 #ifndef GoodLumiFilter_h
 #define GoodLumiFilter_h
 
-#include <map>
-#include <set>
+#include <vector>
 
 class GoodLumiFilter {
 public:
   GoodLumiFilter() {}
   ~GoodLumiFilter() {}
 
-  void addLumi(unsigned run, unsigned lumi) { goodLumiList_[run].insert(lumi); }
+  void addLumi(unsigned run, unsigned lumi) { addLumiRange(run, lumi, lumi); }
+  //! Add lumisections begin to end (inclusive) of the run
+  void addLumiRange(unsigned run, unsigned begin, unsigned end);
+  //! Add n ranges at once. Arrays can be passed from python as array.array('I').
+  void addLumiRanges(unsigned n, unsigned const* runs, unsigned const* begins, unsigned const* ends);
   bool isGoodLumi(unsigned run, unsigned lumi) const;
+  //! Evaluate n (run, lumi) pairs at once. result is filled with 0 or 1 (array.array('B') from python).
+  void isGoodLumi(unsigned n, unsigned const* runs, unsigned const* lumis, unsigned char* result) const;
   bool hasGoodLumi(unsigned run) const;
+  unsigned getNRanges() const { return ranges_.size(); }
 
 private:
-  std::map<unsigned, std::set<unsigned>> goodLumiList_;
-  mutable unsigned currentRun_{0};
-  mutable unsigned currentLumi_{0};
-  mutable bool currentStatus_{false};
+  struct LumiRange {
+    unsigned run;
+    unsigned begin;
+    unsigned end;
+  };
+
+  void merge_(unsigned first);
+
+  //! Sorted by (run, begin), non-overlapping and non-adjacent
+  std::vector<LumiRange> ranges_{};
 };
 
 #endif
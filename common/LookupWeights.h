@@ -0,0 +1,105 @@
+#ifndef LOOKUPWEIGHTS_H
+#define LOOKUPWEIGHTS_H
+
+#include "TH1.h"
+
+#include <vector>
+#include <algorithm>
+#include <stdexcept>
+#include <cmath>
+
+//! Binned lookup of a weight.
+/*!
+ * Replaces piecewise formula strings such as "(1.2*(x>0.5&&x<=1.5)+1.1*(x>1.5&&x<=2.5))", whose every
+ * comparison is evaluated by TTreeFormula in every event, with a binary search over the bin edges.
+ * Bins are [low, high) if lowerInclusive, (low, high] otherwise. Outside the edges the table returns
+ * the outermost bin value if clamp, the outside value otherwise. Edges can be +-infinity.
+ *
+ * Tables are used in formulas through the registry:
+ *  unsigned id(registerLookup(LookupTable(hist)));
+ *  tree.Draw("met", TString::Format("lookupWeight(%d, npv)", id));
+ * and can also be passed directly to MultiDraw::setReweight.
+ * This header is included by MultiDraw.h; load it on its own only when MultiDraw is not loaded.
+ */
+class LookupTable {
+public:
+  LookupTable() {}
+  //! Table with the bins and contents of a 1D histogram. Under- and overflows are clamped by default, as in MultiDraw::setReweight.
+  LookupTable(TH1 const& hist, bool clamp = true) :
+    lowerInclusive_(true),
+    clamp_(clamp)
+  {
+    int nbins(hist.GetNbinsX());
+    for (int iX(1); iX <= nbins + 1; ++iX)
+      edges_.push_back(hist.GetXaxis()->GetBinLowEdge(iX));
+    for (int iX(1); iX <= nbins; ++iX)
+      values_.push_back(hist.GetBinContent(iX));
+  }
+  //! Table with nbins values and nbins + 1 edges.
+  LookupTable(unsigned nbins, double const* edges, double const* values, bool lowerInclusive = true, bool clamp = false, double outside = 0.) :
+    edges_(edges, edges + nbins + 1),
+    values_(values, values + nbins),
+    lowerInclusive_(lowerInclusive),
+    clamp_(clamp),
+    outside_(outside)
+  {
+    for (unsigned i(0); i != nbins; ++i) {
+      if (edges_[i] >= edges_[i + 1])
+        throw std::runtime_error("LookupTable edges must be in increasing order");
+    }
+  }
+
+  double eval(double x) const
+  {
+    if (values_.empty() || std::isnan(x))
+      return outside_;
+
+    std::vector<double>::const_iterator b;
+    if (lowerInclusive_)
+      b = std::upper_bound(edges_.begin(), edges_.end(), x);
+    else
+      b = std::lower_bound(edges_.begin(), edges_.end(), x);
+
+    int iBin(int(b - edges_.begin()) - 1);
+    int nbins(values_.size());
+
+    if (iBin >= 0 && iBin < nbins)
+      return values_[iBin];
+
+    if (!clamp_)
+      return outside_;
+
+    return iBin < 0 ? values_.front() : values_.back();
+  }
+
+  unsigned getNbins() const { return values_.size(); }
+
+private:
+  std::vector<double> edges_{};
+  std::vector<double> values_{};
+  bool lowerInclusive_{true};
+  bool clamp_{false};
+  double outside_{0.};
+};
+
+//! Registered tables, referenced by their position.
+inline std::vector<LookupTable>& lookupTables()
+{
+  static std::vector<LookupTable> tables;
+  return tables;
+}
+
+//! Register a table and return its id for lookupWeight.
+inline unsigned registerLookup(LookupTable const& table)
+{
+  lookupTables().push_back(table);
+  return lookupTables().size() - 1;
+}
+
+//! Value of the registered table id at x. Meant to be called from TTreeFormula expressions.
+inline double lookupWeight(int id, double x)
+{
+  return lookupTables().at(id).eval(x);
+}
+
+#endif
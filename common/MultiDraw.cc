@@ -473,6 +473,26 @@ MultiDraw::setReweight(char const* _expr, TObject const* _source/* = nullptr*/)
   }
 }
 
+void
+MultiDraw::setReweight(char const* _expr, LookupTable const& _table)
+{
+  setReweight(_expr);
+
+  if (reweightExpr_ == nullptr)
+    return;
+
+  LookupTable table(_table);
+
+  reweight_ = [this, table](std::vector<double>& _values) {
+    _values.clear();
+
+    unsigned nD(this->reweightExpr_->GetNdata());
+
+    for (unsigned iD(0); iD != nD; ++iD)
+      _values.push_back(table.eval(this->reweightExpr_->EvalInstance(iD)));
+  };
+}
+
 void
 MultiDraw::addPlot(TH1* _hist, char const* _expr, char const* _cuts/* = ""*/, bool _applyBaseline/* = true*/, bool _applyFullSelection/* = false*/, char const* _reweight/* = ""*/, Plot::OverflowMode _overflowMode/* = Plot::kNoOverflow*/)
 {
@@ -6,6 +6,8 @@
 #include "TH1.h"
 #include "TString.h"
 
+#include "LookupWeights.h"
+
 #include <map>
 #include <vector>
 
@@ -187,6 +189,11 @@ public:
    * to look up the y value of the source object, which is used as the weight.
    */
   void setReweight(char const* expr, TObject const* source = nullptr);
+  //! Set a global reweight looked up from a binned table at the value of expr
+  /*!
+   * The table is copied.
+   */
+  void setReweight(char const* expr, LookupTable const& table);
   //! Add a histogram to fill.
   /*!
    * Currently only 1D histograms can be used.
@@ -0,0 +1,638 @@
+"""
+Vectorized drop-in replacement for MultiDraw (histograms only).
+
+ColumnDraw translates the selection, expression, cut, and reweight strings into NumPy
+expressions, extracts the needed branches of each input file once into a column cache of
+.npy files (memory-mapped on subsequent reads), and fills the histograms with boolean masks
+and weighted bincounts. Configurations that cannot be translated (array expressions without
+an explicit index, TTreePlayer functions, trees, reweight sources, ...) or environments without
+numpy / root_numpy are handed over to ROOT.MultiDraw, which must then be loaded by the caller.
+
+Usage is identical to MultiDraw:
+  plotter = ColumnDraw(cacheDir)
+  plotter.addInputPath('source.root')
+  plotter.setBaseSelection('photons.scRawPt[0] > 175.')
+  plotter.addPlot(hist, 't1Met.pt', 't1Met.minJetDPhi > 0.5')
+  plotter.fillPlots()
+"""
+
+import os
+import re
+import math
+import array
+import fcntl
+import hashlib
+
+import ROOT
+
+try:
+    import numpy
+    import root_numpy
+except ImportError:
+    numpy = None
+
+class TranslationError(RuntimeError):
+    pass
+
+
+def phi_mpi_pi(x):
+    return numpy.mod(x + math.pi, 2. * math.pi) - math.pi
+
+# TTreeFormula function name -> python expression in the evaluation namespace
+FUNCTIONS = {
+    'abs': 'numpy.abs',
+    'fabs': 'numpy.abs',
+    'TMath::Abs': 'numpy.abs',
+    'sqrt': 'numpy.sqrt',
+    'TMath::Sqrt': 'numpy.sqrt',
+    'cos': 'numpy.cos',
+    'TMath::Cos': 'numpy.cos',
+    'sin': 'numpy.sin',
+    'TMath::Sin': 'numpy.sin',
+    'exp': 'numpy.exp',
+    'TMath::Exp': 'numpy.exp',
+    'log': 'numpy.log',
+    'TMath::Log': 'numpy.log',
+    'pow': 'numpy.power',
+    'TMath::Power': 'numpy.power',
+    'TMath::Sign': 'numpy.copysign',
+    'TMath::Min': 'numpy.minimum',
+    'TMath::Max': 'numpy.maximum',
+    'TMath::ATan2': 'numpy.arctan2',
+    'TMath::CosH': 'numpy.cosh',
+    'TMath::SinH': 'numpy.sinh',
+    'TVector2::Phi_mpi_pi': 'phi_mpi_pi'
+}
+
+CONSTANTS = {
+    'TMath::Pi': repr(math.pi),
+    'true': '1.',
+    'false': '0.',
+    'kTRUE': '1.',
+    'kFALSE': '0.'
+}
+
+TOKEN = re.compile(r'\s*(?:(?P<num>(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)|(?P<name>[A-Za-z_]\w*(?:(?:\.|::)[A-Za-z_]\w*)*)(?:\[\s*(?P<index>\d+)\s*\])?|(?P<op>&&|\|\||==|!=|<=|>=|[<>!+\-*/%(),]))')
+
+
+class Expression(object):
+    """
+    A TTreeFormula expression translated into a python expression over columns v0, v1, ...
+    refs is the list of (branch, index) the columns correspond to (index is None for scalars).
+    """
+
+    def __init__(self, formula):
+        self.formula = formula
+        self.refs = []
+
+        self._tokens = self._tokenize(formula)
+        self._pos = 0
+
+        self.code = self._parseOr()
+        if self._pos != len(self._tokens):
+            raise TranslationError('Unexpected token in ' + formula)
+
+        self.compiled = compile(self.code, '<' + formula + '>', 'eval')
+
+    def evaluate(self, columns, nentries):
+        """
+        Evaluate the expression. columns is {(branch, index): (values, valid)}.
+        Returns (values, valid) arrays; valid is None if all entries have valid instances.
+        """
+
+        namespace = dict(NAMESPACE)
+        valid = None
+        for iref, ref in enumerate(self.refs):
+            values, refValid = columns[ref]
+            namespace['v%d' % iref] = values
+            if refValid is not None:
+                if valid is None:
+                    valid = refValid
+                else:
+                    valid = valid & refValid
+
+        result = eval(self.compiled, namespace)
+        if numpy.ndim(result) == 0:
+            result = numpy.full(nentries, float(result))
+
+        return result, valid
+
+    def _tokenize(self, formula):
+        tokens = []
+        pos = 0
+        formula = formula.rstrip()
+        while pos != len(formula):
+            match = TOKEN.match(formula, pos)
+            if match is None:
+                raise TranslationError('Cannot tokenize ' + formula[pos:])
+
+            if match.group('num') is not None:
+                tokens.append(('num', match.group('num')))
+            elif match.group('name') is not None:
+                index = match.group('index')
+                if index is not None:
+                    index = int(index)
+                tokens.append(('name', (match.group('name'), index)))
+            else:
+                tokens.append(('op', match.group('op')))
+
+            pos = match.end()
+
+        return tokens
+
+    def _peek(self):
+        if self._pos == len(self._tokens):
+            return None, None
+
+        return self._tokens[self._pos]
+
+    def _accept(self, ops):
+        kind, value = self._peek()
+        if kind == 'op' and value in ops:
+            self._pos += 1
+            return value
+
+        return None
+
+    def _expect(self, op):
+        if self._accept([op]) is None:
+            raise TranslationError('Expected ' + op + ' in ' + self.formula)
+
+    def _parseBinary(self, ops, parseOperand, fmt):
+        left = parseOperand()
+        while True:
+            op = self._accept(ops)
+            if op is None:
+                return left
+
+            right = parseOperand()
+            left = fmt[op] % (left, right)
+
+    def _parseOr(self):
+        return self._parseBinary(['||'], self._parseAnd, {'||': 'lor(%s, %s)'})
+
+    def _parseAnd(self):
+        return self._parseBinary(['&&'], self._parseEquality, {'&&': 'land(%s, %s)'})
+
+    def _parseEquality(self):
+        return self._parseBinary(['==', '!='], self._parseRelational, {'==': 'eq(%s, %s)', '!=': 'ne(%s, %s)'})
+
+    def _parseRelational(self):
+        return self._parseBinary(['<', '>', '<=', '>='], self._parseAdditive, {'<': 'lt(%s, %s)', '>': 'gt(%s, %s)', '<=': 'le(%s, %s)', '>=': 'ge(%s, %s)'})
+
+    def _parseAdditive(self):
+        return self._parseBinary(['+', '-'], self._parseMultiplicative, {'+': '(%s + %s)', '-': '(%s - %s)'})
+
+    def _parseMultiplicative(self):
+        return self._parseBinary(['*', '/', '%'], self._parseUnary, {'*': '(%s * %s)', '/': '(%s / %s)', '%': 'mod(%s, %s)'})
+
+    def _parseUnary(self):
+        op = self._accept(['!', '-', '+'])
+        if op == '!':
+            return 'lnot(%s)' % self._parseUnary()
+        elif op == '-':
+            return '(-%s)' % self._parseUnary()
+        elif op == '+':
+            return self._parseUnary()
+        else:
+            return self._parsePrimary()
+
+    def _parsePrimary(self):
+        kind, value = self._peek()
+        if kind is None:
+            raise TranslationError('Unexpected end of ' + self.formula)
+
+        self._pos += 1
+
+        if kind == 'num':
+            return repr(float(value))
+
+        if kind == 'op':
+            if value != '(':
+                raise TranslationError('Unexpected ' + value + ' in ' + self.formula)
+
+            code = self._parseOr()
+            self._expect(')')
+            return '(' + code + ')'
+
+        name, index = value
+
+        if self._accept(['(']) is not None:
+            if index is not None:
+                raise TranslationError('Indexed function call in ' + self.formula)
+
+            args = []
+            if self._accept([')']) is None:
+                args.append(self._parseOr())
+                while self._accept([',']) is not None:
+                    args.append(self._parseOr())
+                self._expect(')')
+
+            if len(args) == 0 and name in CONSTANTS:
+                return CONSTANTS[name]
+
+            try:
+                return '%s(%s)' % (FUNCTIONS[name], ', '.join(args))
+            except KeyError:
+                raise TranslationError('Unknown function ' + name)
+
+        if name in CONSTANTS:
+            return CONSTANTS[name]
+
+        if '::' in name:
+            raise TranslationError('Unknown symbol ' + name)
+
+        ref = (name, index)
+        if ref not in self.refs:
+            self.refs.append(ref)
+
+        return 'v%d' % self.refs.index(ref)
+
+
+def _float(x):
+    return numpy.asarray(x, dtype = numpy.float64)
+
+NAMESPACE = {
+    'numpy': numpy,
+    'phi_mpi_pi': phi_mpi_pi,
+    'lor': lambda a, b: _float(numpy.logical_or(a, b)),
+    'land': lambda a, b: _float(numpy.logical_and(a, b)),
+    'lnot': lambda a: _float(numpy.logical_not(a)),
+    'eq': lambda a, b: _float(a == b),
+    'ne': lambda a, b: _float(a != b),
+    'lt': lambda a, b: _float(a < b),
+    'gt': lambda a, b: _float(a > b),
+    'le': lambda a, b: _float(a <= b),
+    'ge': lambda a, b: _float(a >= b),
+    # TTreeFormula casts both operands of % to Long64_t; fmod of the truncated values is the same C integer modulo
+    'mod': lambda a, b: numpy.fmod(numpy.trunc(a), numpy.trunc(b))
+}
+
+
+class ColumnCache(object):
+    """
+    Per-file store of extracted columns. Each input file has a directory named after the hash of its
+    path, holding a stamp (mtime and size of the source), the number of entries, and one .npy file of values
+    (plus one of validity flags for indexed array branches) per (branch, index).
+    Access to the directory of a file is serialized with an flock on <directory>.lock, so that parallel fills
+    (plot.py --jobs) do not extract into or invalidate the same columns at the same time.
+    """
+
+    def __init__(self, cacheDir):
+        self.cacheDir = cacheDir
+
+    def _dir(self, path):
+        return self.cacheDir + '/' + hashlib.sha1(os.path.realpath(path)).hexdigest()
+
+    def _colName(self, ref):
+        return hashlib.sha1('%s[%s]' % ref).hexdigest()
+
+    def get(self, path, treeName, refs):
+        """
+        Return (nentries, {ref: (values, valid)}) for the file, extracting missing columns.
+        """
+
+        colDir = self._dir(path)
+
+        try:
+            os.makedirs(self.cacheDir)
+        except OSError:
+            pass
+
+        with open(colDir + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                return self._get(path, treeName, refs, colDir)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _get(self, path, treeName, refs, colDir):
+        stat = os.stat(path)
+        stamp = '%s %d %s' % (repr(stat.st_mtime), stat.st_size, treeName)
+
+        try:
+            with open(colDir + '/stamp') as stampFile:
+                cachedStamp, nentries = stampFile.read().split('\n')[:2]
+            nentries = int(nentries)
+        except (IOError, ValueError):
+            cachedStamp = ''
+
+        if cachedStamp != stamp:
+            if os.path.isdir(colDir):
+                for fname in os.listdir(colDir):
+                    os.unlink(colDir + '/' + fname)
+            else:
+                os.makedirs(colDir)
+
+            source = ROOT.TFile.Open(path)
+            nentries = source.Get(treeName).GetEntries()
+            source.Close()
+
+            with open(colDir + '/stamp', 'w') as stampFile:
+                stampFile.write(stamp + '\n' + str(nentries) + '\n')
+
+        missing = [ref for ref in refs if not os.path.exists(colDir + '/' + self._colName(ref) + '.npy')]
+        if len(missing) != 0:
+            self._extract(path, treeName, missing, colDir)
+
+        columns = {}
+        for ref in refs:
+            colPath = colDir + '/' + self._colName(ref)
+            values = numpy.load(colPath + '.npy', mmap_mode = 'r')
+            if os.path.exists(colPath + '_valid.npy'):
+                valid = numpy.load(colPath + '_valid.npy', mmap_mode = 'r')
+            else:
+                valid = None
+
+            columns[ref] = (values, valid)
+
+        return nentries, columns
+
+    def _extract(self, path, treeName, refs, colDir):
+        branches = sorted(set(branch for branch, _ in refs))
+
+        try:
+            arrays = root_numpy.root2array(path, treeName, branches = branches)
+        except (ValueError, IOError, TypeError) as ex:
+            raise TranslationError('Failed to read %s from %s: %s' % (branches, path, str(ex)))
+
+        for ref in refs:
+            branch, index = ref
+            column = arrays[branch]
+            valid = None
+
+            if column.dtype == object:
+                # variable-length array
+                if index is None:
+                    raise TranslationError('Branch ' + branch + ' is an array')
+
+                valid = numpy.array([len(a) > index for a in column], dtype = bool)
+                values = numpy.array([a[index] if len(a) > index else 0. for a in column], dtype = numpy.float64)
+
+            elif column.ndim > 1:
+                # fixed-length array
+                if index is None:
+                    raise TranslationError('Branch ' + branch + ' is an array')
+
+                values = numpy.asarray(column[:, index], dtype = numpy.float64)
+
+            else:
+                values = numpy.asarray(column, dtype = numpy.float64)
+
+            colPath = colDir + '/' + self._colName(ref)
+            numpy.save(colPath + '.npy', values)
+            if valid is not None:
+                numpy.save(colPath + '_valid.npy', valid)
+
+
+class ColumnDraw(object):
+    def __init__(self, cacheDir, treeName = 'events'):
+        self.cache = ColumnCache(cacheDir)
+        self.treeName = treeName
+        self.paths = []
+        self.weightBranch = 'weight'
+        self.baseSelection = ''
+        self.fullSelection = ''
+        self.constWeight = 1.
+        self.prescale = 1
+        self.printLevel = 0
+        self.totalEvents = 0
+
+        self._plots = [] # [(hist, expr, cuts, applyBaseline, applyFullSelection, reweight, overflowMode)]
+        self._trees = [] # [(tree, cuts, applyBaseline, applyFullSelection, reweight)]
+        self._treeBranches = [] # [(tree, bname, expr)]
+        self._reweight = None # (expr, source)
+
+    def addInputPath(self, path):
+        self.paths.append(path)
+
+    def setWeightBranch(self, bname, type = 'F'):
+        self.weightBranch = bname
+
+    def setBaseSelection(self, cuts):
+        self.baseSelection = cuts
+
+    def setFullSelection(self, cuts):
+        self.fullSelection = cuts
+
+    def setConstantWeight(self, l):
+        self.constWeight = l
+
+    def setPrescale(self, p):
+        self.prescale = p
+
+    def setReweight(self, expr, source = None):
+        self._reweight = (expr, source)
+
+    def setPrintLevel(self, l):
+        self.printLevel = l
+
+    def addPlot(self, hist, expr, cuts = '', applyBaseline = True, applyFullSelection = False, reweight = '', mode = None):
+        if mode is None:
+            mode = ROOT.Plot.kNoOverflowBin
+
+        self._plots.append((hist, expr, cuts, applyBaseline, applyFullSelection, reweight, mode))
+
+    def addTree(self, tree, cuts = '', applyBaseline = True, applyFullSelection = False, reweight = ''):
+        self._trees.append((tree, cuts, applyBaseline, applyFullSelection, reweight))
+
+    def addTreeBranch(self, tree, bname, expr):
+        self._treeBranches.append((tree, bname, expr))
+
+    def numObjs(self):
+        return len(self._plots) + len(self._trees)
+
+    def getTotalEvents(self):
+        return self.totalEvents
+
+    def fillPlots(self, nEntries = -1, firstEntry = 0):
+        if numpy is None or len(self._trees) != 0 or self._reweight is not None or nEntries >= 0 or firstEntry != 0:
+            self._fallback(nEntries, firstEntry)
+            return
+
+        try:
+            self._fillColumnar()
+        except TranslationError as ex:
+            if self.printLevel > 0:
+                print '      Falling back to MultiDraw:', str(ex)
+
+            self._fallback(nEntries, firstEntry)
+
+    def _fallback(self, nEntries, firstEntry):
+        plotter = ROOT.MultiDraw(self.treeName)
+        for path in self.paths:
+            plotter.addInputPath(path)
+
+        plotter.setWeightBranch(self.weightBranch)
+        plotter.setBaseSelection(self.baseSelection)
+        plotter.setFullSelection(self.fullSelection)
+        plotter.setConstantWeight(self.constWeight)
+        plotter.setPrescale(self.prescale)
+        plotter.setPrintLevel(self.printLevel)
+
+        if self._reweight is not None:
+            plotter.setReweight(*self._reweight)
+
+        for plot in self._plots:
+            plotter.addPlot(*plot)
+
+        for tree in self._trees:
+            plotter.addTree(*tree)
+
+        for treeBranch in self._treeBranches:
+            plotter.addTreeBranch(*treeBranch)
+
+        plotter.fillPlots(nEntries, firstEntry)
+
+        self.totalEvents += plotter.getTotalEvents()
+
+    def _fillColumnar(self):
+        def translate(formula):
+            if formula is None or not formula.strip():
+                return None
+            return Expression(formula)
+
+        # translate everything before reading anything
+        baseSelection = translate(self.baseSelection)
+        fullSelection = translate(self.fullSelection)
+        plots = [(plot, Expression(plot[1]), translate(plot[2]), translate(plot[5])) for plot in self._plots]
+
+        refs = set()
+        for expr in [baseSelection, fullSelection] + sum([list(p[1:]) for p in plots], []):
+            if expr is not None:
+                refs.update(expr.refs)
+
+        if self.weightBranch:
+            refs.add((self.weightBranch, None))
+        if self.prescale > 1:
+            refs.add(('eventNumber', None))
+
+        refs = sorted(refs)
+
+        # accumulate per-plot bin contents over the input files
+        sumw = [None] * len(plots)
+        sumw2 = [None] * len(plots)
+        stats = [numpy.zeros(4) for _ in plots]
+        counts = [0] * len(plots)
+        # added to self.totalEvents only once all files are read; a TranslationError hands everything to MultiDraw
+        totalEvents = 0
+
+        for path in self.paths:
+            nentries, columns = self.cache.get(path, self.treeName, refs)
+            totalEvents += nentries
+
+            if self.printLevel >= 0:
+                print '      %d events (%s)' % (nentries, path)
+
+            if self.weightBranch:
+                weight = columns[(self.weightBranch, None)][0] * self.constWeight
+            else:
+                weight = numpy.full(nentries, self.constWeight)
+
+            selected = numpy.ones(nentries, dtype = bool)
+            if self.prescale > 1:
+                selected &= numpy.mod(columns[('eventNumber', None)][0], self.prescale) == 0
+
+            stages = {(False, False): selected, (False, True): selected}
+            baseMask = selected & self._passes(baseSelection, columns, nentries)
+            stages[(True, False)] = baseMask
+            stages[(True, True)] = baseMask & self._passes(fullSelection, columns, nentries)
+
+            for iplot, (plot, expr, cuts, reweight) in enumerate(plots):
+                hist, _, _, applyBaseline, applyFullSelection, _, mode = plot
+
+                values, mask = expr.evaluate(columns, nentries)
+                if mask is None:
+                    mask = stages[(applyBaseline, applyBaseline and applyFullSelection)]
+                else:
+                    mask = mask & stages[(applyBaseline, applyBaseline and applyFullSelection)]
+
+                mask = mask & self._passes(cuts, columns, nentries)
+
+                w = weight
+                if reweight is not None:
+                    rw, rvalid = reweight.evaluate(columns, nentries)
+                    w = w * rw
+                    if rvalid is not None:
+                        mask = mask & rvalid
+
+                fw, fw2, fstats = self._binContents(hist, values[mask], w[mask], mode)
+                stats[iplot] += fstats
+                if sumw[iplot] is None:
+                    sumw[iplot] = fw
+                    sumw2[iplot] = fw2
+                else:
+                    sumw[iplot] += fw
+                    sumw2[iplot] += fw2
+
+                counts[iplot] += numpy.count_nonzero(mask)
+
+        self.totalEvents += totalEvents
+
+        for iplot, (plot, _, _, _) in enumerate(plots):
+            if sumw[iplot] is None:
+                continue
+
+            hist = plot[0]
+
+            # SetBinContent resets the statistics; carry over the existing ones and add the unbinned sums as TH1::Fill would
+            histStats = array.array('d', [0.] * 13)
+            hist.GetStats(histStats)
+            entries = hist.GetEntries()
+
+            for iBin in xrange(len(sumw[iplot])):
+                hist.SetBinContent(iBin, hist.GetBinContent(iBin) + sumw[iplot][iBin])
+                hist.SetBinError(iBin, math.sqrt(math.pow(hist.GetBinError(iBin), 2.) + sumw2[iplot][iBin]))
+
+            for i in range(4):
+                histStats[i] += stats[iplot][i]
+
+            hist.PutStats(histStats)
+            hist.SetEntries(entries + counts[iplot])
+
+            if self.printLevel > 0:
+                print '        %s: %d' % (hist.GetName(), counts[iplot])
+
+    def _passes(self, selection, columns, nentries):
+        if selection is None:
+            return numpy.ones(nentries, dtype = bool)
+
+        values, valid = selection.evaluate(columns, nentries)
+        result = values != 0.
+        if valid is not None:
+            result &= valid
+
+        return result
+
+    def _binContents(self, hist, x, w, mode):
+        """
+        Compute the sum of weights and squared weights in each (global) bin of hist,
+        including underflow and overflow bins as in TH1::Fill, and the statistics
+        (sumw, sumw2, sumwx, sumwx2) of the in-range entries.
+        """
+
+        if hist.GetDimension() != 1:
+            raise TranslationError('Columnar filling is implemented for 1D histograms only')
+
+        axis = hist.GetXaxis()
+        nbins = hist.GetNbinsX()
+        edges = numpy.array([axis.GetBinLowEdge(iX) for iX in range(1, nbins + 2)])
+
+        if mode == ROOT.Plot.kDedicated:
+            x = numpy.where(x > edges[-2], edges[-2], x)
+        elif mode == ROOT.Plot.kMergeLast:
+            x = numpy.where(x > edges[-1], edges[-2], x)
+
+        # bin [edges[i-1], edges[i]) -> i; underflow -> 0, overflow (including the last upper edge) -> nbins + 1
+        ibins = numpy.searchsorted(edges, x, side = 'right')
+
+        sumw = numpy.bincount(ibins, weights = w, minlength = nbins + 2)
+        sumw2 = numpy.bincount(ibins, weights = w * w, minlength = nbins + 2)
+
+        # TH1::Fill excludes under- and overflows from the statistics
+        inRange = (ibins >= 1) & (ibins <= nbins)
+        xin = x[inRange]
+        win = w[inRange]
+        stats = numpy.array([win.sum(), numpy.dot(win, win), numpy.dot(win, xin), numpy.dot(win, xin * xin)])
+
+        return sumw, sumw2, stats
@@ -0,0 +1,247 @@
+"""
+Cut flows computed from the per-operator decision bits of the skim "cutflow" trees.
+
+Every decision branch of each input file is read once and kept as a packed bit column (numpy.packbits). The
+columns are cached per file in .npz files named after the hash of the path and invalidated by the mtime and
+size of the source. Cumulative and N-1 flows for any grouping and ordering of the cuts are then bitwise ANDs and
+popcounts over the packed columns, without touching the trees again.
+
+Usage:
+  engine = CutflowEngine(cacheDir)
+  engine.addInputPath('sample_monoph.root', 'sample')
+  engine.flow([('MetFilters',), ('PhotonSelection', 'Met')])   # [count after each step]
+  engine.nMinusOne([('MetFilters',), ('PhotonSelection', 'Met')])   # [count passing all other steps]
+"""
+
+import os
+import hashlib
+
+import ROOT
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import root_numpy
+except ImportError:
+    root_numpy = None
+
+# branches of the cutflow tree that are not decisions
+ID_BRANCHES = ['runNumber', 'lumiNumber', 'eventNumber']
+
+_popcountTable = None
+
+def popcount(packed):
+    """
+    Number of set bits in a packed bit column.
+    """
+
+    global _popcountTable
+
+    if _popcountTable is None:
+        _popcountTable = numpy.array([bin(i).count('1') for i in range(256)], dtype = numpy.uint8)
+
+    return int(_popcountTable[packed].sum(dtype = numpy.int64))
+
+def readBits(path, treeName = 'cutflow'):
+    """
+    Read all decision branches of the tree. Return (nentries, {branch: packed bits}).
+    """
+
+    source = ROOT.TFile.Open(path)
+    if not source or source.IsZombie():
+        raise RuntimeError('Cannot open ' + path)
+
+    tree = source.Get(treeName)
+    if not tree:
+        source.Close()
+        raise RuntimeError('No tree ' + treeName + ' in ' + path)
+
+    nentries = tree.GetEntries()
+    branches = [b.GetName() for b in tree.GetListOfBranches() if b.GetName() not in ID_BRANCHES]
+
+    bits = {}
+
+    if root_numpy is not None:
+        arrays = root_numpy.tree2array(tree, branches = branches)
+        for branch in branches:
+            bits[branch] = numpy.packbits(arrays[branch] != 0)
+
+    elif nentries != 0:
+        tree.SetEstimate(nentries + 1)
+        # TTree::Draw returns at most four columns at a time
+        for ib in range(0, len(branches), 4):
+            chunk = branches[ib:ib + 4]
+            tree.Draw(':'.join(chunk), '', 'goff')
+            for ic, branch in enumerate(chunk):
+                buf = tree.GetVal(ic)
+                buf.SetSize(nentries)
+                bits[branch] = numpy.packbits(numpy.frombuffer(buf, dtype = numpy.float64, count = nentries) != 0)
+
+    else:
+        for branch in branches:
+            bits[branch] = numpy.zeros(0, dtype = numpy.uint8)
+
+    source.Close()
+
+    return nentries, bits
+
+
+class BitCache(object):
+    """
+    Packed decision bits of each input file, stored as <hash of path>.npz with the stamp of the source.
+    """
+
+    def __init__(self, cacheDir):
+        self.cacheDir = cacheDir
+
+    def get(self, path, treeName = 'cutflow'):
+        stat = os.stat(path)
+        stamp = '%s %d %s' % (repr(stat.st_mtime), stat.st_size, treeName)
+
+        cachePath = self.cacheDir + '/' + hashlib.sha1(os.path.realpath(path)).hexdigest() + '.npz'
+
+        if os.path.exists(cachePath):
+            cached = numpy.load(cachePath)
+            try:
+                if str(cached['_stamp']) == stamp:
+                    bits = dict((key, cached[key]) for key in cached.files if not key.startswith('_'))
+                    return int(cached['_nentries']), bits
+            finally:
+                cached.close()
+
+        nentries, bits = readBits(path, treeName)
+
+        try:
+            os.makedirs(self.cacheDir)
+        except OSError:
+            pass
+
+        tmpPath = cachePath + '.tmp%d' % os.getpid()
+        with open(tmpPath, 'wb') as output:
+            contents = dict(bits)
+            contents['_stamp'] = stamp
+            contents['_nentries'] = nentries
+            numpy.savez(output, **contents)
+
+        os.rename(tmpPath, cachePath)
+
+        return nentries, bits
+
+
+class CutflowEngine(object):
+    def __init__(self, cacheDir = '', treeName = 'cutflow'):
+        if numpy is None:
+            raise RuntimeError('CutflowEngine requires numpy')
+
+        self.treeName = treeName
+        if cacheDir:
+            self.cache = BitCache(cacheDir)
+        else:
+            self.cache = None
+
+        self._inputs = [] # [(group, nentries, {branch: packed bits})]
+
+    def addInputPath(self, path, group = ''):
+        """
+        Read the decision bits of the file (or take them from the cache). Group labels the file for per-group flows.
+        """
+
+        if self.cache is not None:
+            nentries, bits = self.cache.get(path, self.treeName)
+        else:
+            nentries, bits = readBits(path, self.treeName)
+
+        self._inputs.append((group, nentries, bits))
+
+    def branches(self):
+        """
+        Decision branches present in all inputs, sorted by name.
+        """
+
+        if len(self._inputs) == 0:
+            return []
+
+        names = sorted(self._inputs[0][2].keys())
+        return [name for name in names if all(name in bits for _, _, bits in self._inputs)]
+
+    def total(self, group = None):
+        return sum(nentries for g, nentries, _ in self._inputs if group is None or g == group)
+
+    def flow(self, steps, group = None):
+        """
+        Number of entries passing steps[0] through steps[i] for each i. Each step is a sequence of cut names
+        that are ANDed.
+        """
+
+        counts = [0] * len(steps)
+
+        for g, _, bits in self._inputs:
+            if group is not None and g != group:
+                continue
+
+            running = None
+            for istep, step in enumerate(steps):
+                mask = self._stepMask(bits, step)
+                if running is None:
+                    running = mask
+                else:
+                    running = running & mask
+
+                counts[istep] += popcount(running)
+
+        return counts
+
+    def nMinusOne(self, steps, group = None):
+        """
+        Number of entries passing all steps except the i-th, for each i.
+        """
+
+        counts = [0] * len(steps)
+
+        for g, nentries, bits in self._inputs:
+            if group is not None and g != group:
+                continue
+
+            masks = [self._stepMask(bits, step) for step in steps]
+
+            # prefix[i] = AND of masks[:i], suffix[i] = AND of masks[i:]
+            prefix = [None]
+            for mask in masks:
+                prefix.append(mask if prefix[-1] is None else prefix[-1] & mask)
+
+            suffix = [None]
+            for mask in reversed(masks):
+                suffix.append(mask if suffix[-1] is None else suffix[-1] & mask)
+            suffix.reverse()
+
+            for istep in range(len(steps)):
+                before = prefix[istep]
+                after = suffix[istep + 1]
+                if before is None and after is None:
+                    counts[istep] += nentries
+                elif before is None:
+                    counts[istep] += popcount(after)
+                elif after is None:
+                    counts[istep] += popcount(before)
+                else:
+                    counts[istep] += popcount(before & after)
+
+        return counts
+
+    def _stepMask(self, bits, step):
+        mask = None
+        for cut in step:
+            try:
+                column = bits[cut]
+            except KeyError:
+                raise RuntimeError('No decision branch ' + cut)
+
+            if mask is None:
+                mask = column
+            else:
+                mask = mask & column
+
+        return mask
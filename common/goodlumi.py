@@ -1,5 +1,6 @@
 import os
 import json
+import array
 import ROOT
 
 thisdir = os.path.dirname(os.path.realpath(__file__))
@@ -12,10 +13,44 @@ def makeGoodLumiFilter(jsonPath):
     with open(jsonPath) as source:
         lumiList = json.loads(source.read())
 
-        for run, lumiranges in lumiList.items():
-            for lumirange in lumiranges:
-                lumirange[1] += 1
-                for lumi in range(*tuple(lumirange)):
-                    goodLumi.addLumi(int(run), lumi)
+    addLumiList(goodLumi, lumiList)
 
     return goodLumi
+
+def addLumiList(goodLumi, lumiList):
+    """
+    Add the ranges of a {run: [[begin, end], ...]} dictionary to the filter in one call.
+    """
+
+    runs = array.array('I')
+    begins = array.array('I')
+    ends = array.array('I')
+
+    for run, lumiranges in lumiList.items():
+        run = int(run)
+        for begin, end in lumiranges:
+            runs.append(run)
+            begins.append(begin)
+            ends.append(end)
+
+    if len(runs) != 0:
+        goodLumi.addLumiRanges(len(runs), runs, begins, ends)
+
+def isGoodLumi(goodLumi, runs, lumis):
+    """
+    Evaluate the filter on sequences of run and lumi numbers. Returns an array('B') of 0 and 1.
+    """
+
+    if type(runs) is not array.array or runs.typecode != 'I':
+        runs = array.array('I', runs)
+    if type(lumis) is not array.array or lumis.typecode != 'I':
+        lumis = array.array('I', lumis)
+
+    if len(runs) != len(lumis):
+        raise RuntimeError('Run and lumi arrays have different lengths')
+
+    result = array.array('B', [0]) * len(runs)
+    if len(runs) != 0:
+        goodLumi.isGoodLumi(len(runs), runs, lumis, result)
+
+    return result
@@ -0,0 +1,189 @@
+"""
+Binned lookup weights for TTreeFormula expressions (see LookupWeights.h).
+
+Piecewise-constant formula strings like "(1.2*(npv>0.5&&npv<=1.5)+1.1*(npv>1.5&&npv<=2.5))" are converted into
+registered LookupTables and replaced by a single call "lookupWeight(<id>, npv)", which finds the bin by binary
+search instead of evaluating every comparison. Histograms and (edges, values) arrays can be registered directly.
+
+Usage:
+  w = convert('(0.0*(npv>-0.5&&npv<=0.5)+3.30*(npv>0.5&&npv<=1.5)+...)')   # 'lookupWeight(0, npv)'
+  kfactor = register('kfactor', hist, 'genBos_pt')
+  multiDraw.setReweight('genBos_pt', makeTable(hist))
+"""
+
+import os
+import re
+
+import ROOT
+
+_number = r'[-+]?(?:[0-9]+\.?[0-9]*|\.[0-9]+)(?:[eE][-+]?[0-9]+)?'
+_comparison = re.compile(r'\s*([A-Za-z_][A-Za-z0-9_.]*)\s*(<=|>=|<|>)\s*(' + _number + r')\s*$')
+# value*(condition) or (condition)*value
+_term = re.compile(r'\s*(?:(' + _number + r')\s*\*\s*\(([^()]*)\)|\(([^()]*)\)\s*\*\s*(' + _number + r'))\s*')
+
+_registered = {} # {name: id}
+_converted = {} # {piecewise string: lookup call}
+
+def loadLibrary():
+    try:
+        ROOT.LookupTable
+    except AttributeError:
+        ROOT.gROOT.LoadMacro(os.path.dirname(os.path.realpath(__file__)) + '/LookupWeights.h+')
+
+def parsePiecewise(expr):
+    """
+    Parse a sum of value*(cuts on one variable). Return (variable, edges, values, lowerInclusive) with the gaps
+    between the terms filled with zeros, or None if expr is not such a sum.
+    """
+
+    expr = expr.strip()
+    while expr.startswith('(') and expr.endswith(')') and _balanced(expr[1:-1]):
+        expr = expr[1:-1].strip()
+
+    terms = []
+    pos = 0
+    while pos < len(expr):
+        if len(terms) != 0:
+            if expr[pos] != '+':
+                return None
+            pos += 1
+
+        matches = _term.match(expr, pos)
+        if not matches:
+            return None
+
+        if matches.group(1) is not None:
+            value, condition = float(matches.group(1)), matches.group(2)
+        else:
+            value, condition = float(matches.group(4)), matches.group(3)
+
+        terms.append((value, condition))
+        pos = matches.end()
+
+    if len(terms) == 0:
+        return None
+
+    variable = None
+    lowerOps = set()
+    upperOps = set()
+    bins = []
+
+    for value, condition in terms:
+        low = float('-inf')
+        high = float('inf')
+
+        for part in condition.split('&&'):
+            matches = _comparison.match(part)
+            if not matches:
+                return None
+
+            var, op, bound = matches.group(1), matches.group(2), float(matches.group(3))
+            if variable is None:
+                variable = var
+            elif var != variable:
+                return None
+
+            if op.startswith('>'):
+                low = bound
+                lowerOps.add(op)
+            else:
+                high = bound
+                upperOps.add(op)
+
+        bins.append((low, high, value))
+
+    # all bins must be either [low, high) or (low, high]
+    if lowerOps <= set(['>=']) and upperOps <= set(['<']):
+        lowerInclusive = True
+    elif lowerOps <= set(['>']) and upperOps <= set(['<=']):
+        lowerInclusive = False
+    else:
+        return None
+
+    bins.sort()
+
+    edges = [bins[0][0]]
+    values = []
+    for low, high, value in bins:
+        if low < edges[-1]:
+            # overlapping terms
+            return None
+        elif low > edges[-1]:
+            values.append(0.)
+            edges.append(low)
+
+        values.append(value)
+        edges.append(high)
+
+    return variable, edges, values, lowerInclusive
+
+def _balanced(expr):
+    depth = 0
+    for c in expr:
+        if c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+            if depth < 0:
+                return False
+
+    return depth == 0
+
+def makeTable(source):
+    """
+    LookupTable from a TH1 (clamped at the ends), an (edges, values) pair, or a piecewise formula string.
+    """
+
+    loadLibrary()
+
+    if isinstance(source, ROOT.TH1):
+        return ROOT.LookupTable(source)
+
+    if isinstance(source, str):
+        parsed = parsePiecewise(source)
+        if parsed is None:
+            raise RuntimeError('Not a piecewise constant expression: ' + source)
+
+        _, edges, values, lowerInclusive = parsed
+    else:
+        edges, values = source
+        lowerInclusive = True
+
+    if len(edges) != len(values) + 1:
+        raise RuntimeError('Lookup table needs one more edge than values')
+
+    return ROOT.LookupTable(len(values), _doubles(edges), _doubles(values), lowerInclusive)
+
+def _doubles(values):
+    import array
+    return array.array('d', values)
+
+def register(name, source, expr):
+    """
+    Register the table made from source under name and return the formula evaluating it at expr.
+    A name is registered only once.
+    """
+
+    if name not in _registered:
+        _registered[name] = ROOT.registerLookup(makeTable(source))
+
+    return 'lookupWeight(%d, %s)' % (_registered[name], expr)
+
+def convert(expr):
+    """
+    Return the lookup call replacing the piecewise formula expr, or expr itself if it is not piecewise constant.
+    """
+
+    if expr in _converted:
+        return _converted[expr]
+
+    parsed = parsePiecewise(expr)
+    if parsed is None:
+        converted = expr
+    else:
+        variable = parsed[0]
+        converted = register('piecewise_%d' % len(_converted), expr, variable)
+
+    _converted[expr] = converted
+
+    return converted
@@ -32,7 +32,7 @@ sys.argv = []
 import ROOT
 ROOT.gROOT.SetBatch(True)
 
-ROOT.gROOT.LoadMacro(thisdir + '/GoodLumiFilter.cc+')
+from goodlumi import addLumiList
 ROOT.gROOT.LoadMacro(thisdir + '/MakeLumiList.cc+')
 
 mask = {}
@@ -42,11 +42,7 @@ if args.mask:
         with open(args.mask) as maskFile:
             maskJSON = eval(maskFile.read())
 
-        for runStr, lumiRanges in maskJSON.items():
-            run = int(runStr)
-            for begin, end in lumiRanges:
-                for lumi in range(begin, end + 1):
-                    mask.addLumi(run, lumi)
+        addLumiList(mask, maskJSON)
 
     except:
         print 'Could not parse mask JSON', args.mask
@@ -5,36 +5,25 @@ import collections
 
 directory = sys.argv[1]
 
-allLumis = collections.defaultdict(list)
+allRanges = collections.defaultdict(list)
 
 for fname in os.listdir(directory):
     with open(directory + '/' + fname) as f:
         j = json.loads(f.read())
         for run, intervals in j.items():
-            run = int(run)
-            for interval in intervals:
-                for lumi in range(interval[0], interval[1] + 1):
-                    allLumis[run].append(lumi)
+            allRanges[int(run)].extend((begin, end) for begin, end in intervals)
 
 runBlocks = []
 
-for run in sorted(allLumis.keys()):
-    lumis = allLumis[run]
-
+for run in sorted(allRanges.keys()):
+    # merge overlapping and adjacent intervals without expanding them into lumis
     intervals = []
-
-    begin = 0
-    end = -1
-    for lumi in sorted(lumis):
-        if lumi != end + 1:
-            if begin != 0:
-                intervals.append((begin, end))
-
-            begin = lumi
-
-        end = lumi
-
-    intervals.append((begin, end))
+    for begin, end in sorted(allRanges[run]):
+        if len(intervals) != 0 and begin <= intervals[-1][1] + 1:
+            if end > intervals[-1][1]:
+                intervals[-1] = (intervals[-1][0], end)
+        else:
+            intervals.append((begin, end))
 
     runBlock = '  "%d": [\n' % run
     runBlock += ',\n'.join(['    [%d, %d]' % interval for interval in intervals])
@@ -0,0 +1,136 @@
+"""
+Merging of ROOT files with identical structure, replacing hadd / padd and TChain.CloneTree.
+
+Each input is opened once: trees are appended to the output by copying the compressed baskets
+(TTree::CopyEntries with the "fast" option) whenever the branch layout of the input matches that of the
+output, and histograms are summed while the file is open. Independent merges can be run in a process pool.
+
+Usage:
+  mergeFiles(['a.root', 'b.root'], 'merged.root')
+  mergeMany([(['a.root', 'b.root'], 'ab.root'), (['c.root', 'd.root'], 'cd.root')], nproc = 2)
+"""
+
+import multiprocessing
+
+import ROOT
+
+def branchLayout(tree):
+    """
+    List of (branch name, class name, leaf types) identifying the storage layout of the tree.
+    """
+
+    layout = []
+    for branch in tree.GetListOfBranches():
+        leaves = tuple(leaf.GetTypeName() for leaf in branch.GetListOfLeaves())
+        layout.append((branch.GetName(), branch.GetClassName(), leaves))
+
+    return layout
+
+def mergeFiles(inpaths, outpath, chainTrees = None, fast = True):
+    """
+    Merge inpaths into outpath. Trees named in chainTrees (all trees if None) are concatenated and histograms
+    are summed. Other trees and objects are copied from the first input that has them. Only the highest cycle of
+    each key is read, as in hadd; backup cycles left by AutoSave are ignored.
+    Returns False if any of the inputs cannot be opened.
+    """
+
+    output = ROOT.TFile.Open(outpath, 'recreate')
+
+    trees = {} # {name: (output tree, layout)}
+    objects = {} # {name: output object}
+    order = []
+
+    treeClass = ROOT.TTree.Class()
+    histClass = ROOT.TH1.Class()
+
+    success = True
+
+    for inpath in inpaths:
+        source = ROOT.TFile.Open(inpath)
+        if not source or source.IsZombie():
+            print 'Cannot open', inpath
+            success = False
+            break
+
+        # the key list has one entry per cycle
+        seen = set()
+
+        for key in source.GetListOfKeys():
+            name = key.GetName()
+            if name in seen:
+                continue
+
+            seen.add(name)
+
+            cls = ROOT.TClass.GetClass(key.GetClassName())
+
+            if cls and cls.InheritsFrom(treeClass):
+                # Get returns the highest cycle
+                tree = source.Get(name)
+
+                if name not in trees:
+                    output.cd()
+                    if fast:
+                        clone = tree.CloneTree(-1, 'fast')
+                    else:
+                        clone = tree.CloneTree()
+
+                    trees[name] = (clone, branchLayout(tree))
+                    order.append(name)
+
+                elif chainTrees is None or name in chainTrees:
+                    clone, layout = trees[name]
+                    if fast and branchLayout(tree) == layout:
+                        clone.CopyEntries(tree, -1, 'fast')
+                    else:
+                        clone.CopyEntries(tree)
+
+            elif cls and cls.InheritsFrom(histClass):
+                if name in objects:
+                    objects[name].Add(source.Get(name))
+                else:
+                    output.cd()
+                    hist = source.Get(name).Clone()
+                    hist.SetDirectory(output)
+                    objects[name] = hist
+                    order.append(name)
+
+            elif name not in objects:
+                output.cd()
+                objects[name] = source.Get(name).Clone()
+                order.append(name)
+
+        source.Close()
+
+    output.cd()
+    for name in order:
+        if name in trees:
+            trees[name][0].Write('', ROOT.TObject.kOverwrite)
+        else:
+            objects[name].Write(name, ROOT.TObject.kOverwrite)
+
+    output.Close()
+
+    return success
+
+def _mergeJob(job):
+    inpaths, outpath, kwd = job
+    return mergeFiles(inpaths, outpath, **kwd)
+
+def mergeMany(jobs, nproc = 1):
+    """
+    Run mergeFiles for each (inpaths, outpath) or (inpaths, outpath, {keyword arguments}) in jobs,
+    nproc at a time. Returns the list of results in the order of jobs.
+    """
+
+    jobs = [tuple(job) + ({},) if len(job) == 2 else tuple(job) for job in jobs]
+
+    if nproc <= 1 or len(jobs) <= 1:
+        return map(_mergeJob, jobs)
+
+    pool = multiprocessing.Pool(min(nproc, len(jobs)))
+    try:
+        return pool.map(_mergeJob, jobs)
+    finally:
+        pool.close()
+        pool.join()
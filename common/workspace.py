@@ -39,6 +39,9 @@ import math
 import array
 import pprint
 import collections
+import hashlib
+import multiprocessing
+import numpy
 import ROOT
 
 from HiggsAnalysis.CombinedLimit.ModelTools import SafeWorkspaceImporter
@@ -87,7 +90,7 @@ def nuisance(nuis, up, down = None):
         a1 = -1. + 1.e-5
 
     if not workspace.arg(nuis):
-        fct('{nuis}[0,-5,5]'.format(nuis = nuis))
+        realVar(nuis, 0., -5., 5.)
         nuisances.append(nuis)
 
     return a1, nuis
@@ -120,6 +123,51 @@ def nuisance_old(nuis, target, up, down, form):
 
     return var
 
+def realVar(name, val, low = None, high = None):
+    """
+    Create a RooRealVar in the workspace. Constant if low and high are not given.
+    """
+
+    if low is None:
+        var = ROOT.RooRealVar(name, name, float(val))
+    else:
+        var = ROOT.RooRealVar(name, name, float(val), float(low), float(high))
+
+    wsimport(var)
+
+    return workspace.var(name)
+
+def function(cls, name, *args):
+    """
+    Create a RooAbsReal of class cls (constructor arguments name, title, *args) from objects in the workspace, and
+    import it.
+    """
+
+    func = cls(name, name, *args)
+    wsimport(func, ROOT.RooFit.RecycleConflictNodes())
+
+    return workspace.function(name)
+
+def product(name, factors):
+    """
+    Replaces fct('expr::name("@0*@1", {a, b})') and fct('prod::name(a, b)').
+    """
+
+    return function(ROOT.RooProduct, name, ROOT.RooArgList(*factors))
+
+def processNormalization(name, modifiers):
+    """
+    Create a ProcessNormalization with log-normal modifiers [(a1, nuisance name)].
+    """
+
+    procnorm = ROOT.ProcessNormalization(name, name)
+    for a1, nuis in modifiers:
+        procnorm.addLogNormal(1. + float(a1), workspace.var(nuis))
+
+    wsimport(procnorm)
+
+    return workspace.function(name)
+
 def modRelUncert2(var):
     # stat uncertainty of TFs have two parameters
     # allow for general case of N parameters
@@ -183,32 +231,406 @@ def denormalize(hist, makeInt = False):
 
         hist.SetBinContent(iX, cont)
 
-def fetchHistograms(config, sourcePlots, totals, hstore):
-    sources = {}
+def binArrays(hist):
+    """
+    Contents and errors of the bins of a 1D histogram (without under/overflow) as numpy arrays.
+    """
+
+    nbins = hist.GetNbinsX()
+    contents = numpy.array([hist.GetBinContent(iX) for iX in range(1, nbins + 1)], dtype = numpy.float64)
+    errors = numpy.array([hist.GetBinError(iX) for iX in range(1, nbins + 1)], dtype = numpy.float64)
+
+    return contents, errors
+
+def makeArrays(sourcePlots):
+    """
+    Convert {region: {process: {variation: hist}}} to the same structure with binArrays values.
+    """
+
+    sourceArrays = {}
+    for region, procPlots in sourcePlots.items():
+        sourceArrays[region] = {}
+        for process, plots in procPlots.items():
+            sourceArrays[region][process] = dict((variation, binArrays(hist)) for variation, hist in plots.items())
+
+    return sourceArrays
+
+def constructionOrder(sourcePlots):
+    """
+    List of (process, region) samples ordered so that every link source precedes its targets.
+    """
+
+    order = []
+    state = {} # {sample: False (being visited) or True (done)}
+
+    def visit(sample):
+        try:
+            if state[sample]:
+                return
+            else:
+                raise RuntimeError('Circular link involving {0}'.format(sample))
+        except KeyError:
+            pass
+
+        state[sample] = False
+
+        source = linkSource(sample)
+        if source is not None:
+            if source[0] not in sourcePlots[source[1]]:
+                raise RuntimeError('{0} linked from missing sample {1}'.format(sample, source))
+
+            visit(source)
+
+        state[sample] = True
+        order.append(sample)
 
     for region in config.regions:
-        sourcePlots[region] = collections.defaultdict(dict)
+        for process in sourcePlots[region]:
+            if process != 'data_obs':
+                visit((process, region))
+
+    return order
+
+def isIgnored(sample, var):
+    return sample in config.ignoredNuisances and var in config.ignoredNuisances[sample]
+
+def firstBin(mask):
+    """
+    Index of the first True element of mask, or None.
+    """
+
+    indices = numpy.nonzero(mask)[0]
+    if len(indices) == 0:
+        return None
+    else:
+        return indices[0]
+
+def binnedName(var, ibin):
+    """
+    Nuisance name for bin index ibin (0-based); deshaped nuisances have one parameter per bin.
+    """
+
+    if var in config.deshapedNuisances:
+        # this nuisance is artificially decorrelated among bins
+        return var + '_bin{ibin}'.format(ibin = ibin + 1)
+    else:
+        return var
+
+def buildLinkTarget(sample, sbase, arrays, baseArrays, normModifiers):
+    """
+    Bins of a sample whose yields are transfer factors times the yields of sbase.
+    """
+
+    process, region = sample
+    sampleName = '{0}_{1}'.format(*sample)
+    sbaseName = '{0}_{1}'.format(*sbase)
+
+    numer, numerErr = arrays['nominal']
+    denom, denomErr = baseArrays['nominal']
+    nbins = len(numer)
+
+    with numpy.errstate(divide = 'ignore', invalid = 'ignore'):
+        # TH1::Divide convention: 0 where the denominator is 0
+        ratio = numpy.where(denom != 0., numer / denom, 0.)
+        valid = ratio != 0.
+        # avoid dividing by zero in invalid bins - they are not used
+        safeRatio = numpy.where(valid, ratio, 1.)
+        safeNumer = numpy.where(valid, numer, 1.)
+        safeDenom = numpy.where(valid, denom, 1.)
+
+        binRelErr = numerErr / safeNumer
+        baseRelErr = denomErr / safeDenom
+
+    # list of yield modifiers per bin; statistical uncertainties of the tfactor first
+    modifiers = [[] for ibin in range(nbins)]
+    for ibin in numpy.nonzero(valid)[0]:
+        binName = sampleName + '_bin{0}'.format(ibin + 1)
+        baseBinName = sbaseName + '_bin{0}'.format(ibin + 1)
+        modifiers[ibin].append(nuisance(baseBinName + '_stat', baseRelErr[ibin]))
+        modifiers[ibin].append(nuisance(binName + '_stat', binRelErr[ibin]))
+
+    # other systematic uncertainties on tfactor
+    # collect all variations on numerator and denominator
+    upVariations = set(v for v in arrays.keys() if v.endswith('Up'))
+    upVariations |= set(v for v in baseArrays.keys() if v.endswith('Up'))
+
+    for variation in sorted(upVariations):
+        var = variation[:-2]
+
+        if isIgnored(sample, var):
+            continue
+
+        if var + 'Up' in arrays:
+            numerUp = arrays[var + 'Up'][0]
+            numerDown = arrays[var + 'Down'][0]
+        else:
+            numerUp = numer
+            numerDown = numer
+
+        if var + 'Up' in baseArrays:
+            denomUp = baseArrays[var + 'Up'][0]
+            denomDown = baseArrays[var + 'Down'][0]
+        else:
+            denomUp = denom
+            denomDown = denom
 
-        # data histogram
-        sourceDir = openHistSource(config, config.data, region, sources)
+        with numpy.errstate(divide = 'ignore', invalid = 'ignore'):
+            rup = numerUp / denomUp / safeRatio - 1.
+            rdown = numerDown / denomDown / safeRatio - 1.
+
+        if (sample, sbase, var) in config.ratioCorrelations:
+            # need to split the nuisance into correlated and anti-correlated
+            # assuming no scaleNuisance is partially correlated
+            correlation = config.ratioCorrelations[(sample, sbase, var)]
+
+            with numpy.errstate(divide = 'ignore', invalid = 'ignore'):
+                raup = numerUp / denomDown / safeRatio - 1.
+                radown = numerDown / denomUp / safeRatio - 1.
+
+            for suffix, coeff, up, down in [('_corr', (1. + correlation) * 0.5, rup, rdown), ('_acorr', (1. - correlation) * 0.5, raup, radown)]:
+                if coeff == 0.:
+                    continue
+
+                significant = valid & ((numpy.abs(up) > SMALLNUMBER) | (numpy.abs(down) > SMALLNUMBER))
+                for ibin in numpy.nonzero(significant)[0]:
+                    modifiers[ibin].append(nuisance(binnedName(var, ibin) + suffix, coeff * up[ibin], coeff * down[ibin]))
+
+        else:
+            # skip bins where the uncertainty affects the numerator and denominator identically
+            significant = valid & ((numpy.abs(rup) >= SMALLNUMBER) | (numpy.abs(rdown) >= SMALLNUMBER))
+
+            if var in config.scaleNuisances:
+                # this is a bin-independent modifier, evaluated at the first relevant bin
+                ibin = firstBin(significant)
+                if ibin is not None and var not in normModifiers:
+                    normModifiers[var] = nuisance(var, rup[ibin], rdown[ibin])
+            else:
+                for ibin in numpy.nonzero(significant)[0]:
+                    modifiers[ibin].append(nuisance(binnedName(var, ibin), rup[ibin], rdown[ibin]))
+
+    bins = []
+
+    for ibin in range(nbins):
+        binName = sampleName + '_bin{0}'.format(ibin + 1)
+
+        if not valid[ibin]:
+            print '    WARNING: {region} {process} bin{ibin} has tf = 0'.format(region = region, process = process, ibin = ibin + 1)
+            bins.append(realVar('mu_' + binName, 0.))
+            continue
+
+        # nominal tfactor (constant)
+        tf = realVar(sampleName + '_' + sbaseName + '_bin{0}'.format(ibin + 1) + '_tf', ratio[ibin])
+        baseMu = workspace.arg('mu_' + sbaseName + '_bin{0}'.format(ibin + 1))
+
+        if len(modifiers[ibin]) > 0:
+            # "raw" yield (= base x tfactor)
+            raw = product('raw_' + binName, [tf, baseMu])
+            mod = processNormalization('mod_' + binName, modifiers[ibin])
+            # mu = raw x mod
+            bins.append(product('mu_' + binName, [raw, mod]))
+        else:
+            bins.append(product('mu_' + binName, [tf, baseMu]))
+
+    return bins
+
+def buildLinkSource(sample, arrays):
+    """
+    Bins of a sample used as a base of other samples. Bins are free parameters (scaled together if static)
+    and have no uncertainties; uncertainties are all casted on tfactors.
+    """
+
+    sampleName = '{0}_{1}'.format(*sample)
+    nominal = arrays['nominal'][0]
+
+    bins = []
+
+    if sample in config.staticBase:
+        print '    this sample is a static base of some other sample'
+
+        scale = realVar('mu_{sample}_scale'.format(sample = sampleName), 1., 1.0e-6, 10.)
+        # bin mu is raw x norm
+        for ibin in range(len(nominal)):
+            raw = realVar('rawmu_{sample}_bin{bin}'.format(sample = sampleName, bin = ibin + 1), nominal[ibin])
+            bins.append(product('mu_{sample}_bin{bin}'.format(sample = sampleName, bin = ibin + 1), [raw, scale]))
+
+    else:
+        print '    this sample is a base of some other sample'
+        # each bin must be described by a free-floating RooRealVar unless this is a fixed base
+
+        maximum = nominal.max() * 10.
+        for ibin in range(len(nominal)):
+            bins.append(realVar('mu_{sample}_bin{bin}'.format(sample = sampleName, bin = ibin + 1), nominal[ibin], 0., maximum))
+
+    return bins
+
+def buildIndependent(sample, arrays, totalArrays, normModifiers):
+    """
+    Bins of a sample that does not participate in constraints.
+    """
+
+    process, region = sample
+    sampleName = '{0}_{1}'.format(*sample)
+
+    cval, cerr = arrays['nominal']
+    nbins = len(cval)
+
+    positive = cval > 0.
+    safe = numpy.where(positive, cval, 1.)
+
+    modifiers = [[] for ibin in range(nbins)]
+
+    # statistical uncertainty - often not considered
+    relErr = cerr / safe
+    bkgTotal = totalArrays[region][0]
+    with numpy.errstate(divide = 'ignore', invalid = 'ignore'):
+        stat = positive & (relErr > SMALLNUMBER) & ((bkgTotal <= 0.) | (cval / bkgTotal > STATCUTOFF))
+
+    for ibin in numpy.nonzero(stat)[0]:
+        modifiers[ibin].append(nuisance('{sample}_bin{ibin}_stat'.format(sample = sampleName, ibin = ibin + 1), relErr[ibin]))
+
+    for variation in sorted(arrays.keys()):
+        if not variation.endswith('Up'):
+            continue
+
+        var = variation[:-2]
+
+        if isIgnored(sample, var):
+            continue
+
+        dup = arrays[var + 'Up'][0] / safe - 1.
+        ddown = arrays[var + 'Down'][0] / safe - 1.
+
+        significant = positive & (numpy.abs(dup - ddown) >= SMALLNUMBER)
+
+        if var in config.scaleNuisances:
+            # this is a bin-independent variation, evaluated at the first relevant bin
+            if var in normModifiers:
+                # we took care of this already
+                continue
+
+            if process in config.floatProcesses:
+                # if this sample is freely floating; scale modifiers are unnecessary degrees of freedom
+                continue
+
+            ibin = firstBin(significant)
+            if ibin is not None:
+                normModifiers[var] = nuisance(var, dup[ibin], ddown[ibin])
+        else:
+            for ibin in numpy.nonzero(significant)[0]:
+                modifiers[ibin].append(nuisance(binnedName(var, ibin), dup[ibin], ddown[ibin]))
+
+    bins = []
+
+    for ibin in range(nbins):
+        binName = sampleName + '_bin{0}'.format(ibin + 1)
+
+        if not positive[ibin]:
+            # bin content is 0
+            bins.append(realVar('mu_' + binName, 0.))
+        elif len(modifiers[ibin]) > 0:
+            raw = realVar('raw_' + binName, cval[ibin])
+            mod = processNormalization('mod_' + binName, modifiers[ibin])
+            bins.append(product('mu_' + binName, [raw, mod]))
+        else:
+            bins.append(realVar('mu_' + binName, cval[ibin]))
+
+    return bins
+
+def buildSample(sample, sourcePlots, sourceArrays, totalArrays):
+    """
+    Construct the RooParametricHist and the normalization of a (process, region).
+    """
+
+    process, region = sample
+    sampleName = '{0}_{1}'.format(*sample)
+
+    print '  Constructing pdf for', sampleName
+
+    # collect nuisances that affect the overall normalization
+    normModifiers = {}
+
+    arrays = sourceArrays[region][process]
+
+    # there are three different types of samples
+    # 1. link target: mu is TF x someone else's mu
+    # 2. link source: mu is its own, but has no uncertainty assigned
+    # 3. independent: mu is its own and has uncertainties
+
+    sbase = linkSource(sample)
+    if sbase is not None:
+        print '    this sample is a function of the yields in', sbase
+        bins = buildLinkTarget(sample, sbase, arrays, sourceArrays[sbase[1]][sbase[0]], normModifiers)
+
+    elif isLinkSource(sample):
+        bins = buildLinkSource(sample, arrays)
+
+    else:
+        print '    this sample does not participate in constraints'
+        bins = buildIndependent(sample, arrays, totalArrays, normModifiers)
 
-        histname = config.histname.format(process = config.data, region = region)
+    binList = ROOT.RooArgList()
+    for bin in bins:
+        binList.add(bin)
 
-        hist = sourceDir.Get(histname)
-        if not hist:
-            print histname, 'not found'
-            sys.exit(1)
+    # now compile the bins into a parametric hist pdf and a norm
+    shape = ROOT.RooParametricHist(sampleName, sampleName, x, binList, sourcePlots[region][process]['nominal'])
+    wsimport(shape)
 
-        hist.SetDirectory(hstore)
+    if process in config.floatProcesses:
+        print '      normalization is floated'
+        normName = 'rawnorm'
+        mod = realVar('mod_{sample}_norm'.format(sample = sampleName), 1., 0., 100.)
 
-        if config.binWidthNormalized:
-            denormalize(hist, makeInt = True)
+    elif len(normModifiers) > 0:
+        normName = 'rawnorm'
+        mod = processNormalization('mod_{sample}_norm'.format(sample = sampleName), normModifiers.values())
 
-        # name does not have _*Up or _*Down suffix -> is a nominal histogram
-        sourcePlots[region]['data_obs']['nominal'] = hist
+    else:
+        # if there is no normModifier, RooAddition of the bins is the norm
+        normName = 'norm'
+
+    if len(bins) > 1:
+        norm = function(ROOT.RooAddition, '{sample}_{norm}'.format(sample = sampleName, norm = normName), binList)
+    else:
+        norm = product('{sample}_{norm}'.format(sample = sampleName, norm = normName), bins)
+
+    if normName == 'rawnorm':
+        product('{sample}_norm'.format(sample = sampleName), [norm, mod])
+
+def fetchHistograms(config, sourcePlots, totals, hstore, processes = None, fetchData = True):
+    """
+    Read the histograms of the processes (all backgrounds and signals if None) and, if fetchData, the data.
+    """
+
+    if processes is None:
+        processes = config.bkgProcesses + config.signals
+
+    sources = {}
+
+    for region in config.regions:
+        sourcePlots[region] = collections.defaultdict(dict)
+
+        if fetchData:
+            # data histogram
+            sourceDir = openHistSource(config, config.data, region, sources)
+    
+            histname = config.histname.format(process = config.data, region = region)
+    
+            hist = sourceDir.Get(histname)
+            if not hist:
+                print histname, 'not found'
+                sys.exit(1)
+    
+            hist.SetDirectory(hstore)
+    
+            if config.binWidthNormalized:
+                denormalize(hist, makeInt = True)
+    
+            # name does not have _*Up or _*Down suffix -> is a nominal histogram
+            sourcePlots[region]['data_obs']['nominal'] = hist
         
         # background and signal histograms
-        for process in config.bkgProcesses + config.signals:
+        for process in processes:
             sourceDir = openHistSource(config, process, region, sources)
 
             if process in config.signals and config.signalHistname:
@@ -254,6 +676,9 @@ def fetchHistograms(config, sourcePlots, totals, hstore):
 
     # make sure all signal processes appear at least in one region
     for process in config.signals:
+        if process not in processes:
+            continue
+
         for region in config.regions:
             if process in sourcePlots[region]:
                 break
@@ -261,523 +686,418 @@ def fetchHistograms(config, sourcePlots, totals, hstore):
             raise RuntimeError('Signal process ' + process + ' was not found in any of the regions.')
 
 
-if __name__ == '__main__':
-
-    ## INPUT
-    # fetch all source histograms first    
-
-    sourcePlots = {}
-    totals = {} # {region: background total}
-
-    hstore = ROOT.gROOT.mkdir('hstore')
-
-    fetchHistograms(config, sourcePlots, totals, hstore)
+def setupWorkspace(hist):
+    """
+    Create an empty workspace and the observable with the binning of hist as the module globals.
+    """
 
-    ## WORKSPACE
+    global workspace, wsimport, x
 
     workspace = ROOT.RooWorkspace('wspace')
     wsimport = SafeWorkspaceImporter(workspace)
 
-    ROOT.RooMsgService.instance().setGlobalKillBelow(ROOT.RooFit.WARNING)
-
     x = fct('{xname}[-1.e+10,1.e+10]'.format(xname = config.xname))
     x.SetTitle(config.xtitle)
     x.setUnit(config.xunit)
 
     # binning
-    h = sourcePlots[config.regions[0]]['data_obs']['nominal']
-    xaxis = h.GetXaxis()
+    xaxis = hist.GetXaxis()
     if xaxis.GetXbins().GetSize():
-        x.setBinning(ROOT.RooBinning(h.GetNbinsX(), xaxis.GetXbins().GetArray()), 'default')
+        x.setBinning(ROOT.RooBinning(hist.GetNbinsX(), xaxis.GetXbins().GetArray()), 'default')
     else:
-        x.setBinning(ROOT.RooBinning(h.GetNbinsX(), xaxis.GetXmin(), xaxis.GetXmax()), 'default')
+        x.setBinning(ROOT.RooBinning(hist.GetNbinsX(), xaxis.GetXmin(), xaxis.GetXmax()), 'default')
 
-    print 'Constructing the workspace'
+def writeWorkspace(outname):
+    if not os.path.isdir(os.path.dirname(os.path.realpath(outname))):
+        os.makedirs(os.path.dirname(os.path.realpath(outname)))
 
-    # will construct the workspace iteratively to resolve links
-    iteration = 0
-    done = False
-    while not done:
+    workspace.writeToFile(outname)
 
-        done = True
+    print 'Workspace written to', outname
 
-        print '<Iteration {0}>'.format(iteration)
-        iteration += 1
+def makeCardTemplate(yields, wsPath):
+    """
+    Lines and columns common to the data cards of all signal models.
+    yields is {region: {process: expected yield}} including the signals.
+    Returns (lines, columns, signalRegions).
+    """
 
-        for region in config.regions:
-            dataObsName = 'data_obs_' + region
+    samplesByRegion = {} # names of background samples by region
+    procIds = {}
+    signalRegions = set()
+
+    maxRegionNameLength = 0
 
-            if workspace.data(dataObsName):
-                # data_obs DataHist is added to the workspace only when all background & signal PDFs are constructed.
-                # -> this region is fully constructed
+    for region, procYields in yields.items():
+        samplesByRegion[region] = []
+
+        # sort processes by expectation
+        procs = sorted(procYields.keys(), key = lambda p: -procYields[p])
+
+        for p in procs:
+            if p == 'data_obs':
                 continue
+            elif p in config.signals:
+                signalRegions.add(region)
+            else:
+                samplesByRegion[region].append(p)
+                if p not in procIds:
+                    procIds[p] = len(procIds) + 1
 
-            regionDone = True
-            for process, plots in sourcePlots[region].items():
-                if process == 'data_obs':
-                    continue
+        if len(region) > maxRegionNameLength:
+            maxRegionNameLength = len(region)
 
-                sample = (process, region)
-                sampleName = '{0}_{1}'.format(*sample)
+    # define datacard template
 
-                if workspace.arg(sampleName + '_norm'):
-                    # this (process, region) is constructed already
-                    continue
+    hrule = '-' * 140
 
-                # now construct the ParametricHist + norm
-                bins = ROOT.RooArgList()
-                # collect nuisances that affect the overall normalization
-                normModifiers = {}
+    lines = [
+        'imax * number of bins',
+        'jmax * number of processes minus 1',
+        'kmax * number of nuisance parameters',
+        hrule,
+        'shapes * * %s wspace:$PROCESS_$CHANNEL' % wsPath,
+        hrule,
+    ]
 
-                nominal = plots['nominal']
+    colw = max(maxRegionNameLength + 1, 9)
 
-                print '  Constructing pdf for', sampleName
+    # list of regions, signal regions first
+    line = 'bin          ' + ''.join(sorted('%{w}s'.format(w = colw) % r for r in signalRegions)) + ''.join(sorted('%{w}s'.format(w = colw) % r for r in samplesByRegion if r not in signalRegions))
+    lines.append(line)
 
-                # there are three different types of samples
-                # 1. link target: mu is TF x someone else's mu
-                # 2. link source: mu is its own, but has no uncertainty assigned
-                # 3. independent: mu is its own and has uncertainties
+    # number of observed events in each region (set to -1 - combine will read it from workspace)
+    line = 'observation  ' + ''.join('%{w}.1f'.format(w = colw) % o for o in [-1.] * len(samplesByRegion))
+    lines.append(line)
 
-                sbase = linkSource(sample)
-                if sbase is not None:
-                    print '    this sample is a function of the yields in', sbase
-
-                    try:
-                        # check for source recursively
-                        source = sbase
-                        while source is not None:
-                            if not workspace.arg('{0}_{1}_norm'.format(*source)):
-                                # source of this sample is not constructed yet
-                                raise ReferenceError()
-
-                            source = linkSource(source)
-
-                    except ReferenceError:
-                        print '    but source', source, 'is not constructed yet.'
-                        # try again in a later iteration
-                        regionDone = False
-                        continue
+    lines.append(hrule)
 
-                    sbaseName = '{0}_{1}'.format(*sbase)
-                    # sampleName = sampleName + '_' + sbaseName
-
-                    numer = nominal
-                    basePlots = sourcePlots[sbase[1]][sbase[0]]
-                    denom = basePlots['nominal']
-
-                    ratio = numer.Clone('ratio')
-                    ratio.Divide(denom)
-
-                    for ibin in range(1, nominal.GetNbinsX() + 1):
-                        rbin = ratio.GetBinContent(ibin)
-
-                        binName = sampleName + '_bin{0}'.format(ibin)
-                        baseBinName = sbaseName + '_bin{0}'.format(ibin)
-
-                        if rbin == 0.:
-                            print '    WARNING: {region} {process} bin{ibin} has tf = 0'.format(region = region, process = process, ibin = ibin)
-                            bin = fct('mu_{bin}[0.]'.format(bin = binName))
-                            bins.add(bin)
-                            continue
-
-                        # tfName = binName + '_tf'
-                        tfName = sampleName + '_' + sbaseName + '_bin{0}'.format(ibin) + '_tf'
-
-                        # nominal tfactor (constant)
-                        fct('{tf}[{val}]'.format(tf = tfName, val = rbin))
+    # columns for all background processes and yields
+    columns = []
 
-                        # list of yield modifiers (switch to using RooArgList if the chained string becomes too long)
-                        modifiers = []
-
-                        # statistical uncertainty on tfactor
-                        binRelErr = nominal.GetBinError(ibin) / nominal.GetBinContent(ibin)
-                        baseRelErr = denom.GetBinError(ibin) / denom.GetBinContent(ibin)
-
-                        modifiers.append(nuisance(baseBinName + '_stat', baseRelErr))
-                        modifiers.append(nuisance(binName + '_stat', binRelErr))
-
-                        # other systematic uncertainties on tfactor
-                        # collect all variations on numerator and denominator
-                        upVariations = set(v for v in plots.keys() if v.endswith('Up'))
-                        upVariations |= set(v for v in basePlots.keys() if v.endswith('Up'))
-
-                        for variation in upVariations:
-                            var = variation[:-2]
-
-                            if sample in config.ignoredNuisances and var in config.ignoredNuisances[sample]:
-                                continue
-
-                            if var in config.scaleNuisances and var in normModifiers:
-                                # this uncertainty is non-shape and is taken care of already
-                                continue
-
-                            if var + 'Up' in plots:
-                                numerUp = plots[var + 'Up'].GetBinContent(ibin)
-                                numerDown = plots[var + 'Down'].GetBinContent(ibin)
-                            else:
-                                numerUp = numer.GetBinContent(ibin)
-                                numerDown = numer.GetBinContent(ibin)
-
-                            if var + 'Up' in basePlots:
-                                denomUp = basePlots[var + 'Up'].GetBinContent(ibin)
-                                denomDown = basePlots[var + 'Down'].GetBinContent(ibin)
-                            else:
-                                denomUp = denom.GetBinContent(ibin)
-                                denomDown = denom.GetBinContent(ibin)
-
-                            rup = numerUp / denomUp / rbin - 1.
-                            rdown = numerDown / denomDown / rbin - 1.
-
-                            if (sample, sbase, var) in config.ratioCorrelations:
-                                # need to split the nuisance into correlated and anti-correlated
-                                # assuming no scaleNuisance is partially correlated
-                                correlation = config.ratioCorrelations[(sample, sbase, var)]
-                                raup = numerUp / denomDown / rbin - 1.
-                                radown = numerDown / denomUp / rbin - 1.
-
-                                if var in config.deshapedNuisances:
-                                    # this nuisance is artificially decorrelated among bins
-                                    # calling "corr"Uncert function, but in reality this results in one nuisance per bin
-                                    var = var + '_bin{ibin}'.format(ibin = ibin)
-
-                                if abs(rup) > SMALLNUMBER or abs(rdown) > SMALLNUMBER:
-                                    coeff = (1. + correlation) * 0.5
-                                    if coeff != 0.:
-                                        modifiers.append(nuisance(var + '_corr', coeff * rup, coeff * rdown))
-
-                                if abs(raup) > SMALLNUMBER or abs(radown) > SMALLNUMBER:
-                                    coeff = (1. - correlation) * 0.5
-                                    if coeff != 0.:
-                                        modifiers.append(nuisance(var + '_acorr', coeff * raup, coeff * radown))
-
-                            else:
-                                if abs(rup) < SMALLNUMBER and abs(rdown) < SMALLNUMBER:
-                                    # fully correlated uncertainty that affects the numerator and denominator identically
-                                    continue
-
-                                if var in config.scaleNuisances:
-                                    # this is a bin-independent modifier
-                                    if var not in normModifiers:
-                                        normModifiers[var] = nuisance(var, rup, rdown)
-                                else:
-                                    if var in config.deshapedNuisances:
-                                        # this nuisance is artificially decorrelated among bins
-                                        # calling "corr"Uncert function, but in reality this results in one nuisance per bin
-                                        var = var + '_bin{ibin}'.format(ibin = ibin)
-
-                                    modifiers.append(nuisance(var, rup, rdown))
-
-                        if len(modifiers) > 0:
-                            # "raw" yield (= base x tfactor)
-                            fct('expr::raw_{bin}("@0*@1", {{{tf}, mu_{baseBin}}})'.format(bin = binName, tf = tfName, baseBin = baseBinName))
-
-                            procnorm = ROOT.ProcessNormalization('mod_{bin}'.format(bin = binName), 'mod_{bin}'.format(bin = binName))
-                            for m in modifiers:
-                                procnorm.addLogNormal(1. + m[0], workspace.var(m[1]))
-
-                            wsimport(procnorm)
-
-                            # mu = raw x mod
-                            bin = fct('prod::mu_{bin}(raw_{bin},mod_{bin})'.format(bin = binName))
-                        else:
-                            bin = fct('expr::mu_{bin}("@0*@1", {{{tf}, mu_{baseBin}}})'.format(bin = binName, tf = tfName, baseBin = baseBinName))
-
-                        bins.add(bin)
-
-                    ratio.Delete()
-
-                elif isLinkSource(sample):
-                    if sample in config.staticBase:
-                        print '    this sample is a static base of some other sample'
-    
-                        fct('mu_{sample}_scale[1., 1.0e-6, 10.]'.format(sample = sampleName))
-                        # bin mu is raw x norm
-                        for ibin in range(1, nominal.GetNbinsX() + 1):
-                            fct('rawmu_{sample}_bin{bin}[{val}]'.format(sample = sampleName, bin = ibin, val = nominal.GetBinContent(ibin)))
-                            bin = fct('prod::mu_{sample}_bin{bin}(rawmu_{sample}_bin{bin},mu_{sample}_scale)'.format(sample = sampleName, bin = ibin))
-                            bins.add(bin)
+    # signal region first
+    for region in signalRegions:
+        for proc in samplesByRegion[region]:
+            columns.append((region, proc, str(procIds[proc])))
 
-                    else:
-                        print '    this sample is a base of some other sample'
-                        # each bin must be described by a free-floating RooRealVar unless this is a fixed base
-                        # uncertainties are all casted on tfactors
+    for region in sorted(samplesByRegion):
+        if region in signalRegions:
+            continue
+
+        for proc in samplesByRegion[region]:
+            columns.append((region, proc, str(procIds[proc])))
+
+    return lines, columns, signalRegions
+
+def writeCard(signal, lines, columns, signalRegions, nuisanceNames, shapes = []):
+    """
+    Write the data card of one signal model. Lines in shapes are added before the default shapes line.
+    """
+
+    hrule = '-' * 140
+
+    cardcolumns = list(columns)
+    cardlines = list(lines)
+
+    ishape = cardlines.index(next(l for l in cardlines if l.startswith('shapes * *')))
+    cardlines[ishape:ishape] = shapes
+
+    # insert the signal expectation as the first column
+    ic = 0
+    for region in signalRegions:
+        # skip to the first column of the region
+        while columns[ic][0] != region:
+            ic += 1
+        
+        cardcolumns.insert(ic, (region, signal, str(-1)))
+
+    for ih, heading in enumerate(['bin', 'process', 'process']):
+        line = '%13s' % heading
+        for column in cardcolumns:
+            w = max(len(s) for s in column)
+            line += ('%{width}s'.format(width = w + 1)) % column[ih]
+        cardlines.append(line)
+
+    line = 'rate         '
+    for column in cardcolumns:
+        w = max(len(s) for s in column)
+        line += ('%{width}.1f'.format(width = w + 1)) % 1.
+    cardlines.append(line)
+
+    cardlines.append(hrule)
+
+    for nuisance in sorted(nuisanceNames):
+        # remove nuisances related to other signal models
+        matched_other_signal = False
+        for s in config.signals:
+            if s != signal and nuisance.startswith(s):
+                matched_other_signal = True
+                break
+
+        if matched_other_signal:
+            continue
+        
+        if nuisance in config.flatParams:
+            cardlines.append(nuisance + ' flatParam 0 1')
+        else:
+            cardlines.append(nuisance + ' param 0 1')
+
+    cardname = config.cardname.format(signal = signal)
+
+    with open(cardname, 'w') as datacard:
+        for line in cardlines:
+            if '{signal}' in line:
+                line = line.format(signal = signal)
+
+            datacard.write(line + '\n')
     
-                        for ibin in range(1, nominal.GetNbinsX() + 1):
-                            bin = fct('mu_{sample}_bin{bin}[{val},0.,{max}]'.format(sample = sampleName, bin = ibin, val = nominal.GetBinContent(ibin), max = nominal.GetMaximum() * 10.))
-                            bins.add(bin)
+    print ' ', signal, '-->', cardname
 
-                else:
-                    print '    this sample does not participate in constraints'
+def backgroundKey():
+    """
+    Hash of the parameters and input files that determine the background part of the workspace.
+    """
 
-                    for ibin in range(1, nominal.GetNbinsX() + 1):
-                        binName = sampleName + '_bin{0}'.format(ibin)
+    digest = hashlib.sha1()
 
-                        cval = nominal.GetBinContent(ibin)
-                        if cval <= 0.:
-                            # bin content is 0
-                            bin = fct('mu_{bin}[0.]'.format(bin = binName))
-                        else:
-                            modifiers = []
+    for attr in ['sourcename', 'histname', 'data', 'binWidthNormalized', 'xname', 'regions', 'bkgProcesses', 'links', 'staticBase', 'floatProcesses', 'ignoredNuisances', 'scaleNuisances', 'ratioCorrelations', 'deshapedNuisances']:
+        digest.update(attr + '=' + pprint.pformat(getattr(config, attr)) + '\n')
 
-                            # statistical uncertainty - often not considered
-                            relErr = nominal.GetBinError(ibin) / cval
-                            bkgTotal = totals[region].GetBinContent(ibin)
-                            if relErr > SMALLNUMBER and (bkgTotal <= 0. or cval / bkgTotal > STATCUTOFF):
-                                modifiers.append(nuisance('{bin}_stat'.format(bin = binName), relErr))
+    digest.update('SMALLNUMBER=%s STATCUTOFF=%s\n' % (repr(SMALLNUMBER), repr(STATCUTOFF)))
 
-                            for variation in plots:
-                                if not variation.endswith('Up'):
-                                    continue
+    for region in config.regions:
+        for process in [config.data] + config.bkgProcesses:
+            fname = config.sourcename.format(process = process, region = region)
+            if os.path.exists(fname):
+                stat = os.stat(fname)
+                digest.update('%s %d %d\n' % (fname, stat.st_mtime, stat.st_size))
+            else:
+                digest.update(fname + '\n')
 
-                                var = variation[:-2]
+    return digest.hexdigest()
 
-                                try:
-                                    if var in config.ignoredNuisances[sample]:
-                                        continue
-                                except KeyError:
-                                    pass
+def buildBackground(key, hstore):
+    """
+    Build and write the workspace of data and backgrounds only. The key, the set of nuisances, and the
+    background totals are saved with it.
+    """
 
-                                dup = plots[var + 'Up'].GetBinContent(ibin) / cval - 1.
-                                ddown = plots[var + 'Down'].GetBinContent(ibin) / cval - 1.
+    sourcePlots = {}
+    totals = {}
 
-                                if abs(dup - ddown) < SMALLNUMBER:
-                                    continue
+    fetchHistograms(config, sourcePlots, totals, hstore, processes = config.bkgProcesses)
 
-                                if var in config.scaleNuisances:
-                                    # this is a bin-independent variation
-                                    if var in normModifiers:
-                                        # we took care of this already
-                                        continue
+    setupWorkspace(sourcePlots[config.regions[0]]['data_obs']['nominal'])
 
-                                    if sample[0] in config.floatProcesses:
-                                        # if this sample is freely floating; scale modifiers are unnecessary degrees of freedom
-                                        continue
+    print 'Constructing the background workspace'
 
-                                    normModifiers[var] = nuisance(var, dup, ddown)
-                                else:
-                                    if var in config.deshapedNuisances:
-                                        # this nuisance is artificially decorrelated among bins
-                                        # treat each (variation name)_(bin name) as a variation name
-                                        var += '_bin{ibin}'.format(ibin = ibin)
+    sourceArrays = makeArrays(sourcePlots)
+    totalArrays = dict((region, binArrays(total)) for region, total in totals.items())
 
-                                    modifiers.append(nuisance(var, dup, ddown))
+    for sample in constructionOrder(sourcePlots):
+        buildSample(sample, sourcePlots, sourceArrays, totalArrays)
 
-                            if len(modifiers) > 0:
-                                raw = fct('raw_{bin}[{val}]'.format(bin = binName, val = cval))
+    for region in config.regions:
+        dataObsName = 'data_obs_' + region
+        data_obs = ROOT.RooDataHist(dataObsName, dataObsName, ROOT.RooArgList(x), sourcePlots[region]['data_obs']['nominal'])
+        wsimport(data_obs)
 
-                                procnorm = ROOT.ProcessNormalization('mod_{bin}'.format(bin = binName), 'mod_{bin}'.format(bin = binName))
-                                for m in modifiers:
-                                    procnorm.addLogNormal(1. + m[0], workspace.var(m[1]))
+    workspace.defineSet('nuisances', ','.join(nuisances))
 
-                                wsimport(procnorm)
+    writeWorkspace(config.outname)
 
-                                bin = fct('prod::mu_{bin}(raw_{bin},mod_{bin})'.format(bin = binName))
-                            else:
-                                bin = fct('mu_{bin}[{val}]'.format(bin = binName, val = cval))
+    output = ROOT.TFile.Open(config.outname, 'update')
+    ROOT.TNamed('backgroundKey', key).Write()
+    for total in totals.values():
+        total.Write()
+    output.Close()
 
-                        bins.add(bin)
+def loadBackground(key):
+    """
+    Read the nuisance names, the yields {region: {process: yield}}, and the background total arrays from the
+    background workspace. Returns None if the workspace does not exist or was built with a different key.
+    """
 
-                    # close switch between the three types of samples
+    if not os.path.exists(config.outname):
+        return None
 
-                # now compile the bins into a parametric hist pdf and a norm
-                shape = ROOT.RooParametricHist(sampleName, sampleName, x, bins, nominal)
-                wsimport(shape)
+    source = ROOT.TFile.Open(config.outname)
+    stored = source.Get('backgroundKey')
+    if not stored or stored.GetTitle() != key:
+        source.Close()
+        return None
 
-                if sample[0] in config.floatProcesses:
-                    print '      normalization is floated'
-                    normName = 'rawnorm'
-                    fct('mod_{sample}_norm[1.,0.,100.]'.format(sample = sampleName))
+    wspace = source.Get('wspace')
 
-                elif len(normModifiers) > 0:
-                    normName = 'rawnorm'
-                    procnorm = ROOT.ProcessNormalization('mod_{sample}_norm'.format(sample = sampleName), 'mod_{sample}_norm'.format(sample = sampleName))
-                    for m in normModifiers.values():
-                        procnorm.addLogNormal(1. + m[0], workspace.var(m[1]))
+    nuisanceNames = []
+    itr = wspace.set('nuisances').iterator()
+    while True:
+        nuis = itr.Next()
+        if not nuis:
+            break
 
-                    wsimport(procnorm)
+        nuisanceNames.append(nuis.GetName())
 
-                else:
-                    # if there is no normModifier, RooAddition of the bins is the norm
-                    normName = 'norm'
+    yields = {}
+    totalArrays = {}
+    for region in config.regions:
+        yields[region] = {}
+        for process in config.bkgProcesses:
+            norm = wspace.function('{0}_{1}_norm'.format(process, region))
+            if norm:
+                yields[region][process] = norm.getVal()
 
-                if bins.getSize() > 1:
-                    binNames = ','.join(bins.at(ib).GetName() for ib in range(bins.getSize()))
-                    fct('sum::{sample}_{norm}({binNames})'.format(sample = sampleName, norm = normName, binNames = binNames))
-                else:
-                    fct('expr::{sample}_{norm}("@0", {{{bin}}})'.format(sample = sampleName, norm = normName, bin = bins.at(0).GetName()))
+        total = source.Get('total_' + region)
+        if total:
+            totalArrays[region] = binArrays(total)
 
-                if normName == 'rawnorm':
-                    fct('expr::{sample}_norm("@0*@1", {{{sample}_rawnorm, mod_{sample}_norm}})'.format(sample = sampleName))
-            
-            # / for process, plots in sourcePlots[region].items():
+    source.Close()
 
-            if regionDone:
-                # All processes in the region are constructed. Add the observed RooDataHist.
-                data_obs = ROOT.RooDataHist(dataObsName, dataObsName, ROOT.RooArgList(x), sourcePlots[region]['data_obs']['nominal'])
-                wsimport(data_obs)
+    return nuisanceNames, yields, totalArrays
 
-            else:
-                done = False
+# filled before the signal workspaces are built in the worker processes
+background = None
 
-    if PRINTNUISANCE:
-        for n in sorted(nuisances):
-            print n, 'param 0 1'
+def buildSignal(signal):
+    """
+    Build the workspace of a single signal model and write its data card.
+    """
 
-    if not os.path.isdir(os.path.dirname(os.path.realpath(config.outname))):
-        os.makedirs(os.path.dirname(os.path.realpath(config.outname)))
+    bkgNuisances, bkgYields, totalArrays = background
 
-    workspace.writeToFile(config.outname)
+    del nuisances[:]
 
-    print 'Workspace written to', config.outname
+    hstore = ROOT.gROOT.mkdir('hstore_' + signal)
 
-    wsimport = None
-    wssource = ROOT.TFile.Open(config.outname)
-    workspace = wssource.Get('wspace')
+    sourcePlots = {}
+    fetchHistograms(config, sourcePlots, {}, hstore, processes = [signal], fetchData = False)
 
-    x = workspace.var(config.xname)
+    regions = [r for r in config.regions if signal in sourcePlots[r]]
 
-    ## DATACARDS
-    if config.cardname:
-        print 'Writing data cards'
+    setupWorkspace(sourcePlots[regions[0]][signal]['nominal'])
 
-        carddir = os.path.dirname(os.path.realpath(config.cardname))
-        if not os.path.isdir(carddir):
-            os.makedirs(carddir)
+    sourceArrays = makeArrays(sourcePlots)
 
-        # sort samples
+    for region in regions:
+        sample = (signal, region)
+        if linkSource(sample) is not None or isLinkSource(sample):
+            raise RuntimeError('Signal sample {0} has links and cannot be built separately'.format(sample))
 
-        samplesByRegion = {} # names of background samples by region
-        procIds = {}
-        signalRegions = set()
+        buildSample(sample, sourcePlots, sourceArrays, totalArrays)
 
-        maxRegionNameLength = 0
+    signalOutname = config.signalOutname.format(signal = signal)
+    writeWorkspace(signalOutname)
 
-        for region, procPlots in sourcePlots.items():
-            samplesByRegion[region] = []
+    if config.cardname:
+        carddir = os.path.dirname(os.path.realpath(config.cardname))
 
-            # sort processes by expectation
-            def compProc(p, q):
-                if procPlots[p]['nominal'].GetSumOfWeights() > procPlots[q]['nominal'].GetSumOfWeights():
-                    return -1
-                else:
-                    return 1
+        yields = dict((region, dict(procYields)) for region, procYields in bkgYields.items())
+        for region in regions:
+            yields[region][signal] = sourcePlots[region][signal]['nominal'].GetSumOfWeights()
 
-            procs = sorted(procPlots.keys(), compProc)
+        lines, columns, signalRegions = makeCardTemplate(yields, os.path.relpath(os.path.realpath(config.outname), carddir))
+        shapes = ['shapes %s * %s wspace:$PROCESS_$CHANNEL' % (signal, os.path.relpath(os.path.realpath(signalOutname), carddir))]
 
-            for p in procs:
-                if p == 'data_obs':
-                    continue
-                elif p in config.signals:
-                    signalRegions.add(region)
-                else:
-                    samplesByRegion[region].append(p)
-                    if p not in procIds:
-                        procIds[p] = len(procIds) + 1
+        # nuisances shared with the backgrounds are defined in both workspaces
+        writeCard(signal, lines, columns, signalRegions, set(bkgNuisances) | set(nuisances), shapes = shapes)
 
-            if len(region) > maxRegionNameLength:
-                maxRegionNameLength = len(region)
+    return signal
 
-        print 'signalRegions', list(signalRegions)
+if __name__ == '__main__':
 
-        # define datacard template
+    ROOT.RooMsgService.instance().setGlobalKillBelow(ROOT.RooFit.WARNING)
 
-        hrule = '-' * 140
+    hstore = ROOT.gROOT.mkdir('hstore')
 
-        # combine likes to have relative path to the workspace (matters when using combineCards.py)
-        ws_abs_path = os.path.realpath(config.outname)
-        ws_path = os.path.relpath(ws_abs_path, carddir)
+    if config.cardname:
+        carddir = os.path.dirname(os.path.realpath(config.cardname))
+        if not os.path.isdir(carddir):
+            os.makedirs(carddir)
 
-        lines = [
-            'imax * number of bins',
-            'jmax * number of processes minus 1',
-            'kmax * number of nuisance parameters',
-            hrule,
-            'shapes * * %s wspace:$PROCESS_$CHANNEL' % ws_path,
-            hrule,
-        ]
+    if config.signalOutname:
+        ## BACKGROUND WORKSPACE + ONE WORKSPACE PER SIGNAL
+        key = backgroundKey()
 
-        colw = max(maxRegionNameLength + 1, 9)
+        background = loadBackground(key)
+        if background is None:
+            buildBackground(key, hstore)
+            background = loadBackground(key)
+        else:
+            print 'Background workspace', config.outname, 'is up to date'
 
-        # list of regions, signal regions first
-        line = 'bin          ' + ''.join(sorted('%{w}s'.format(w = colw) % r for r in signalRegions)) + ''.join(sorted('%{w}s'.format(w = colw) % r for r in samplesByRegion if r not in signalRegions))
-        lines.append(line)
+        if PRINTNUISANCE:
+            for n in sorted(background[0]):
+                print n, 'param 0 1'
 
-        # number of observed events in each region (set to -1 - combine will read it from workspace)
-        line = 'observation  ' + ''.join('%{w}.1f'.format(w = colw) % o for o in [-1.] * len(samplesByRegion))
-        lines.append(line)
+        print 'Constructing the signal workspaces'
 
-        lines.append(hrule)
+        if config.nproc > 1:
+            pool = multiprocessing.Pool(config.nproc)
+            try:
+                pool.map(buildSignal, config.signals)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for signal in config.signals:
+                buildSignal(signal)
 
-        # columns for all background processes and yields
-        columns = []
+    else:
+        ## INPUT
+        # fetch all source histograms first    
+    
+        sourcePlots = {}
+        totals = {} # {region: background total}
+    
+        fetchHistograms(config, sourcePlots, totals, hstore)
+    
+        ## WORKSPACE
+    
+        setupWorkspace(sourcePlots[config.regions[0]]['data_obs']['nominal'])
+    
+        print 'Constructing the workspace'
+    
+        sourceArrays = makeArrays(sourcePlots)
+        totalArrays = dict((region, binArrays(total)) for region, total in totals.items())
+    
+        # link sources are constructed before their targets
+        for sample in constructionOrder(sourcePlots):
+            buildSample(sample, sourcePlots, sourceArrays, totalArrays)
+    
+        for region in config.regions:
+            # All processes in the region are constructed. Add the observed RooDataHist.
+            dataObsName = 'data_obs_' + region
+            data_obs = ROOT.RooDataHist(dataObsName, dataObsName, ROOT.RooArgList(x), sourcePlots[region]['data_obs']['nominal'])
+            wsimport(data_obs)
+    
+        if PRINTNUISANCE:
+            for n in sorted(nuisances):
+                print n, 'param 0 1'
+    
+        writeWorkspace(config.outname)
 
-        # signal region first
-        for region in signalRegions:
-            for proc in samplesByRegion[region]:
-                columns.append((region, proc, str(procIds[proc])))
+        ## DATACARDS
+        if config.cardname:
+            print 'Writing data cards'
 
-        for region in sorted(samplesByRegion):
-            if region in signalRegions:
-                continue
+            yields = {}
+            for region, procPlots in sourcePlots.items():
+                yields[region] = dict((p, plots['nominal'].GetSumOfWeights()) for p, plots in procPlots.items())
 
-            for proc in samplesByRegion[region]:
-                columns.append((region, proc, str(procIds[proc])))
-
-        # now loop over signal models and write a card per model
-        for signal in config.signals:
-            cardcolumns = list(columns)
-            cardlines = list(lines)
-
-            # insert the signal expectation as the first column
-            ic = 0
-            for region in signalRegions:
-                # skip to the first column of the region
-                while columns[ic][0] != region:
-                    ic += 1
-                
-                cardcolumns.insert(ic, (region, signal, str(-1)))
-
-            for ih, heading in enumerate(['bin', 'process', 'process']):
-                line = '%13s' % heading
-                for column in cardcolumns:
-                    w = max(len(s) for s in column)
-                    line += ('%{width}s'.format(width = w + 1)) % column[ih]
-                cardlines.append(line)
-
-            line = 'rate         '
-            for column in cardcolumns:
-                w = max(len(s) for s in column)
-                line += ('%{width}.1f'.format(width = w + 1)) % 1.
-            cardlines.append(line)
-
-            cardlines.append(hrule)
-
-            for nuisance in sorted(nuisances):
-                # remove nuisances related to other signal models
-                matched_other_signal = False
-                for s in config.signals:
-                    if s != signal and nuisance.startswith(s):
-                        matched_other_signal = True
-                        break
-
-                if matched_other_signal:
-                    continue
-                
-                if nuisance in config.flatParams:
-                    cardlines.append(nuisance + ' flatParam 0 1')
-                else:
-                    cardlines.append(nuisance + ' param 0 1')
+            # combine likes to have relative path to the workspace (matters when using combineCards.py)
+            lines, columns, signalRegions = makeCardTemplate(yields, os.path.relpath(os.path.realpath(config.outname), carddir))
 
-            cardname = config.cardname.format(signal = signal)
+            print 'signalRegions', list(signalRegions)
 
-            with open(cardname, 'w') as datacard:
-                for line in cardlines:
-                    if '{signal}' in line:
-                        line = line.format(signal = signal)
+            # now loop over signal models and write a card per model
+            for signal in config.signals:
+                writeCard(signal, lines, columns, signalRegions, nuisances)
 
-                    datacard.write(line + '\n')
-            
-            print ' ', signal, '-->', cardname
+    wsimport = None
+    wssource = ROOT.TFile.Open(config.outname)
+    workspace = wssource.Get('wspace')
+
+    x = workspace.var(config.xname)
 
     ## PLOTS
     if config.plotsOutname:
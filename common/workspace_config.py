@@ -11,6 +11,8 @@
   (carddir) - When given, data card files are produced and saved in this directory.
   (cardname) - Name of the data card files. Wild card {signal} can be used as a placeholder for signal model name.
   (plotsOutname) - When given, a ROOT file with histograms visualizing the workspace content is created.
+  (signalOutname) - When given, outname contains only data and backgrounds and is rebuilt only when its inputs change. Each signal model is written to a separate workspace file under this name. Wild card {signal} must be used.
+  (nproc) - Number of processes building the signal workspaces and data cards when signalOutname is given.
   (xtitle) - X axis title of the histograms.
   (xunit) - Unit of the X axis variable.
  <physics>
@@ -56,6 +58,8 @@ class WorkspaceConfig(object):
         mandatory('outname')
         optional('cardname')
         optional('plotsOutname')
+        optional('signalOutname')
+        optional('nproc', 1)
         optional('xname', 'x')
         optional('xtitle')
         optional('xunit')
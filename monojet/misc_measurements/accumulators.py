@@ -0,0 +1,322 @@
+"""
+Streaming per-bin statistics of many tree columns in one pass.
+
+The tree is read in blocks of entries (readColumns), and every block updates, for each bin of a binning variable
+and each column, a Moments accumulator (weighted mean and RMS, Welford / Chan updates) and a QuantileSketch
+(compactor hierarchy as in KLL). Memory is bounded by the number of bins and columns and does not grow with the
+number of entries. All accumulators have merge(), so blocks, files, or parallel workers can be combined.
+
+Usage:
+  acc = BinnedAccumulator([100., 150., 200.], ['pdfUp', 'scale00'], limits = {'pdfUp': (-500., 500.)})
+  acc.fillTree(tree, 'dm_pt')
+  acc.moments[0]['pdfUp'].rms()
+  acc.sketches[0]['scale00'].quantiles([0.16, 0.5, 0.84])
+"""
+
+import math
+
+import numpy
+
+try:
+  import root_numpy
+except ImportError:
+  root_numpy = None
+
+def readColumns(tree, exprs, selection = '', step = 1000000):
+  """
+  Iterate over blocks of at most step entries of the tree, yielding a list of arrays (one per expression) of the
+  selected entries. Expressions are branch names or scalar TTreeFormula expressions.
+  """
+
+  nentries = tree.GetEntries()
+
+  for first in range(0, nentries, step):
+    last = min(first + step, nentries)
+
+    if root_numpy is not None:
+      arrays = root_numpy.tree2array(tree, branches = exprs, selection = selection, start = first, stop = last)
+      yield [numpy.asarray(arrays[name], dtype = numpy.float64) for name in arrays.dtype.names]
+      continue
+
+    tree.SetEstimate(last - first + 1)
+
+    columns = []
+    # TTree::Draw returns at most four columns at a time
+    for ie in range(0, len(exprs), 4):
+      chunk = exprs[ie:ie + 4]
+      nrows = tree.Draw(':'.join(chunk), selection, 'goff', last - first, first)
+      for ic in range(len(chunk)):
+        if nrows <= 0:
+          columns.append(numpy.zeros(0))
+          continue
+
+        buf = tree.GetVal(ic)
+        buf.SetSize(nrows)
+        # GetVal buffers are overwritten by the next Draw
+        columns.append(numpy.frombuffer(buf, dtype = numpy.float64, count = nrows).copy())
+
+    yield columns
+
+
+class Moments(object):
+  """
+  Weighted count, mean, and variance of a stream of values. Mean and RMS follow TH1::GetMean and TH1::GetRMS
+  (unbinned, RMS is the standard deviation with sum of weights in the denominator).
+  """
+
+  def __init__(self):
+    self.n = 0
+    self.sumw = 0.
+    self.mean_ = 0.
+    self.m2 = 0.
+    self.min = float('inf')
+    self.max = float('-inf')
+
+  def update(self, values, weights = None):
+    values = numpy.asarray(values, dtype = numpy.float64)
+    if values.shape[0] == 0:
+      return
+
+    if weights is None:
+      sumw = float(values.shape[0])
+      mean = values.mean()
+      m2 = numpy.square(values - mean).sum()
+    else:
+      weights = numpy.asarray(weights, dtype = numpy.float64)
+      sumw = weights.sum()
+      if sumw == 0.:
+        mean = 0.
+        m2 = 0.
+      else:
+        mean = numpy.dot(weights, values) / sumw
+        m2 = numpy.dot(weights, numpy.square(values - mean))
+
+    self._combine(values.shape[0], sumw, mean, m2)
+    self.min = min(self.min, values.min())
+    self.max = max(self.max, values.max())
+
+  def merge(self, other):
+    self._combine(other.n, other.sumw, other.mean_, other.m2)
+    self.min = min(self.min, other.min)
+    self.max = max(self.max, other.max)
+
+  def _combine(self, n, sumw, mean, m2):
+    total = self.sumw + sumw
+    if total == 0.:
+      # only possible with weights summing to zero; keep the plain sums
+      self.n += n
+      self.sumw = total
+      self.m2 += m2
+      return
+
+    delta = mean - self.mean_
+    self.mean_ += delta * sumw / total
+    self.m2 += m2 + delta * delta * self.sumw * sumw / total
+    self.sumw = total
+    self.n += n
+
+  def mean(self):
+    return self.mean_
+
+  def sum(self):
+    return self.mean_ * self.sumw
+
+  def variance(self):
+    if self.sumw == 0.:
+      return 0.
+
+    return max(0., self.m2 / self.sumw)
+
+  def rms(self):
+    return math.sqrt(self.variance())
+
+
+class QuantileSketch(object):
+  """
+  Mergeable approximate quantiles with bounded memory. Level h holds values standing for 2^h entries each; a level
+  holding more than capacity values is sorted and every other value (random offset) moves to level h + 1. The rank
+  error is of order log2(n / capacity) / capacity, and at most capacity + 1 values are kept per level.
+  """
+
+  def __init__(self, capacity = 1000, seed = 12345):
+    self.capacity = capacity
+    self.n = 0
+    self.levels = [numpy.zeros(0)]
+    self._random = numpy.random.RandomState(seed)
+
+  def update(self, values):
+    values = numpy.asarray(values, dtype = numpy.float64).ravel()
+    if values.shape[0] == 0:
+      return
+
+    self.n += values.shape[0]
+    self.levels[0] = numpy.concatenate((self.levels[0], values))
+    self._compact()
+
+  def merge(self, other):
+    self.n += other.n
+    for level, values in enumerate(other.levels):
+      if level == len(self.levels):
+        self.levels.append(numpy.zeros(0))
+
+      self.levels[level] = numpy.concatenate((self.levels[level], values))
+
+    self._compact()
+
+  def _compact(self):
+    level = 0
+    while level < len(self.levels):
+      values = self.levels[level]
+      if values.shape[0] > self.capacity:
+        values = numpy.sort(values)
+        # an odd value out stays at this level
+        if values.shape[0] % 2 == 1:
+          self.levels[level] = values[-1:]
+          values = values[:-1]
+        else:
+          self.levels[level] = numpy.zeros(0)
+
+        if level + 1 == len(self.levels):
+          self.levels.append(numpy.zeros(0))
+
+        promoted = values[self._random.randint(2)::2]
+        self.levels[level + 1] = numpy.concatenate((self.levels[level + 1], promoted))
+
+      level += 1
+
+  def quantiles(self, probs):
+    """
+    Approximate values at the cumulative probabilities probs. NaN if the sketch is empty.
+    """
+
+    if self.n == 0:
+      return [float('nan')] * len(probs)
+
+    values = numpy.concatenate(self.levels)
+    weights = numpy.concatenate([numpy.full(v.shape[0], 2. ** level) for level, v in enumerate(self.levels)])
+
+    order = numpy.argsort(values, kind = 'mergesort')
+    values = values[order]
+    cumulative = numpy.cumsum(weights[order])
+
+    indices = numpy.searchsorted(cumulative, numpy.asarray(probs, dtype = numpy.float64) * cumulative[-1], side = 'left')
+    indices = numpy.minimum(indices, values.shape[0] - 1)
+
+    return [float(values[i]) for i in indices]
+
+  def quantile(self, prob):
+    return self.quantiles([prob])[0]
+
+  def size(self):
+    return sum(v.shape[0] for v in self.levels)
+
+
+class BinnedAccumulator(object):
+  """
+  Moments (and optionally quantile sketches) of several columns in bins [low, high) of one variable.
+  moments[ibin][column] and sketches[ibin][column] are the accumulators, sumw[ibin] the sum of weights of the
+  entries in the bin, with the underflow and overflow at sumw[-2] and sumw[-1].
+  Limits {column: (low, high)} drop column values outside [low, high) from that column only, like the axis range of
+  a histogram the column would otherwise be drawn into.
+  """
+
+  def __init__(self, edges, columns, limits = {}, quantiles = True, capacity = 1000):
+    self.edges = numpy.asarray(edges, dtype = numpy.float64)
+    self.columns = list(columns)
+    self.limits = dict(limits)
+
+    nbins = self.edges.shape[0] - 1
+
+    self.sumw = numpy.zeros(nbins + 2)
+    self.moments = [dict((column, Moments()) for column in self.columns) for _ in range(nbins)]
+    if quantiles:
+      self.sketches = [dict((column, QuantileSketch(capacity)) for column in self.columns) for _ in range(nbins)]
+    else:
+      self.sketches = None
+
+  def nbins(self):
+    return self.edges.shape[0] - 1
+
+  def fill(self, x, values, weights = None):
+    """
+    Add a block of entries. values is {column: array} with arrays of the same length as x.
+    """
+
+    x = numpy.asarray(x, dtype = numpy.float64)
+    if weights is not None:
+      weights = numpy.asarray(weights, dtype = numpy.float64)
+
+    nbins = self.nbins()
+
+    # -1 and nbins are under- and overflow
+    ibins = numpy.searchsorted(self.edges, x, side = 'right') - 1
+    ibins = numpy.where(ibins >= nbins, nbins, ibins)
+
+    if weights is None:
+      counts = numpy.bincount(ibins + 1, minlength = nbins + 2)
+    else:
+      counts = numpy.bincount(ibins + 1, weights = weights, minlength = nbins + 2)
+
+    # sumw is ordered [bins..., underflow, overflow]
+    self.sumw[:nbins] += counts[1:nbins + 1]
+    self.sumw[-2] += counts[0]
+    self.sumw[-1] += counts[nbins + 1]
+
+    for ibin in range(nbins):
+      inBin = (ibins == ibin)
+      if not inBin.any():
+        continue
+
+      for column in self.columns:
+        v = numpy.asarray(values[column], dtype = numpy.float64)[inBin]
+        if weights is None:
+          w = None
+        else:
+          w = weights[inBin]
+
+        if column in self.limits:
+          low, high = self.limits[column]
+          inRange = (v >= low) & (v < high)
+          v = v[inRange]
+          if w is not None:
+            w = w[inRange]
+
+        self.moments[ibin][column].update(v, w)
+        if self.sketches is not None:
+          self.sketches[ibin][column].update(v)
+
+  def fillTree(self, tree, xexpr, weight = '', selection = '', step = 1000000, extra = [], callback = None):
+    """
+    Fill from the tree in one pass, binning in xexpr. Columns are tree expressions. For each block,
+    callback({expression: array}) is called with the columns, xexpr, weight, and the extra expressions, so that
+    the caller can fill other quantities from the same read.
+    """
+
+    exprs = []
+    for expr in [xexpr] + self.columns + [weight] + list(extra):
+      if expr and expr not in exprs:
+        exprs.append(expr)
+
+    for block in readColumns(tree, exprs, selection = selection, step = step):
+      arrays = dict(zip(exprs, block))
+
+      if weight:
+        weights = arrays[weight]
+      else:
+        weights = None
+
+      self.fill(arrays[xexpr], arrays, weights)
+
+      if callback is not None:
+        callback(arrays)
+
+  def merge(self, other):
+    if not numpy.array_equal(self.edges, other.edges) or self.columns != other.columns:
+      raise RuntimeError('Cannot merge accumulators with different bins or columns')
+
+    self.sumw += other.sumw
+    for ibin in range(self.nbins()):
+      for column in self.columns:
+        self.moments[ibin][column].merge(other.moments[ibin][column])
+        if self.sketches is not None and other.sketches is not None:
+          self.sketches[ibin][column].merge(other.sketches[ibin][column])
@@ -4,6 +4,9 @@ from array import array
 from tdrStyle import *
 from gjets import *
 from pretty import plot_cms
+from accumulators import readColumns
+import math
+import numpy
 setTDRStyle()
 
 def makevariations():
@@ -36,12 +39,26 @@ def makevariations():
   nlo_file = TFile("eos/cms/store/user/zdemirag/privateGen/A_13TeV_v2.root","READ");
   h_nlo    = TH1F("h_nlo", "h_nlo", bin, low, high)
   h_nlo.Sumw2()
-  h_int    = TH1F("h_int", "h_int", bin, -5000, 5000)
   nlo_tree = nlo_file.Get("Events")
-  nlo_tree.Draw("dm_pt>>h_int","effweight","goff")
-  total = h_int.Integral()
+
+  # normalization and NLO spectrum in one pass over the NLO tree
+  edges = numpy.linspace(low, high, bin + 1)
+  total = 0.
+  sumw = numpy.zeros(bin)
+  sumw2 = numpy.zeros(bin)
+
+  for pt, effweight, mcweight, eta in readColumns(nlo_tree, ["dm_pt", "effweight", "mcweight", "dm_eta"]):
+    total += effweight[(pt >= -5000) & (pt < 5000)].sum()
+    # numpy.histogram closes the last bin; TH1 bins are [low, high)
+    w = effweight*mcweight*(numpy.abs(eta) < 1.5)*(pt < high)
+    sumw += numpy.histogram(pt, bins = edges, weights = w)[0]
+    sumw2 += numpy.histogram(pt, bins = edges, weights = w*w)[0]
+
   print total
-  nlo_tree.Draw("dm_pt >> h_nlo","effweight*mcweight*(abs(dm_eta) < 1.5)","goff")
+  for b in range(bin):
+    h_nlo.SetBinContent(b+1, sumw[b])
+    h_nlo.SetBinError(b+1, math.sqrt(sumw2[b]))
+
   h_nlo.Scale(1./total)
   h_nlo.SetLineColor(2)
   h_lo.SetLineColor(4)
@@ -6,6 +6,9 @@ channel_list  = ['signal']
 #channel_list  = ['Wen','Zee']
 #channel_list  = ['gjets']
 
+# Number of physics process files read in parallel
+nproc = 4
+
 # This is where the plots are output
 folder = '/afs/cern.ch/user/d/dabercro/www/monoV_160126'
 
@@ -1,6 +1,8 @@
 #! /usr/bin/python
 import sys, os, string, re, time, datetime
-from multiprocessing import Process
+import tempfile
+import shutil
+from multiprocessing import Pool
 from array import *
 
 from config import *
@@ -30,6 +32,13 @@ setTDRStyle()
 
 gROOT.LoadMacro("functions.C+");
 
+commondir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.realpath(__file__)))) + '/common'
+gROOT.LoadMacro(commondir + '/MultiDraw.cc+')
+
+# piecewise weight strings are evaluated as binned lookups
+sys.path.append(commondir)
+from lookupweights import convert
+
 metcut = 200.
 
 print "Starting Plotting Be Patient!"
@@ -37,7 +46,169 @@ print "Starting Plotting Be Patient!"
 lumi = 2109.
 lumi_str = 2.1
 
-def plot_stack(channel, name,var, bin, low, high, ylabel, xlabel, setLog = False):
+#Incase you want to apply event by event re-weighting
+w = convert("((0.0*(npv>-0.5&&npv<=0.5)+3.30418257204*(npv>0.5&&npv<=1.5)+2.59691269521*(npv>1.5&&npv<=2.5)+2.44251087681*(npv>2.5&&npv<=3.5)+2.42846225153*(npv>3.5&&npv<=4.5)+2.40062512591*(npv>4.5&&npv<=5.5)+2.30279811595*(npv>5.5&&npv<=6.5)+2.12054720297*(npv>6.5&&npv<=7.5)+1.9104708827*(npv>7.5&&npv<=8.5)+1.67904936047*(npv>8.5&&npv<=9.5)+1.43348925382*(npv>9.5&&npv<=10.5)+1.17893952713*(npv>10.5&&npv<=11.5)+0.940505177881*(npv>11.5&&npv<=12.5)+0.740901867872*(npv>12.5&&npv<=13.5)+0.56877478036*(npv>13.5&&npv<=14.5)+0.433148655714*(npv>14.5&&npv<=15.5)+0.325343558476*(npv>15.5&&npv<=16.5)+0.241688459349*(npv>16.5&&npv<=17.5)+0.180491032782*(npv>17.5&&npv<=18.5)+0.136993937378*(npv>18.5&&npv<=19.5)+0.104859480066*(npv>19.5&&npv<=20.5)+0.0768271030309*(npv>20.5&&npv<=21.5)+0.0563426184938*(npv>21.5&&npv<=22.5)+0.0454037058117*(npv>22.5&&npv<=23.5)+0.0359945616383*(npv>23.5&&npv<=24.5)+0.0286879205085*(npv>24.5&&npv<=25.5)+0.0208185595478*(npv>25.5&&npv<=26.5)+0.0170977379612*(npv>26.5&&npv<=27.5)+0.0122446391898*(npv>27.5&&npv<=28.5)+0.0148028308301*(npv>28.5&&npv<=29.5)+0.0120527550003*(npv>29.5&&npv<=30.5)+0.00402643194054*(npv>30.5&&npv<=31.5)+0.00981143754301*(npv>31.5&&npv<=32.5)+0.0*(npv>32.5&&npv<=33.5)+0.0155664899019*(npv>33.5&&npv<=34.5)+0.0*(npv>34.5&&npv<=35.5)+0.0*(npv>35.5&&npv<=36.5)+0.0*(npv>36.5&&npv<=37.5)+0.0*(npv>37.5&&npv<=38.5)+0.0*(npv>38.5&&npv<=39.5)))")
+
+anlo1_over_alo = convert("(1.24087232993*(genBos_pt>100.0&&genBos_pt<=150.0)+1.55807026252*(genBos_pt>150.0&&genBos_pt<=200.0)+1.51043242876*(genBos_pt>200.0&&genBos_pt<=250.0)+1.47333461572*(genBos_pt>250.0&&genBos_pt<=300.0)+1.43497331471*(genBos_pt>300.0&&genBos_pt<=350.0)+1.37846354687*(genBos_pt>350.0&&genBos_pt<=400.0)+1.2920177717*(genBos_pt>400.0&&genBos_pt<=500.0)+1.31414429236*(genBos_pt>500.0&&genBos_pt<=600.0)+1.20453974747*(genBos_pt>600.0))")
+a_ewkcorr = convert("(0.998568444581*(genBos_pt>100.0&&genBos_pt<=150.0)+0.992098286517*(genBos_pt>150.0&&genBos_pt<=200.0)+0.986010290609*(genBos_pt>200.0&&genBos_pt<=250.0)+0.980265498435*(genBos_pt>250.0&&genBos_pt<=300.0)+0.974830448283*(genBos_pt>300.0&&genBos_pt<=350.0)+0.969676202351*(genBos_pt>350.0&&genBos_pt<=400.0)+0.962417128177*(genBos_pt>400.0&&genBos_pt<=500.0)+0.953511139209*(genBos_pt>500.0&&genBos_pt<=600.0)+0.934331895615*(genBos_pt>600.0))")
+
+w_ewkcorr = convert("(0.980859240872*(genBos_pt>100.0&&genBos_pt<=150.0)+0.962118764182*(genBos_pt>150.0&&genBos_pt<=200.0)+0.944428528597*(genBos_pt>200.0&&genBos_pt<=250.0)+0.927685912907*(genBos_pt>250.0&&genBos_pt<=300.0)+0.911802238928*(genBos_pt>300.0&&genBos_pt<=350.0)+0.896700388113*(genBos_pt>350.0&&genBos_pt<=400.0)+0.875368225896*(genBos_pt>400.0&&genBos_pt<=500.0)+0.849096933047*(genBos_pt>500.0&&genBos_pt<=600.0)+0.792158791839*(genBos_pt>600.0))")
+wnlo012_over_wlo = convert("(1.89123123702*(genBos_pt>100.0&&genBos_pt<=150.0)+1.70414182145*(genBos_pt>150.0&&genBos_pt<=200.0)+1.60726459197*(genBos_pt>200.0&&genBos_pt<=250.0)+1.57205818769*(genBos_pt>250.0&&genBos_pt<=300.0)+1.51688539716*(genBos_pt>300.0&&genBos_pt<=350.0)+1.41090079307*(genBos_pt>350.0&&genBos_pt<=400.0)+1.30757555038*(genBos_pt>400.0&&genBos_pt<=500.0)+1.32046236765*(genBos_pt>500.0&&genBos_pt<=600.0)+1.26852513234*(genBos_pt>600.0))")
+
+z_ewkcorr = convert("(0.984525344338*(genBos_pt>100.0&&genBos_pt<=150.0)+0.969078612189*(genBos_pt>150.0&&genBos_pt<=200.0)+0.954626582726*(genBos_pt>200.0&&genBos_pt<=250.0)+0.941059330021*(genBos_pt>250.0&&genBos_pt<=300.0)+0.92828367065*(genBos_pt>300.0&&genBos_pt<=350.0)+0.916219976557*(genBos_pt>350.0&&genBos_pt<=400.0)+0.89931198024*(genBos_pt>400.0&&genBos_pt<=500.0)+0.878692669663*(genBos_pt>500.0&&genBos_pt<=600.0)+0.834717745177*(genBos_pt>600.0))")
+znlo012_over_zlo = convert("(1.68500099066*(genBos_pt>100.0&&genBos_pt<=150.0)+1.55256109189*(genBos_pt>150.0&&genBos_pt<=200.0)+1.52259467479*(genBos_pt>200.0&&genBos_pt<=250.0)+1.52062313572*(genBos_pt>250.0&&genBos_pt<=300.0)+1.4322825541*(genBos_pt>300.0&&genBos_pt<=350.0)+1.45741443405*(genBos_pt>350.0&&genBos_pt<=400.0)+1.36849777989*(genBos_pt>400.0&&genBos_pt<=500.0)+1.3580214432*(genBos_pt>500.0&&genBos_pt<=600.0)+1.16484769869*(genBos_pt>600.0))")
+
+met_trig = convert('((met < 250)*0.97 + (met >=250 && met<350)* 0.987 + (met>=350)* 1.0 )')
+
+#SF explicitly written for the leading tight lepton from the root files
+lep_sf = convert("(0.98 *(lep1Eta<2.1)+0.91*(lep1Eta>=2.1))")
+
+wm_postfit = "(1.0)"
+zm_postfit = "(1.0)"
+g_postfit  = "(1.0)"
+
+# processes not added to the background stack
+not_stacked = ['data', 'signal_dm', 'signal_dm_s', 'signal_dm_ps', 'signal_dm_v', 'signal_dm_av_1_2']
+
+def trigger_weight(channel):
+    if channel == 'signal' or channel == 'Zmm' or channel == 'Wmn':
+        return met_trig
+    else:
+        return '(1.0)'
+
+def fill_expressions(Type, channel):
+    """
+    Selection and weight expressions of the process in the channel, or None if the process is not filled.
+    mcWeight is read as the weight branch of the MC processes.
+    """
+
+    cut_standard = build_selection(channel,metcut)
+    w_trig = trigger_weight(channel)
+
+    if Type == 'data':
+        if channel == 'signal' or channel == 'Zmm' or channel == 'Wmn':
+            return "(" + cut_standard + " && (triggerFired[0]==1 || triggerFired[1]==1 || triggerFired[2]==1) )", ''
+        else:
+            return "(" + cut_standard + " )", ''
+
+    if Type.startswith('signal_h_ggf') or Type.startswith('signal_dm_av_1_2'):
+        return cut_standard, w
+
+    if Type in not_stacked:
+        return None
+
+    if Type.startswith('GJets'):
+        weight = "0.98*"+g_postfit+"*"+anlo1_over_alo+"*"+a_ewkcorr+"*"+w+"*"+w_trig
+    elif Type.startswith('Zvv') or Type.startswith('Zll'):
+        weight = zm_postfit+"*"+z_ewkcorr+"*"+znlo012_over_zlo+"*"+w+"*"+w_trig
+        if channel != 'signal':
+            weight = lep_sf+"*"+weight
+    elif Type.startswith('Wlv'):
+        weight = wm_postfit+"*"+wnlo012_over_wlo+"*"+w_ewkcorr+"*"+w+"*"+w_trig
+    else:
+        weight = w+"*"+w_trig
+
+    return cut_standard, weight
+
+def book_hist(histName, var, bin, low, high):
+    if var == 'met':
+        binLowE = [200,250,300,350,400,500,600,1000]
+        hist = TH1F(histName,histName,len(binLowE)-1,array('d',binLowE))
+    else:
+        hist = TH1F(histName, histName, bin, low, high)
+
+    hist.Sumw2()
+    return hist
+
+def fill_process(job):
+    """
+    Fill the histograms of every (channel, variable) of one physics process in a single pass over its files.
+    Returns (process, path of the file holding the histograms, normalization).
+    """
+
+    Type, outPath = job
+
+    # this right now breaks the tchain logic! 
+    # if we have more than 1 file, this will break!!!!  
+    if Type != 'data':
+        source = ROOT.TFile(physics_processes[Type]['files'][0],"read")
+        total = source.Get("htotal").GetBinContent(1)
+        source.Close()
+    else:
+        total = 1.0
+
+    drawer = ROOT.MultiDraw('events')
+    for path in physics_processes[Type]['files']:
+        drawer.addInputPath(path)
+
+    if Type == 'data':
+        drawer.setWeightBranch('')
+    else:
+        drawer.setWeightBranch('mcWeight')
+
+    hists = []
+    for channel in channel_list:
+        expressions = fill_expressions(Type, channel)
+        if expressions is None:
+            continue
+
+        cut, weight = expressions
+        for varName in variable_list:
+            name, var, bin, low, high = arguments[varName][:5]
+            hist = book_hist(Type+'_'+name+'_'+channel, var, bin, low, high)
+            hist.SetDirectory(0)
+            drawer.addPlot(hist, var, cut, False, False, weight)
+            hists.append(hist)
+
+            if Type.startswith('signal_h_ggf'):
+                # the background total (and the ratio) includes this process with the trigger weight; see plot_stack
+                hist = book_hist(Type+'_'+name+'_'+channel+'_stacked', var, bin, low, high)
+                hist.SetDirectory(0)
+                drawer.addPlot(hist, var, cut, False, False, weight+"*"+trigger_weight(channel))
+                hists.append(hist)
+
+    print 'INFO filling', len(hists), 'histograms of', Type
+    drawer.fillPlots()
+
+    outFile = ROOT.TFile(outPath, 'recreate')
+    for hist in hists:
+        outFile.WriteTObject(hist)
+    outFile.Close()
+
+    return Type, outPath, total
+
+def fill_all(nproc = 1):
+    """
+    Fill all processes, nproc files at a time. Returns ({histogram name: histogram}, {process: normalization}).
+    """
+
+    tmpDir = tempfile.mkdtemp()
+    jobs = [(Type, tmpDir+'/'+Type+'.root') for Type in ordered_physics_processes]
+
+    if nproc > 1:
+        pool = Pool(nproc)
+        results = pool.map(fill_process, jobs)
+        pool.close()
+        pool.join()
+    else:
+        results = map(fill_process, jobs)
+
+    filled = {}
+    totals = {}
+    for Type, outPath, total in results:
+        totals[Type] = total
+        source = ROOT.TFile(outPath)
+        for key in source.GetListOfKeys():
+            hist = key.ReadObj()
+            hist.SetDirectory(0)
+            filled[hist.GetName()] = hist
+        source.Close()
+
+    shutil.rmtree(tmpDir)
+
+    return filled, totals
+
+def plot_stack(channel, name,var, bin, low, high, ylabel, xlabel, setLog = False, filled = {}, totals = {}):
 
     yield_dic = {}
 
@@ -49,8 +220,6 @@ def plot_stack(channel, name,var, bin, low, high, ylabel, xlabel, setLog = False
     else:
         added = TH1D('added', 'added',bin,low,high)
     added.Sumw2()
-    f  = {}
-    h1 = {}
 
     Variables = {}
     cut_standard= build_selection(channel,metcut)
@@ -73,113 +242,48 @@ def plot_stack(channel, name,var, bin, low, high, ylabel, xlabel, setLog = False
         yield_dic[physics_processes[Type]['datacard']] = 0
  
     for Type in reordered_physics_processes:
-        # Create the Histograms
         histName = Type+'_'+name+'_'+channel
 
-        if var is 'met':
-            #binLowE = [200,250,300,350,400,500,600,900,1500]
-            binLowE = [200,250,300,350,400,500,600,1000]
-#            binLowE = [250,300,350,400,500,600,1000]
-            Variables[Type] = TH1F(histName,histName,len(binLowE)-1,array('d',binLowE))
-        else:
-            Variables[Type] = TH1F(histName, histName, bin, low, high)
-
-        Variables[Type].Sumw2()
-        #print "\n"
-
-        # this right now breaks the tchain logic! 
-        # if we have more than 1 file, this will break!!!!  
-
-        if Type is not 'data':
-            f[Type] = ROOT.TFile(physics_processes[Type]['files'][0],"read")
-            h1[Type] = f[Type].Get("htotal")
-            total = h1[Type].GetBinContent(1)
-            #total = h1[Type].GetEntries()
-            f[Type].Close()
+        if histName in filled:
+            Variables[Type] = filled[histName]
         else:
-            total = 1.0
-
-        input_tree   = makeTrees(Type,"events",channel)
-        n_entries = input_tree.GetEntries()
-
-        #Incase you want to apply event by event re-weighting
+            # process not filled in this channel
+            Variables[Type] = book_hist(histName, var, bin, low, high)
 
-        w = "((0.0*(npv>-0.5&&npv<=0.5)+3.30418257204*(npv>0.5&&npv<=1.5)+2.59691269521*(npv>1.5&&npv<=2.5)+2.44251087681*(npv>2.5&&npv<=3.5)+2.42846225153*(npv>3.5&&npv<=4.5)+2.40062512591*(npv>4.5&&npv<=5.5)+2.30279811595*(npv>5.5&&npv<=6.5)+2.12054720297*(npv>6.5&&npv<=7.5)+1.9104708827*(npv>7.5&&npv<=8.5)+1.67904936047*(npv>8.5&&npv<=9.5)+1.43348925382*(npv>9.5&&npv<=10.5)+1.17893952713*(npv>10.5&&npv<=11.5)+0.940505177881*(npv>11.5&&npv<=12.5)+0.740901867872*(npv>12.5&&npv<=13.5)+0.56877478036*(npv>13.5&&npv<=14.5)+0.433148655714*(npv>14.5&&npv<=15.5)+0.325343558476*(npv>15.5&&npv<=16.5)+0.241688459349*(npv>16.5&&npv<=17.5)+0.180491032782*(npv>17.5&&npv<=18.5)+0.136993937378*(npv>18.5&&npv<=19.5)+0.104859480066*(npv>19.5&&npv<=20.5)+0.0768271030309*(npv>20.5&&npv<=21.5)+0.0563426184938*(npv>21.5&&npv<=22.5)+0.0454037058117*(npv>22.5&&npv<=23.5)+0.0359945616383*(npv>23.5&&npv<=24.5)+0.0286879205085*(npv>24.5&&npv<=25.5)+0.0208185595478*(npv>25.5&&npv<=26.5)+0.0170977379612*(npv>26.5&&npv<=27.5)+0.0122446391898*(npv>27.5&&npv<=28.5)+0.0148028308301*(npv>28.5&&npv<=29.5)+0.0120527550003*(npv>29.5&&npv<=30.5)+0.00402643194054*(npv>30.5&&npv<=31.5)+0.00981143754301*(npv>31.5&&npv<=32.5)+0.0*(npv>32.5&&npv<=33.5)+0.0155664899019*(npv>33.5&&npv<=34.5)+0.0*(npv>34.5&&npv<=35.5)+0.0*(npv>35.5&&npv<=36.5)+0.0*(npv>36.5&&npv<=37.5)+0.0*(npv>37.5&&npv<=38.5)+0.0*(npv>38.5&&npv<=39.5)))"
-
-        if channel is 'signal' or channel is 'Zmm' or channel is 'Wmn':
-            w_trig = '((met < 250)*0.97 + (met >=250 && met<350)* 0.987 + (met>=350)* 1.0 )'
-        else:
-            w_trig = '(1.0)'
-            
-        anlo1_over_alo = "(1.24087232993*(genBos_pt>100.0&&genBos_pt<=150.0)+1.55807026252*(genBos_pt>150.0&&genBos_pt<=200.0)+1.51043242876*(genBos_pt>200.0&&genBos_pt<=250.0)+1.47333461572*(genBos_pt>250.0&&genBos_pt<=300.0)+1.43497331471*(genBos_pt>300.0&&genBos_pt<=350.0)+1.37846354687*(genBos_pt>350.0&&genBos_pt<=400.0)+1.2920177717*(genBos_pt>400.0&&genBos_pt<=500.0)+1.31414429236*(genBos_pt>500.0&&genBos_pt<=600.0)+1.20453974747*(genBos_pt>600.0))"
-        a_ewkcorr = "(0.998568444581*(genBos_pt>100.0&&genBos_pt<=150.0)+0.992098286517*(genBos_pt>150.0&&genBos_pt<=200.0)+0.986010290609*(genBos_pt>200.0&&genBos_pt<=250.0)+0.980265498435*(genBos_pt>250.0&&genBos_pt<=300.0)+0.974830448283*(genBos_pt>300.0&&genBos_pt<=350.0)+0.969676202351*(genBos_pt>350.0&&genBos_pt<=400.0)+0.962417128177*(genBos_pt>400.0&&genBos_pt<=500.0)+0.953511139209*(genBos_pt>500.0&&genBos_pt<=600.0)+0.934331895615*(genBos_pt>600.0))"
-
-        w_ewkcorr = "(0.980859240872*(genBos_pt>100.0&&genBos_pt<=150.0)+0.962118764182*(genBos_pt>150.0&&genBos_pt<=200.0)+0.944428528597*(genBos_pt>200.0&&genBos_pt<=250.0)+0.927685912907*(genBos_pt>250.0&&genBos_pt<=300.0)+0.911802238928*(genBos_pt>300.0&&genBos_pt<=350.0)+0.896700388113*(genBos_pt>350.0&&genBos_pt<=400.0)+0.875368225896*(genBos_pt>400.0&&genBos_pt<=500.0)+0.849096933047*(genBos_pt>500.0&&genBos_pt<=600.0)+0.792158791839*(genBos_pt>600.0))"
-        wnlo012_over_wlo = "(1.89123123702*(genBos_pt>100.0&&genBos_pt<=150.0)+1.70414182145*(genBos_pt>150.0&&genBos_pt<=200.0)+1.60726459197*(genBos_pt>200.0&&genBos_pt<=250.0)+1.57205818769*(genBos_pt>250.0&&genBos_pt<=300.0)+1.51688539716*(genBos_pt>300.0&&genBos_pt<=350.0)+1.41090079307*(genBos_pt>350.0&&genBos_pt<=400.0)+1.30757555038*(genBos_pt>400.0&&genBos_pt<=500.0)+1.32046236765*(genBos_pt>500.0&&genBos_pt<=600.0)+1.26852513234*(genBos_pt>600.0))"
-
-        z_ewkcorr = "(0.984525344338*(genBos_pt>100.0&&genBos_pt<=150.0)+0.969078612189*(genBos_pt>150.0&&genBos_pt<=200.0)+0.954626582726*(genBos_pt>200.0&&genBos_pt<=250.0)+0.941059330021*(genBos_pt>250.0&&genBos_pt<=300.0)+0.92828367065*(genBos_pt>300.0&&genBos_pt<=350.0)+0.916219976557*(genBos_pt>350.0&&genBos_pt<=400.0)+0.89931198024*(genBos_pt>400.0&&genBos_pt<=500.0)+0.878692669663*(genBos_pt>500.0&&genBos_pt<=600.0)+0.834717745177*(genBos_pt>600.0))"
-        znlo012_over_zlo = "(1.68500099066*(genBos_pt>100.0&&genBos_pt<=150.0)+1.55256109189*(genBos_pt>150.0&&genBos_pt<=200.0)+1.52259467479*(genBos_pt>200.0&&genBos_pt<=250.0)+1.52062313572*(genBos_pt>250.0&&genBos_pt<=300.0)+1.4322825541*(genBos_pt>300.0&&genBos_pt<=350.0)+1.45741443405*(genBos_pt>350.0&&genBos_pt<=400.0)+1.36849777989*(genBos_pt>400.0&&genBos_pt<=500.0)+1.3580214432*(genBos_pt>500.0&&genBos_pt<=600.0)+1.16484769869*(genBos_pt>600.0))"
-        
-        wm_postfit = "(1.0)"
-        zm_postfit = "(1.0)"
-        g_postfit  = "(1.0)"
-            
         # this is the scale using the total number of effective events
-        scale = 1.0;
-        scale = float(lumi)*physics_processes[Type]['xsec']/total
-        
-        #print '\n'
-#        print "type: ", Type,  "scale", scale, "lumi", lumi, physics_processes[Type]['xsec'], total
+        scale = float(lumi)*physics_processes[Type]['xsec']/totals[Type]
 
-        if Type is not 'data' and Type is not 'signal_dm' and Type is not 'signal_dm_s' and Type is not 'signal_dm_ps' and Type is not 'signal_dm_v' and Type is not 'signal_dm_av_1_2':
+        if Type not in not_stacked:
             Variables[Type].SetFillColor(physics_processes[Type]['color'])
             Variables[Type].SetLineColor(physics_processes[Type]['color'])
+            Variables[Type].Scale(scale,"width")
+            stack.Add(Variables[Type],"hist")
 
-            if Type.startswith('GJets') :
-                makeTrees(Type,'events',channel).Draw(var + " >> " + histName,"(" + cut_standard + ")*mcWeight*0.98*"+str(g_postfit)+"*"+str(anlo1_over_alo)+"*"+str(a_ewkcorr)+"*" +str(w)+"*"+str(w_trig),"goff")
-
-            elif (Type.startswith('Zvv') or Type.startswith('Zll')) :
-                if channel is 'signal' :
-                    makeTrees(Type,'events',channel).Draw(var + " >> " + histName,"(" + cut_standard + ")*mcWeight*"+str(zm_postfit)+"*"+str(z_ewkcorr)+"*"+str(znlo012_over_zlo)+"*"+str(w)+"*"+str(w_trig),"goff")
+            if Type.startswith('signal_h_ggf'):
+                # signal_h_ggf used to be drawn with w*w_trig, stacked and added, then redrawn with w into the same
+                # histogram: the stack and the yield show the w fill, the total the w*w_trig fill
+                if histName+'_stacked' in filled:
+                    stacked = filled[histName+'_stacked']
                 else:
-                    #SF explicitly written for the leading tight lepton from the root files
-                    makeTrees(Type,'events',channel).Draw(var + " >> " + histName,"(" + cut_standard + ")*mcWeight*(0.98 *(lep1Eta<2.1)+0.91*(lep1Eta>=2.1))*"+str(zm_postfit)+"*"+str(z_ewkcorr)+"*"+str(znlo012_over_zlo)+"*"+str(w)+"*"+str(w_trig),"goff")
-
-
-            elif Type.startswith('Wlv'):
-                if channel is 'signal' :
-                    makeTrees(Type,'events',channel).Draw(var + " >> " + histName,"(" + cut_standard + ")*mcWeight*"+str(wm_postfit)+"*"+str(wnlo012_over_wlo)+"*"+str(w_ewkcorr)+"*" +str(w)+"*"+str(w_trig),"goff")
-                else:                
-                    makeTrees(Type,'events',channel).Draw(var + " >> " + histName,"(" + cut_standard + ")*mcWeight*"+str(wm_postfit)+"*"+str(wnlo012_over_wlo)+"*"+str(w_ewkcorr)+"*" +str(w)+"*"+str(w_trig),"goff")
-            
+                    stacked = book_hist(histName+'_stacked', var, bin, low, high)
+                stacked.Scale(scale,"width")
+                added.Add(stacked)
             else:
-                makeTrees(Type,'events',channel).Draw(var + " >> " + histName,"(" + cut_standard + ") *mcWeight*" +str(w)+"*"+str(w_trig),"goff")
-                
-
-            Variables[Type].Scale(scale,"width")
-            stack.Add(Variables[Type],"hist")
-            added.Add(Variables[Type])
+                added.Add(Variables[Type])
 
         if Type.startswith('signal_h_ggf'):
             Variables[Type].SetLineColor(1)
             Variables[Type].SetLineWidth(3)
             Variables[Type].SetLineStyle(1)
-            makeTrees(Type,"events",channel).Draw(var + " >> " + histName,"(" + cut_standard + ")*mcWeight*"+str(w),"goff")
-            Variables[Type].Scale(scale,"width")
 
         if Type.startswith('signal_dm_av_1_2'):
             Variables[Type].SetLineColor(1)
             Variables[Type].SetLineWidth(3)
             Variables[Type].SetLineStyle(8)
-            makeTrees(Type,"events",channel).Draw(var + " >> " + histName,"(" + cut_standard + ")*mcWeight*"+str(w),"goff")
             Variables[Type].Scale(scale,"width")
             
         if Type.startswith('data'):
             Variables[Type].SetMarkerStyle(20)
-            if channel is 'signal' or channel is 'Zmm' or channel is 'Wmn':
-                makeTrees(Type,"events",channel).Draw(var + " >> " + histName, "(" + cut_standard + " && (triggerFired[0]==1 || triggerFired[1]==1 || triggerFired[2]==1) )", "goff")
-            else:
-                makeTrees(Type,"events",channel).Draw(var + " >> " + histName, "(" + cut_standard +" )", "goff") 
             Variables[Type].Scale(1,"width")
 
         yield_dic[physics_processes[Type]['datacard']] += round(Variables[Type].Integral("width"),3)
@@ -270,8 +374,6 @@ def plot_stack(channel, name,var, bin, low, high, ylabel, xlabel, setLog = False
 
     del Variables
     del var
-    del f
-    del h1
     c4.IsA().Destructor( c4 )
     stack.IsA().Destructor( stack )
 
@@ -327,21 +429,14 @@ arguments['fatjet1Pt']    = ['fatjet1Pt','fatjet1Pt',20,100,1500,'Events/GeV','F
 arguments['fatjet1PrunedM'] = ['fatjet1PrunedM','fatjet1PrunedM',30,0,200,'Events/GeV','m_{pruned} [GeV]',True]
 arguments['fatjet1SoftDropM'] = ['fatjet1SoftDropM','fatjet1SoftDropM',30,0,200,'Events/GeV','m_{SB} [GeV]',True]
 arguments['fatjet1tau21'] = ['fatjet1tau21','fatjet1tau21',20,0.0,1.0,'Events/bin','#tau_{2}/#tau_{1}',True]
-
 start_time = time.time()
 
-processes     = []
+filled, totals = fill_all(nproc)
 
 for channel in channel_list:
     for var in variable_list:
-        arguments[var].insert(0,channel)
-        print  arguments[var]
-        process = Process(target = plot_stack, args = arguments[var])
-        process.start()
-        processes.append(process)
-        arguments[var].remove(channel)
-for process in processes: 
-    process.join()
+        print  [channel] + arguments[var]
+        plot_stack(channel, *arguments[var], filled = filled, totals = totals)
 
 print("--- %s seconds ---" % (time.time()-start_time))
 print datetime.datetime.fromtimestamp(time.time()-start_time)
@@ -6,9 +6,21 @@ skimDir = '/mnt/hadoop/scratch/' + os.environ['USER'] + '/monophoton/skim'
 # optionally copy to a local disk to speed up
 localSkimDir = '/local/' + os.environ['USER'] + '/monophoton/skim'
 #localSkimDir = '/local/' + os.environ['USER'] + '/monophoton/skim_ballen'
+# managed copies of the skims returned by utils.getSkimPath, see skimcache.py (empty string to disable)
+skimCacheDir = ''
+#skimCacheDir = localSkimDir + '/cache'
+skimCacheQuota = 200 * 1024 ** 3 # bytes
+# lists of input entries passing each preskim, used by ssw2 to skip rejected events
+preskimIndexDir = skimDir + '/preskim_index'
+# (run, lumi, event) -> (file, entry) indices of panda samples and skims, see eventindex.py
+eventIndexDir = os.path.dirname(skimDir) + '/eventindex'
 
 # where the various output plots and text files
 histDir = '/data/t3home000/' + os.environ['USER'] + '/monophoton'
+# filled histograms reused by plot.py --cache
+histCacheDir = histDir + '/histcache'
+# branch columns extracted from the skims for the columnar filling backend (common/columndraw.py)
+columnCacheDir = localSkimDir + '/columns'
 
 # panda library
 libobjs = 'libPandaTreeObjects.so'
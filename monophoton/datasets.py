@@ -5,9 +5,19 @@ import os
 import math
 import fnmatch
 import subprocess
+import multiprocessing
+import tempfile
+import sqlite3
+import cPickle as pickle
 
 defaultList = os.path.dirname(os.path.realpath(__file__)) + '/data/datasets.csv'
 catalogDir = '/home/cmsprod/catalog/t2mit'
+# parsed catalog contents, refreshed when the source Filesets or Files change. Set to '' to always parse the catalog
+catalogCachePath = tempfile.gettempdir() + '/monophoton_catalog_%d.db' % os.getuid()
+# per-file event counts used by recalculate. Set to '' to always open the files
+countCachePath = tempfile.gettempdir() + '/monophoton_counts_%d.db' % os.getuid()
+# number of processes opening files in recalculate
+countJobs = 1
 
 def expandBrace(pattern):
     """Expand a string with a brace-enclosed substitution pattern."""
@@ -87,6 +97,287 @@ def braceContract(strings):
     return base[:start] + '{' + ','.join(diffs) + '}' + base[end:]
 
 
+def parseCatalog(directory):
+    """
+    Read the Filesets and Files lists of a dataset in the catalog. Return (xrdpath, filesets) where
+    xrdpath is the location of the first fileset and filesets is a list of (fileset, [basename]).
+    """
+
+    xrdpath = ''
+    filesets = []
+    basenames = {}
+
+    with open(directory + '/Filesets') as filesetList:
+        for line in filesetList:
+            fileset, path = line.split()[:2]
+            if not xrdpath:
+                xrdpath = path
+
+            basenames[fileset] = []
+            filesets.append((fileset, basenames[fileset]))
+
+    with open(directory + '/Files') as fileList:
+        for line in fileList:
+            fileset, fname = line.split()[:2]
+            basenames[fileset].append(fname)
+
+    return xrdpath, filesets
+
+
+class CatalogCache(object):
+    """
+    SQLite store of parsed catalog entries, keyed by the catalog directory of the dataset.
+    An entry is valid as long as the modification times and sizes of the source lists are unchanged.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._db = None
+
+    def _connect(self):
+        if self._db is None:
+            self._db = sqlite3.connect(self.path, timeout = 30.)
+            self._db.execute('CREATE TABLE IF NOT EXISTS `catalog` (`directory` TEXT PRIMARY KEY, `stamp` TEXT, `content` BLOB)')
+            self._db.commit()
+
+        return self._db
+
+    def load(self, directory):
+        stamp = []
+        for name in ['Filesets', 'Files']:
+            stat = os.stat(directory + '/' + name)
+            stamp.append('%d:%d' % (stat.st_mtime, stat.st_size))
+        stamp = ','.join(stamp)
+
+        try:
+            db = self._connect()
+            row = db.execute('SELECT `stamp`, `content` FROM `catalog` WHERE `directory` = ?', (directory,)).fetchone()
+            if row is not None and row[0] == stamp:
+                return pickle.loads(str(row[1]))
+        except (sqlite3.Error, pickle.UnpicklingError):
+            # cache is unusable; parse the source
+            pass
+
+        content = parseCatalog(directory)
+
+        try:
+            db = self._connect()
+            db.execute('INSERT OR REPLACE INTO `catalog` VALUES (?, ?, ?)', (directory, stamp, sqlite3.Binary(pickle.dumps(content, pickle.HIGHEST_PROTOCOL))))
+            db.commit()
+        except sqlite3.Error:
+            pass
+
+        return content
+
+
+_catalogCache = None
+
+def loadCatalog(directory):
+    global _catalogCache
+
+    if not catalogCachePath:
+        return parseCatalog(directory)
+
+    if _catalogCache is None or _catalogCache.path != catalogCachePath:
+        _catalogCache = CatalogCache(catalogCachePath)
+
+    return _catalogCache.load(directory)
+
+
+def countFile(path):
+    """
+    Read the event counters of a file. Return (path, (nevents, sumw, sumw2)), with sumw and sumw2 None
+    if the file has no hSumW, or (path, None) if the file cannot be read.
+    """
+
+    import ROOT
+
+    source = ROOT.TFile.Open(path)
+    if not source:
+        return path, None
+
+    try:
+        counter = source.Get('eventcounter')
+        nevents = counter.GetBinContent(1)
+
+        hsumw = source.Get('hSumW')
+        if hsumw:
+            sumw = hsumw.GetBinContent(1)
+            sumw2 = math.pow(hsumw.GetBinError(1), 2.)
+        else:
+            sumw = None
+            sumw2 = None
+
+        result = (nevents, sumw, sumw2)
+
+    except:
+        result = None
+
+    source.Close()
+
+    return path, result
+
+
+class CountCache(object):
+    """
+    SQLite store of countFile results keyed by file path, valid while the size and modification time are unchanged.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._db = None
+
+    def _connect(self):
+        if self._db is None:
+            self._db = sqlite3.connect(self.path, timeout = 30.)
+            self._db.execute('CREATE TABLE IF NOT EXISTS `counts` (`path` TEXT PRIMARY KEY, `stamp` TEXT, `nevents` REAL, `sumw` REAL, `sumw2` REAL)')
+            self._db.commit()
+
+        return self._db
+
+    @staticmethod
+    def stamp(path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+
+        return '%d:%d' % (stat.st_mtime, stat.st_size)
+
+    def load(self, path):
+        stamp = CountCache.stamp(path)
+        if stamp is None:
+            return None
+
+        try:
+            row = self._connect().execute('SELECT `stamp`, `nevents`, `sumw`, `sumw2` FROM `counts` WHERE `path` = ?', (path,)).fetchone()
+        except sqlite3.Error:
+            return None
+
+        if row is None or row[0] != stamp:
+            return None
+
+        return tuple(row[1:])
+
+    def store(self, results):
+        """
+        Store a list of (path, (nevents, sumw, sumw2)).
+        """
+
+        try:
+            db = self._connect()
+            for path, result in results:
+                stamp = CountCache.stamp(path)
+                if stamp is not None:
+                    db.execute('INSERT OR REPLACE INTO `counts` VALUES (?, ?, ?, ?, ?)', (path, stamp) + tuple(result))
+
+            db.commit()
+        except sqlite3.Error:
+            pass
+
+
+def countFiles(paths, jobs = 1):
+    """
+    Return {path: (nevents, sumw, sumw2)} for the readable files in paths, opening only the files not in the
+    count cache, in a pool of jobs processes.
+    """
+
+    if countCachePath:
+        cache = CountCache(countCachePath)
+    else:
+        cache = None
+
+    counts = {} # {path: (nevents, sumw, sumw2)}
+    toOpen = []
+    queued = set()
+
+    for path in paths:
+        if path in queued:
+            continue
+
+        queued.add(path)
+
+        if cache is not None:
+            result = cache.load(path)
+            if result is not None:
+                counts[path] = result
+                continue
+
+        toOpen.append(path)
+
+    if len(toOpen) != 0:
+        print 'Opening', len(toOpen), 'files'
+
+        if jobs > 1 and len(toOpen) > 1:
+            pool = multiprocessing.Pool(min(jobs, len(toOpen)))
+            try:
+                results = pool.map(countFile, toOpen)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = map(countFile, toOpen)
+
+        newCounts = [(path, result) for path, result in results if result is not None]
+        counts.update(newCounts)
+
+        if cache is not None:
+            cache.store(newCounts)
+
+    return counts
+
+def recount(samples, jobs = 1):
+    """
+    Recompute nevents, sumw, and sumw2 of the samples, opening the files in a pool of jobs processes.
+    Only files not in the count cache are opened. Samples with unreadable files are left unchanged.
+    Return {sample name: [failed path]}.
+    """
+
+    paths = []
+    for sample in samples:
+        sample.download()
+        paths.extend(sample.files())
+
+    counts = countFiles(paths, jobs = jobs)
+
+    failures = {}
+
+    for sample in samples:
+        nevents = 0.
+        sumw = 0.
+        sumw2 = 0.
+        failed = []
+
+        for path in sample.files():
+            try:
+                n, w, w2 = counts[path]
+            except KeyError:
+                failed.append(path)
+                continue
+
+            nevents += n
+            if not sample.data:
+                if w is None:
+                    failed.append(path)
+                    continue
+
+                sumw += w
+                sumw2 += w2
+
+        if len(failed) != 0:
+            failures[sample.name] = failed
+            continue
+
+        sample.nevents = nevents
+        if sample.data:
+            sample.sumw = 0.
+        else:
+            sample.sumw = sumw
+            sample._sumw2 = sumw2
+
+    return failures
+
+
 class SampleDef(object):
     def __init__(self, name, title = '', book = '', fullname = '', additionalDatasets = [], crosssection = 0., nevents = 0, sumw = 0., lumi = 0., data = False, comments = '', custom = {}):
         self.name = name
@@ -188,38 +479,12 @@ class SampleDef(object):
         if self._sumw2 > 0.:
             return
 
-        import ROOT
-
-        self.download()
+        failures = recount([self], jobs = countJobs)
 
-        self.nevents = 0
-        self.sumw = 0.
+        if len(failures) != 0:
+            for path in failures[self.name]:
+                print path, 'corrupt'
 
-        error = False
-        for dataset in self.datasetNames:
-            for fileset, basenames in self._basenames[dataset].items():
-                for basename in basenames:
-                    path = self._directories[dataset] + '/' + basename
-                    source = ROOT.TFile.Open(path)
-                    if not source:
-                        error = True
-                        continue
-
-                    try:
-                        counter = source.Get('eventcounter')
-                        self.nevents += counter.GetBinContent(1)
-                        if not self.data:
-                            sumw = source.Get('hSumW')
-                            self.sumw += sumw.GetBinContent(1)
-                            self._sumw2 += math.pow(sumw.GetBinError(1), 2.)
-
-                    except:
-                        print path, 'corrupt'
-                        error = True
-
-                    source.Close()
-
-        if error:
             raise RuntimeError('Corrupt input')
 
     def _readCatalogs(self):
@@ -228,25 +493,13 @@ class SampleDef(object):
             if dataset in self._basenames:
                 continue
 
-            self._basenames[dataset] = {}
+            xrdpath, filesets = loadCatalog(catalogDir + '/' + self.book + '/' + dataset)
 
-            with open(catalogDir + '/' + self.book + '/' + dataset + '/Filesets') as filesetList:
-                for line in filesetList:
-                    fileset, xrdpath = line.split()[:2]
-                    fileset += dsuffix
+            self._basenames[dataset] = dict((fileset + dsuffix, list(basenames)) for fileset, basenames in filesets)
 
-                    self._basenames[dataset][fileset] = []
-
-                    if dataset not in self._directories:
-                        self._directories[dataset] = xrdpath.replace('root://xrootd.cmsaf.mit.edu/', '/mnt/hadoop/cms').replace('root://t3serv006.mit.edu/', '/mnt/hadoop')
-                        self._downloadable[dataset] = self._directories[dataset].startswith('/mnt/hadoop/cms/store/user/paus')
-    
-            with open(catalogDir + '/' + self.book + '/' + dataset + '/Files') as fileList:
-                for line in fileList:
-                    fileset, fname = line.split()[:2]
-                    fileset += dsuffix
-    
-                    self._basenames[dataset][fileset].append(fname)
+            if len(filesets) != 0:
+                self._directories[dataset] = xrdpath.replace('root://xrootd.cmsaf.mit.edu/', '/mnt/hadoop/cms').replace('root://t3serv006.mit.edu/', '/mnt/hadoop')
+                self._downloadable[dataset] = self._directories[dataset].startswith('/mnt/hadoop/cms/store/user/paus')
     
     def recomputeWeight(self):
         self._sumw2 = 0.
@@ -304,11 +557,14 @@ class SampleDef(object):
         return paths
 
 
+_fnmatchPatterns = {} # {glob: compiled regex} for getmany
+
 class SampleDefList(object):
     def __init__(self, samples = [], listpath = ''):
         self.samples = list(samples)
         self._commentLines = {} # {path: [(dataset before, comment)]} to reproduce comment lines from the source
         self._sample_source = {} # {path: set(sample name)}
+        self._index = {} # {name: sample}, rebuilt when a lookup misses or finds a stale entry
 
         if listpath:
             self._load(listpath)
@@ -409,9 +665,19 @@ class SampleDefList(object):
         return [s.name for s in self.samples]
 
     def get(self, name):
+        sample = self._index.get(name)
+        # the samples list and the sample names can be modified directly; validate the cached entry
+        if sample is not None and sample.name == name and any(s is sample for s in self.samples):
+            return sample
+
+        self._index = {}
+        for sample in self.samples:
+            # first definition wins
+            self._index.setdefault(sample.name, sample)
+
         try:
-            return next(s for s in self.samples if s.name == name)
-        except StopIteration:
+            return self._index[name]
+        except KeyError:
             raise RuntimeError('Sample ' + name + ' not found')
 
     def getmany(self, names):
@@ -437,7 +703,12 @@ class SampleDefList(object):
                 names.extend(expanded[1:]) # add to the end of list
             
             if '*' in name:
-                matching = [s for s in self.samples if fnmatch.fnmatch(s.name, name)]
+                try:
+                    pattern = _fnmatchPatterns[name]
+                except KeyError:
+                    pattern = _fnmatchPatterns[name] = re.compile(fnmatch.translate(name))
+
+                matching = [s for s in self.samples if pattern.match(s.name)]
             else:
                 matching = [self.get(name)]
 
@@ -466,12 +737,14 @@ add INFO: Add a new dataset.'''
     argParser.add_argument('command', nargs = '+', help = commandHelp)
     argParser.add_argument('--catalog', '-c', metavar = 'PATH', dest = 'catalog', default = catalogDir, help = 'Source file catalog.')
     argParser.add_argument('--list-path', '-s', metavar = 'PATH', dest = 'listPath', default = defaultList, help = 'CSV file to load data from.')
+    argParser.add_argument('--jobs', '-j', metavar = 'N', dest = 'jobs', type = int, default = 1, help = 'Number of processes to open files with in recalculate.')
     argParser.add_argument('--save', '-o', metavar = 'PATH', dest = 'outPath', nargs = '?', const = '', help = 'Save updated content to CSV file (no argument: save to original CSV).')
 
     args = argParser.parse_args()
     sys.argv = []
 
     catalogDir = args.catalog
+    countJobs = args.jobs
 
     import ROOT
 
@@ -524,9 +797,15 @@ add INFO: Add a new dataset.'''
         for name in arguments:
             targets.extend(samples.getmany(name))
 
+        failures = recount(targets, jobs = args.jobs)
+
         for sample in targets:
-            sample.recomputeWeight()
-            print sample.linedump()
+            if sample.name in failures:
+                print sample.name, 'failed to read', len(failures[sample.name]), 'files. Not changing anything.'
+                for path in failures[sample.name]:
+                    print ' ', path
+            else:
+                print sample.linedump()
 
     elif command == 'add':
         name, title, crosssection, nevents, sumw, book, fullname = arguments[:7]
@@ -0,0 +1,323 @@
+#!/usr/bin/env python
+
+"""
+Persistent index from event ID (run, lumi, event) to (file path, entry number).
+
+Indices are stored in config.eventIndexDir as numpy .npz files with one column per field, sorted by event ID.
+Panda samples are indexed over the "events" tree of their files (index name = sample name); skims are indexed
+over their "cutflow" tree (index name = sample_region).
+
+Usage:
+  eventindex.py SAMPLE [SAMPLE ...] [--region REGION]   build or update the indices
+  eventindex.py SAMPLE --find RUN:LUMI:EVENT [...]      print the file and entry of the events
+"""
+
+import os
+import sys
+import re
+import multiprocessing
+
+import numpy
+
+thisdir = os.path.dirname(os.path.realpath(__file__))
+if thisdir not in sys.path:
+    sys.path.append(thisdir)
+
+import config
+
+def indexPath(name):
+    return config.eventIndexDir + '/' + name + '.npz'
+
+def fileStamp(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+
+    return (int(stat.st_mtime), stat.st_size)
+
+def readIds(job):
+    """
+    Read the event IDs of one file. Return (path, stamp, (n, 3) uint64 array of run, lumi, event),
+    or (path, None, None) if the file cannot be read.
+    """
+
+    path, treeName = job
+
+    import ROOT
+
+    stamp = fileStamp(path)
+    if stamp is None:
+        # only local files can be checked for changes
+        return path, None, None
+
+    source = ROOT.TFile.Open(path)
+    if not source or source.IsZombie():
+        return path, None, None
+
+    tree = source.Get(treeName)
+    if not tree:
+        source.Close()
+        return path, None, None
+
+    nentries = tree.GetEntries()
+    ids = numpy.empty((nentries, 3), dtype = numpy.uint64)
+
+    if nentries != 0:
+        tree.SetEstimate(nentries + 1)
+        tree.Draw('runNumber:lumiNumber:eventNumber', '', 'goff')
+
+        for icol, buf in enumerate([tree.GetV1(), tree.GetV2(), tree.GetV3()]):
+            buf.SetSize(nentries)
+            ids[:, icol] = numpy.frombuffer(buf, dtype = numpy.float64, count = nentries)
+
+    source.Close()
+
+    return path, stamp, ids
+
+
+class EventIndex(object):
+    """
+    Columns run, lumi, event, file (position in paths), entry, sorted by (run, lumi, event).
+    """
+
+    def __init__(self, treeName, paths, stamps, run, lumi, event, ifile, entry):
+        self.treeName = treeName
+        self.paths = list(paths)
+        self.stamps = [tuple(s) for s in stamps]
+
+        order = numpy.lexsort((event, lumi, run))
+
+        self.run = numpy.asarray(run, dtype = numpy.uint32)[order]
+        self.lumi = numpy.asarray(lumi, dtype = numpy.uint32)[order]
+        self.event = numpy.asarray(event, dtype = numpy.uint64)[order]
+        self.file = numpy.asarray(ifile, dtype = numpy.uint32)[order]
+        self.entry = numpy.asarray(entry, dtype = numpy.int64)[order]
+
+        self._lumiKey = (self.run.astype(numpy.uint64) << numpy.uint64(32)) | self.lumi.astype(numpy.uint64)
+
+    def __len__(self):
+        return self.run.shape[0]
+
+    @staticmethod
+    def load(path):
+        """
+        Return the index stored at path, or None if there is none.
+        """
+
+        if not os.path.exists(path):
+            return None
+
+        source = numpy.load(path)
+        try:
+            return EventIndex(str(source['treeName']), source['paths'], source['stamps'], source['run'], source['lumi'], source['event'], source['file'], source['entry'])
+        finally:
+            source.close()
+
+    def save(self, path):
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError:
+            pass
+
+        # write to a temporary file and rename so that readers never see a partial index
+        tmpPath = path + '.tmp%d' % os.getpid()
+        with open(tmpPath, 'wb') as output:
+            numpy.savez(output, treeName = self.treeName, paths = numpy.array(self.paths), stamps = numpy.array(self.stamps, dtype = numpy.int64).reshape(-1, 2),
+                run = self.run, lumi = self.lumi, event = self.event, file = self.file, entry = self.entry)
+
+        os.rename(tmpPath, path)
+
+    def fileRows(self):
+        """
+        Return {file position: array of row numbers}.
+        """
+
+        order = numpy.argsort(self.file, kind = 'mergesort')
+        ifiles = self.file[order]
+        bounds = numpy.searchsorted(ifiles, numpy.arange(len(self.paths) + 1))
+
+        return dict((ifile, order[bounds[ifile]:bounds[ifile + 1]]) for ifile in range(len(self.paths)))
+
+    def find(self, eventIds):
+        """
+        Look up a list of (run, lumi, event). Return ({path: [(event ID, entry)] sorted by entry}, [event IDs not found]).
+        """
+
+        located = {}
+        missing = []
+
+        for eventId in eventIds:
+            run, lumi, event = eventId
+            key = numpy.uint64((run << 32) | lumi)
+
+            low = numpy.searchsorted(self._lumiKey, key, side = 'left')
+            high = numpy.searchsorted(self._lumiKey, key, side = 'right')
+            irow = low + numpy.searchsorted(self.event[low:high], numpy.uint64(event))
+
+            if irow == high or self.event[irow] != event:
+                missing.append(eventId)
+                continue
+
+            path = self.paths[self.file[irow]]
+            if path not in located:
+                located[path] = []
+
+            located[path].append((eventId, int(self.entry[irow])))
+
+        for entries in located.values():
+            entries.sort(key = lambda e: e[1])
+
+        return located, missing
+
+    def stale(self, paths):
+        """
+        Return the subset of paths that changed since they were indexed.
+        """
+
+        stamps = dict(zip(self.paths, self.stamps))
+        return [path for path in paths if fileStamp(path) != stamps.get(path)]
+
+
+def build(paths, treeName = 'events', previous = None, jobs = 1):
+    """
+    Index treeName of the files in paths. Files whose mtime and size match their entries in the previous index
+    are not reopened. Return (index, [paths that could not be read]).
+    """
+
+    reused = {} # {path: (stamp, ids, entries)}
+    if previous is not None and previous.treeName == treeName:
+        for ifile, rows in previous.fileRows().items():
+            path = previous.paths[ifile]
+            if fileStamp(path) == previous.stamps[ifile]:
+                ids = numpy.column_stack((previous.run[rows], previous.lumi[rows], previous.event[rows])).astype(numpy.uint64)
+                reused[path] = (previous.stamps[ifile], ids, previous.entry[rows])
+
+    toOpen = [(path, treeName) for path in paths if path not in reused]
+
+    if len(toOpen) != 0:
+        print 'Indexing', len(toOpen), 'files'
+
+    if jobs > 1 and len(toOpen) > 1:
+        pool = multiprocessing.Pool(min(jobs, len(toOpen)))
+        try:
+            results = pool.map(readIds, toOpen)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = map(readIds, toOpen)
+
+    read = {}
+    failed = []
+    for path, stamp, ids in results:
+        if ids is None:
+            failed.append(path)
+        else:
+            read[path] = (stamp, ids, numpy.arange(ids.shape[0], dtype = numpy.int64))
+
+    indexed = []
+    stamps = []
+    columns = []
+    for path in paths:
+        if path in reused:
+            stamp, ids, entries = reused[path]
+        elif path in read:
+            stamp, ids, entries = read[path]
+        else:
+            continue
+
+        columns.append((ids, entries, numpy.full(ids.shape[0], len(indexed), dtype = numpy.uint32)))
+        indexed.append(path)
+        stamps.append(stamp)
+
+    if len(columns) != 0:
+        ids = numpy.concatenate([c[0] for c in columns])
+        entries = numpy.concatenate([c[1] for c in columns])
+        ifiles = numpy.concatenate([c[2] for c in columns])
+    else:
+        ids = numpy.empty((0, 3), dtype = numpy.uint64)
+        entries = numpy.empty(0, dtype = numpy.int64)
+        ifiles = numpy.empty(0, dtype = numpy.uint32)
+
+    index = EventIndex(treeName, indexed, stamps, ids[:, 0], ids[:, 1], ids[:, 2], ifiles, entries)
+
+    return index, failed
+
+def update(name, paths, treeName = 'events', jobs = 1):
+    """
+    Bring the index name up to date with paths and save it. Return (index, [paths that could not be read]).
+    """
+
+    path = indexPath(name)
+
+    index, failed = build(paths, treeName = treeName, previous = EventIndex.load(path), jobs = jobs)
+    index.save(path)
+
+    return index, failed
+
+def load(name):
+    return EventIndex.load(indexPath(name))
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    argParser = ArgumentParser(description = 'Build and query event ID indices.')
+    argParser.add_argument('snames', metavar = 'SAMPLE', nargs = '+', help = 'Sample names.')
+    argParser.add_argument('--region', '-r', metavar = 'REGION', dest = 'region', default = '', help = 'Index the skim of the region instead of the panda files.')
+    argParser.add_argument('--catalog', '-c', metavar = 'PATH', dest = 'catalog', default = '', help = 'Source file catalog.')
+    argParser.add_argument('--jobs', '-j', metavar = 'N', dest = 'jobs', type = int, default = 1, help = 'Number of processes opening files.')
+    argParser.add_argument('--find', '-f', metavar = 'EVENTID', dest = 'eventIds', nargs = '+', default = [], help = 'Print the location of run:lumi:event instead of building the index.')
+
+    args = argParser.parse_args()
+    sys.argv = []
+
+    import datasets
+    import utils
+
+    if args.catalog:
+        datasets.catalogDir = args.catalog
+
+    eventIds = []
+    for sid in args.eventIds:
+        matches = re.match('([0-9]+):([0-9]+):([0-9]+)$', sid)
+        if not matches:
+            print 'Invalid event ID', sid
+            sys.exit(1)
+
+        eventIds.append(tuple(int(matches.group(i)) for i in range(1, 4)))
+
+    for sample in datasets.allsamples.getmany(args.snames):
+        if args.region:
+            name = sample.name + '_' + args.region
+        else:
+            name = sample.name
+
+        if len(eventIds) != 0:
+            index = load(name)
+            if index is None:
+                print 'No index for', name
+                continue
+
+            located, missing = index.find(eventIds)
+            for path, entries in sorted(located.items()):
+                for eventId, entry in entries:
+                    print '%d:%d:%d' % eventId, path, entry
+
+            for eventId in missing:
+                print '%d:%d:%d' % eventId, 'not found in', name
+
+        else:
+            if args.region:
+                paths = [utils.getSkimPath(sample.name, args.region)]
+                treeName = 'cutflow'
+            else:
+                paths = sample.files()
+                treeName = 'events'
+
+            index, failed = update(name, paths, treeName = treeName, jobs = args.jobs)
+
+            print name, len(index), 'events in', len(index.paths), 'files'
+            for path in failed:
+                print ' Could not read', path
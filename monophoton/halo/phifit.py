@@ -15,6 +15,8 @@ sys.path.append(basedir)
 
 TEMPLATEONLY = True
 FITPSEUDODATA = False
+# fill the histograms with the vectorized backend (trees are always filled by MultiDraw)
+COLUMNAR = False
 
 from datasets import allsamples
 from plotstyle import SimpleCanvas
@@ -24,6 +26,15 @@ import utils
 ROOT.RooMsgService.instance().setGlobalKillBelow(ROOT.RooFit.ERROR)
 ROOT.gROOT.LoadMacro(basedir + '/../common/MultiDraw.cc+')
 
+sys.path.append(basedir + '/../common')
+from columndraw import ColumnDraw
+
+def makePlotter():
+    if COLUMNAR:
+        return ColumnDraw(config.columnCacheDir)
+    else:
+        return ROOT.MultiDraw()
+
 #targs = allsamples.getmany(['sph-16b-m', 'sph-16c-m', 'sph-16d-m'])
 targs = allsamples.getmany(['sph-16*-m'])
 dataLumi = sum(s.lumi for s in targs)
@@ -46,8 +57,8 @@ outputFile = ROOT.TFile.Open(config.histDir + '/halo/phifit.root', 'recreate')
 templates = {}
 trees = {}
 
-haloPlotter = ROOT.MultiDraw()
-mcPlotter = ROOT.MultiDraw()
+haloPlotter = makePlotter()
+mcPlotter = makePlotter()
 for sample in targs:
     haloPlotter.addInputPath(utils.getSkimPath(sample.name, 'halo'))
 
@@ -119,7 +130,7 @@ print 'Transfer factor uncertainty:', max(abs(tfVar1 - tf), abs(tfVar2 - tf))
 sys.exit(0)
 
 if not TEMPLATEONLY and not FITPSEUDODATA:
-    candPlotter = ROOT.MultiDraw()
+    candPlotter = makePlotter()
     for sample in targs:
         candPlotter.addInputPath(utils.getSkimPath(sample.name, 'monoph'))
 
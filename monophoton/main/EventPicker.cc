@@ -6,16 +6,23 @@
 #include "TTree.h"
 #include "TKey.h"
 
+#include <map>
+
 class EventPicker {
 public:
   EventPicker() {}
   ~EventPicker() {}
   void addPath(char const* _path) { paths_.emplace_back(_path); }
   void addEvent(unsigned r, unsigned l, unsigned e) { eventIds_.emplace_back(r, l, e); }
+  //! Entry of an event located through an event index (see eventindex.py)
+  void addEntry(char const* _path, long _entry) { entries_[_path].push_back(_entry); }
   void setPrintEvery(unsigned i) { printEvery_ = i; }
   void setPrintLevel(unsigned l) { printLevel_ = l; }
 
+  //! Scan the paths for the events
   void run(char const* outputDir, long nEntries = -1);
+  //! Read the entries added with addEntry directly
+  void runEntries(char const* outputDir);
 
   struct EventId {
     EventId() {}
@@ -27,8 +34,11 @@ public:
   };
 
 private:
+  void writeEvent_(char const* outputDir, panda::Event&, TFile& source);
+
   std::vector<TString> paths_{};
   std::vector<EventId> eventIds_{};
+  std::map<TString, std::vector<long>> entries_{};
   unsigned printEvery_{10000};
   unsigned printLevel_{0};
 };
@@ -78,33 +88,78 @@ EventPicker::run(char const* _outputDir, long _nEntries/* = -1*/)
 
         run.findEntry(*runTree, id.runNumber);
 
-        auto* outputFile(TFile::Open(TString::Format("%s/%d_%d_%d.root", _outputDir, id.runNumber, id.lumiNumber, id.eventNumber), "recreate"));
-        auto* outputEvents(new TTree("events", "events"));
-        auto* outputRuns(new TTree("runs", "runs"));
+        writeEvent_(_outputDir, event, *fullInput.GetCurrentFile());
+        
+        eventIds_.erase(idItr);
+        break;
+      }
+    }
+  }
+}
 
-        event.book(*outputEvents);
-        event.run.book(*outputRuns);
-        event.fill(*outputEvents);
-        event.run.fill(*outputRuns);
+void
+EventPicker::runEntries(char const* _outputDir)
+{
+  panda::Event event;
+  panda::Run run;
 
-        outputFile->cd();
-        outputEvents->Write();
-        outputRuns->Write();
+  for (auto& pathEntries : entries_) {
+    auto* source(TFile::Open(pathEntries.first));
+    if (!source || source->IsZombie()) {
+      std::cerr << "Cannot open " << pathEntries.first << std::endl;
+      delete source;
+      continue;
+    }
 
-        for (auto* key : *fullInput.GetCurrentFile()->GetListOfKeys()) {
-          if (std::strcmp(key->GetName(), "events") == 0 || std::strcmp(key->GetName(), "runs") == 0)
-            continue;
+    auto* input(static_cast<TTree*>(source->Get("events")));
+    auto* runTree(static_cast<TTree*>(source->Get("runs")));
 
-          outputFile->cd();
-          auto* obj(static_cast<TKey*>(key)->ReadObj());
-          obj->Write();
-        }
-        
-        delete outputFile;
-        
-        eventIds_.erase(idItr);
-        break;
+    event.setAddress(*input);
+    run.runNumber = 0;
+    run.setAddress(*runTree);
+
+    for (long iEntry : pathEntries.second) {
+      if (event.getEntry(*input, iEntry) <= 0) {
+        std::cerr << "Cannot read entry " << iEntry << " of " << pathEntries.first << std::endl;
+        continue;
       }
+
+      if (printLevel_ > 0)
+        std::cout << "Found event " << event.runNumber << ":" << event.lumiNumber << ":" << event.eventNumber << std::endl;
+
+      run.findEntry(*runTree, event.runNumber);
+
+      writeEvent_(_outputDir, event, *source);
     }
+
+    delete source;
+  }
+}
+
+void
+EventPicker::writeEvent_(char const* _outputDir, panda::Event& _event, TFile& _source)
+{
+  auto* outputFile(TFile::Open(TString::Format("%s/%d_%d_%d.root", _outputDir, _event.runNumber, _event.lumiNumber, _event.eventNumber), "recreate"));
+  auto* outputEvents(new TTree("events", "events"));
+  auto* outputRuns(new TTree("runs", "runs"));
+
+  _event.book(*outputEvents);
+  _event.run.book(*outputRuns);
+  _event.fill(*outputEvents);
+  _event.run.fill(*outputRuns);
+
+  outputFile->cd();
+  outputEvents->Write();
+  outputRuns->Write();
+
+  for (auto* key : *_source.GetListOfKeys()) {
+    if (std::strcmp(key->GetName(), "events") == 0 || std::strcmp(key->GetName(), "runs") == 0)
+      continue;
+
+    outputFile->cd();
+    auto* obj(static_cast<TKey*>(key)->ReadObj());
+    obj->Write();
   }
+  
+  delete outputFile;
 }
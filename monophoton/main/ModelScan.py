@@ -4,6 +4,11 @@ from argparse import ArgumentParser
 import os
 import sys
 import re
+import glob
+import json
+import hashlib
+import tempfile
+import multiprocessing
 from subprocess import Popen, PIPE
 import shutil
 from pprint import pprint
@@ -13,6 +18,7 @@ thisdir = os.path.dirname(os.path.realpath(__file__))
 basedir = os.path.dirname(thisdir)
 sys.path.append(basedir)
 from plotstyle import *
+import ROOT
 from datasets import allsamples
 import config
 
@@ -21,6 +27,10 @@ parser.add_argument('-m', '--models', metavar = 'MODEL', action = 'store', defau
 parser.add_argument('-R', '--root-file', metavar = 'PATH', action = 'store', dest = 'rootFile', help = 'Histogram ROOT file.')
 parser.add_argument('--variable', '-v', metavar = 'VARNAME', action = 'store', dest = 'variable', default = 'phoPtHighMet', help = 'Discriminating variable.')
 parser.add_argument('--shape', '-s', action = 'store_true', dest = 'shape', default = False, help = 'Turn on shape analysis.')
+parser.add_argument('--jobs', '-j', metavar = 'N', action = 'store', dest = 'jobs', type = int, default = 1, help = 'Number of model points to process in parallel.')
+parser.add_argument('--limit-tool', '-t', metavar = 'PATH', action = 'store', dest = 'limitTool', default = 'combine', help = 'Limit tool executable. Must accept the combine command line and write a higgsCombine*.root file with the limit tree.')
+parser.add_argument('--cache', '-C', metavar = 'PATH', action = 'store', dest = 'cacheDir', default = '', help = 'Directory for cached limits. Default is limitcache under the card directory.')
+parser.add_argument('--no-cache', '-N', action = 'store_true', dest = 'noCache', default = False, help = 'Recompute all points.')
 
 opts = parser.parse_args()
 
@@ -35,15 +45,13 @@ for m in mandatories:
 ### Function to Run Higgs Tool and Get Expected Limit for a DataCard
 ###======================================================================================
 
-def RunHiggsTool(DataCardPath,LimitToolDir):
-    TextPath = DataCardPath
-    HiggsTool = Popen(['combine','-M','Asymptotic',TextPath],
-                      stdout=PIPE,stderr=PIPE,cwd=LimitToolDir)    
-    """ For debugging, will cause grep step to crash
-    (hout, herr) = HiggsTool.communicate()
-    print hout, '\n'
-    print herr, '\n'
+def RunHiggsTool(DataCardPath, limitTool = 'combine'):
     """
+    Run the asymptotic limit calculation on the card in a scratch directory and read the limit tree of the output.
+    Returns (obs, exp) where exp is (median, 16%, 84%). Limits that could not be computed are -1.
+    """
+
+    TextPath = os.path.realpath(DataCardPath)
 
     rscale = 1.
     with open(TextPath) as datacard:
@@ -52,35 +60,111 @@ def RunHiggsTool(DataCardPath,LimitToolDir):
         if matches:
             rscale = float(matches.group(1))
 
-    find = Popen(['egrep','Observed|Expected'],stdin=HiggsTool.stdout,stdout=PIPE,stderr=PIPE)
-    """ for debugging, will cause next step to crash
-    (fout, ferr) = find.communicate()
-    print fout, '\n'
-    print ferr, '\n'
-    """
+    workdir = tempfile.mkdtemp(prefix = 'modelscan_')
+
+    try:
+        HiggsTool = Popen([limitTool, '-M', 'Asymptotic', TextPath], stdout = PIPE, stderr = PIPE, cwd = workdir)
+        (hout, herr) = HiggsTool.communicate()
+
+        limits = {}
+
+        outputs = glob.glob(workdir + '/higgsCombine*.root')
+        if len(outputs) != 0:
+            source = ROOT.TFile.Open(outputs[0])
+            tree = source.Get('limit')
+            if tree:
+                for entry in tree:
+                    limits[round(entry.quantileExpected, 3)] = entry.limit * rscale
 
-    lines = [line for line in find.stdout]
-    # print lines
-
-    obs = (-1., -1., -1.)
-    exp = (-1., -1., -1.)
-
-    for line in lines:
-        # print line
-        tmp = line.split()
-        # print tmp
-        if tmp:
-            if 'Observed' in tmp[0]:
-                obs = ( float(tmp[4]) * rscale, float(tmp[4])/1.2 * rscale, float(tmp[4])/0.8 * rscale )
-            elif "50.0%" in tmp[0]:
-                exp[0] = float(tmp[4]) * rscale
-            elif "16.0%" in tmp[0]:
-                exp[1] = float(tmp[4]) * rscale
-            elif "84.0%" in tmp[0]:
-                exp[2] = float(tmp[4]) * rscale
+            source.Close()
+
+        else:
+            print 'No output from', limitTool, 'for', DataCardPath
+            print herr
+
+    finally:
+        shutil.rmtree(workdir)
+
+    obs = limits.get(-1., -1.)
+    exp = (limits.get(0.5, -1.), limits.get(0.16, -1.), limits.get(0.84, -1.))
 
     return (obs, exp)
 
+_contentHashes = {} # {(path, mtime, size): sha1}
+
+def contentHash(path):
+    stat = os.stat(path)
+    key = (path, stat.st_mtime, stat.st_size)
+
+    try:
+        return _contentHashes[key]
+    except KeyError:
+        pass
+
+    digest = hashlib.sha1()
+    with open(path, 'rb') as source:
+        while True:
+            block = source.read(1024 * 1024)
+            if not block:
+                break
+            digest.update(block)
+
+    _contentHashes[key] = digest.hexdigest()
+    return _contentHashes[key]
+
+def cardKey(cardPath, limitTool):
+    """
+    Hash of the card, the shape files it refers to, and the limit tool.
+    """
+
+    digest = hashlib.sha1()
+    digest.update(limitTool + '\n')
+    digest.update(contentHash(cardPath) + '\n')
+
+    cardDir = os.path.dirname(os.path.realpath(cardPath))
+
+    with open(cardPath) as datacard:
+        for line in datacard:
+            words = line.split()
+            if len(words) > 3 and words[0] == 'shapes':
+                path = os.path.join(cardDir, words[3])
+                if os.path.exists(path):
+                    digest.update(contentHash(path) + '\n')
+
+    return digest.hexdigest()
+
+def computeLimit(model):
+    """
+    Write the card of the model point and return (model, obs, exp) from the cache or the limit tool.
+    """
+
+    '''./datacard.py dma-500-1 limitsfile.root -o test.txt -O -v phoPtHighMet'''
+    cardPath = os.path.join(cardDir, model + '_' + opts.variable + '.txt')
+
+    argList = ['./datacard.py', model, opts.rootFile, '-v', opts.variable, '-o', cardPath]
+    if opts.shape:
+        argList.append('-s')
+    MakeDataCard = Popen(argList, stdout = PIPE, stderr = PIPE)
+    (out, err) = MakeDataCard.communicate()
+
+    if cacheDir:
+        cachePath = os.path.join(cacheDir, cardKey(cardPath, opts.limitTool) + '.json')
+        if os.path.exists(cachePath):
+            with open(cachePath) as cache:
+                result = json.load(cache)
+
+            return model, result['obs'], tuple(result['exp'])
+
+    (obs, exp) = RunHiggsTool(cardPath, opts.limitTool)
+
+    if cacheDir and obs >= 0. and exp[0] >= 0.:
+        tmpPath = cachePath + '.%d' % os.getpid()
+        with open(tmpPath, 'w') as cache:
+            json.dump({'model': model, 'obs': obs, 'exp': exp}, cache)
+        os.rename(tmpPath, cachePath)
+
+    return model, obs, exp
+
 
 ###======================================================================================
 ### Make Datacards and compute limits
@@ -116,31 +200,37 @@ shutil.copy(opts.rootFile, rootFilePath)
 
 print datetime.datetime.now(), '\n'
 
-limits = {} # "dmv-500-150" : ( Obs, Exp )
-print "%-16s %15s %15s %15s %15s" % ('model', 'Observed (r)', 'Expected (r)', 'Observed (1/fb)', 'Expected (1/fb)')
-for iM, model in enumerate(modelList):
+if opts.noCache:
+    cacheDir = ''
+elif opts.cacheDir:
+    cacheDir = opts.cacheDir
+else:
+    cacheDir = os.path.join(cardDir, 'limitcache')
+
+if cacheDir and not os.path.isdir(cacheDir):
+    os.makedirs(cacheDir)
+
+points = []
+for model in modelList:
     try:
         allsamples[model]
     except:
         print 'Skipping', model
         continue
 
-    '''./datacard.py dma-500-1 limitsfile.root -o test.txt -O -v phoPtHighMet'''
-    cardPath = os.path.join(cardDir, model+'_'+opts.variable+'.txt')
-    # print cardPath
-    argList = ['./datacard.py', model, opts.rootFile, '-v', opts.variable, '-o', cardPath]
-    if opts.shape:
-        argList.append('-s')
-    MakeDataCard = Popen(argList, stdout=PIPE, stderr=PIPE)
-    
-    (out, err) = MakeDataCard.communicate()
-    # print out, '\n'
-    # print err, '\n'
-        
-    (obs, exp) = RunHiggsTool(cardPath,LimitToolDir)
-    # (obs, exp) = (1.0, 1.0)
+    points.append(model)
+
+if opts.jobs > 1:
+    pool = multiprocessing.Pool(opts.jobs)
+    results = pool.imap(computeLimit, points)
+else:
+    pool = None
+    results = (computeLimit(model) for model in points)
 
-    obsNom = obs[0]
+limits = {} # "dmv-500-150" : ( Obs, Exp )
+print "%-16s %15s %15s %15s %15s" % ('model', 'Observed (r)', 'Expected (r)', 'Observed (1/fb)', 'Expected (1/fb)')
+for (model, obs, exp) in results:
+    obsNom = obs
     expNom = exp[0]
 
     obsXsec = obsNom * allsamples[model].crosssection * 1000. # to 1/fb
@@ -161,6 +251,10 @@ for iM, model in enumerate(modelList):
 
     print limitString
 
+if pool is not None:
+    pool.close()
+    pool.join()
+
 print datetime.datetime.now()
 
 # "dmv" : ( [mMed], [mDM] ) 
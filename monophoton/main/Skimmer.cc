@@ -14,57 +14,175 @@
 
 #include "GoodLumiFilter.h"
 
+#include "TFileMerger.h"
+
 #include <vector>
 #include <iostream>
 #include <fstream>
 #include <stdexcept>
 #include <chrono>
+#include <thread>
+#include <memory>
+#include <exception>
+#include <algorithm>
+#include <map>
 typedef std::chrono::steady_clock SClock;
 
 unsigned TIMEOUT(300);
 
+//! Input chains, event objects, and selectors of one event loop.
+/*!
+ * Skimmer::run creates one per thread, each processing a contiguous range of entries.
+ * Everything a thread modifies during the loop is in its worker: the selectors and their operators are built
+ * per thread by ssw2.py, and the good lumi filter is copied. Objects still shared between the threads (weight
+ * histograms from selectors.getFromFile, the preskim index) are only read through const lookups.
+ */
+struct SkimWorker {
+  SkimWorker() : preInput("events"), mainInput("events"), genInput("events"), genParticles("genParticles") {}
+
+  TChain preInput;
+  TChain mainInput;
+  TChain genInput;
+  panda::Event event;
+  panda::GenParticleCollection genParticles;
+  panda::EventMonophoton skimmedEvent;
+  TTreeFormula* preselection{0};
+  std::vector<EventSelectorBase*>* selectors{0};
+  long firstEntry{0};
+  long nEntries{-1};
+  TString label{""};
+  std::ostream* stream{&std::cout};
+  std::ofstream debugFile;
+  std::exception_ptr error{};
+  std::map<int, std::vector<Long64_t>> preskimPassed{}; // tree number -> local entries passing the preselection
+  std::unique_ptr<GoodLumiFilter> goodLumiFilter{};
+};
+
 class Skimmer {
 public:
   Skimmer() {}
   ~Skimmer();
 
   void addPath(char const* _path) { paths_.emplace_back(_path); }
-  void clearPaths() { paths_.clear(); }
-  void addSelector(EventSelectorBase* _sel) { selectors_.push_back(_sel); }
+  void clearPaths();
+  //! Add a selector. With multiple threads, each thread needs its own set of selectors.
+  void addSelector(EventSelectorBase* _sel, unsigned _iThread = 0);
   void setOwnSelectors(bool b) { ownSelectors_ = b; }
   void setGoodLumiFilter(GoodLumiFilter* _filt) { goodLumiFilter_ = _filt; }
   void setSkipMissingFiles(bool b) { skipMissingFiles_ = b; }
   void setPrintEvery(unsigned i) { printEvery_ = i; }
+  //! Split the entry range over n threads. Outputs of the threads are merged at the end of run().
+  void setNThreads(unsigned n) { nThreads_ = n == 0 ? 1 : n; }
   void run(char const* outputDir, char const* sampleName, bool isData, long nEntries = -1, long firstEntry = 0);
   void prepareEvent(panda::Event const&, panda::EventMonophoton&, panda::GenParticleCollection const* = 0);
   void setPrintLevel(unsigned l) { printLevel_ = l; }
   void setCompatibilityMode(bool r) { compatibilityMode_ = r; }
+  //! Read the list of local entry numbers of the input path that pass the preskim.
+  /*!
+   * Entries not in the list are skipped without evaluating the preselection or reading the event.
+   * The index file is a flat array of Long64_t written by savePreskimIndex.
+   */
+  void loadPreskimIndex(char const* path, char const* indexPath);
+  //! Write the local entry numbers of the input path that passed the preskim in the last run.
+  /*!
+   * Only meaningful if the last run covered all entries of the file. Returns false if there is
+   * no record for the path.
+   */
+  bool savePreskimIndex(char const* path, char const* indexPath) const;
 
 private:
+  void runWorker_(SkimWorker&);
+
   std::vector<TString> paths_{};
-  std::vector<EventSelectorBase*> selectors_{};
+  std::vector<std::vector<EventSelectorBase*>> selectors_{1};
   bool ownSelectors_{true};
   GoodLumiFilter* goodLumiFilter_{};
   bool skipMissingFiles_{false};
   unsigned printEvery_{10000};
   unsigned printLevel_{0};
   bool compatibilityMode_{false};
+  unsigned nThreads_{1};
+  std::map<TString, std::vector<Long64_t>> preskimIndex_{};
+  std::map<TString, std::vector<Long64_t>> preskimPassed_{};
 };
 
 Skimmer::~Skimmer()
 {
   if (ownSelectors_) {
-    for (auto* sel : selectors_)
-      delete sel;
+    for (auto& selectors : selectors_) {
+      for (auto* sel : selectors)
+        delete sel;
+    }
   }
 }
 
+void
+Skimmer::clearPaths()
+{
+  paths_.clear();
+  preskimIndex_.clear();
+  preskimPassed_.clear();
+}
+
+void
+Skimmer::loadPreskimIndex(char const* _path, char const* _indexPath)
+{
+  std::ifstream indexFile(_indexPath, std::ios::binary | std::ios::ate);
+  if (!indexFile.is_open())
+    throw std::runtime_error(TString::Format("Cannot open preskim index %s", _indexPath).Data());
+
+  std::streamsize size(indexFile.tellg());
+  indexFile.seekg(0, std::ios::beg);
+
+  auto& entries(preskimIndex_[_path]);
+  entries.resize(size / sizeof(Long64_t));
+  indexFile.read(reinterpret_cast<char*>(entries.data()), entries.size() * sizeof(Long64_t));
+}
+
+bool
+Skimmer::savePreskimIndex(char const* _path, char const* _indexPath) const
+{
+  auto pItr(preskimPassed_.find(_path));
+  if (pItr == preskimPassed_.end())
+    return false;
+
+  auto& entries(pItr->second);
+
+  std::ofstream indexFile(_indexPath, std::ios::binary | std::ios::trunc);
+  if (!indexFile.is_open())
+    return false;
+
+  indexFile.write(reinterpret_cast<char const*>(entries.data()), entries.size() * sizeof(Long64_t));
+
+  return indexFile.good();
+}
+
+void
+Skimmer::addSelector(EventSelectorBase* _sel, unsigned _iThread/* = 0*/)
+{
+  if (_iThread >= selectors_.size())
+    selectors_.resize(_iThread + 1);
+
+  selectors_[_iThread].push_back(_sel);
+}
+
 void
 Skimmer::run(char const* _outputDir, char const* _sampleName, bool isData, long _nEntries/* = -1*/, long _firstEntry/* = 0*/)
 {
-  if (selectors_.size() == 0)
+  if (selectors_[0].size() == 0)
     throw std::runtime_error("No selectors set");
 
+  unsigned nThreads(nThreads_);
+  if (nThreads > 1) {
+    if (selectors_.size() < nThreads)
+      throw std::runtime_error("Selectors must be set for each thread");
+
+    for (unsigned iT(1); iT != nThreads; ++iT) {
+      if (selectors_[iT].size() != selectors_[0].size())
+        throw std::runtime_error("Inconsistent selectors among threads");
+    }
+  }
+
   // check all input exists
   for (auto&& pItr(paths_.begin()); pItr != paths_.end(); ++pItr) {
     TFile* source(0);
@@ -119,18 +237,50 @@ Skimmer::run(char const* _outputDir, char const* _sampleName, bool isData, long
   TString outputDir(_outputDir);
   TString sampleName(_sampleName);
 
-  std::ostream* stream(&std::cout);
-  std::ofstream debugFile;
-  if (printLevel_ > 0 && printLevel_ <= DEBUG) {
-    TString debugPath("debug_" + sampleName + ".txt");
-    debugFile.open(debugPath.Data());
-    stream = &debugFile;
+  std::vector<std::unique_ptr<SkimWorker>> workers;
+  for (unsigned iT(0); iT != nThreads; ++iT) {
+    workers.emplace_back(new SkimWorker);
+    if (nThreads > 1)
+      workers.back()->label = TString::Format("_part%u", iT);
   }
 
-  panda::Event event;
-  panda::GenParticleCollection genParticles("genParticles");
-  genParticles.data.parentContainer_ = &genParticles;
-  panda::EventMonophoton skimmedEvent;
+  // split the entry range into contiguous blocks, so the merged output keeps the input order
+  if (nThreads == 1) {
+    workers[0]->firstEntry = _firstEntry;
+    workers[0]->nEntries = _nEntries;
+  }
+  else {
+    TChain counter("events");
+    for (auto& path : paths_)
+      counter.Add(path);
+
+    long total(counter.GetEntries() - _firstEntry);
+    if (_nEntries >= 0 && _nEntries < total)
+      total = _nEntries;
+    if (total < 0)
+      total = 0;
+
+    long block((total + nThreads - 1) / nThreads);
+    for (unsigned iT(0); iT != nThreads; ++iT) {
+      long begin(iT * block);
+      long end(std::min(begin + block, total));
+      workers[iT]->firstEntry = _firstEntry + begin;
+      workers[iT]->nEntries = end > begin ? end - begin : 0;
+    }
+
+    ROOT::EnableThreadSafety();
+  }
+
+  for (unsigned iT(0); iT != nThreads; ++iT) {
+    auto& worker(*workers[iT]);
+    worker.selectors = &selectors_[iT];
+
+    if (printLevel_ > 0 && printLevel_ <= DEBUG) {
+      TString debugPath("debug_" + sampleName + worker.label + ".txt");
+      worker.debugFile.open(debugPath.Data());
+      worker.stream = &worker.debugFile;
+    }
+  }
 
   // will get updated by individual operators
   panda::utils::BranchList branchList = {
@@ -166,96 +316,230 @@ Skimmer::run(char const* _outputDir, char const* _sampleName, bool isData, long
   if (printLevel_ > 0 && printLevel_ <= DEBUG)
     branchList.setVerbosity(1);
 
-  TString commonSelection(selectors_[0]->getPreskim());
+  TString commonSelection(selectors_[0][0]->getPreskim());
 
-  for (auto* sel : selectors_) {
-    sel->setPrintLevel(printLevel_, stream);
+  for (auto& worker : workers) {
+    for (auto* sel : *worker->selectors) {
+      sel->setPrintLevel(printLevel_, worker->stream);
 
-    TString outputPath(outputDir + "/" + sampleName + "_" + sel->name() + ".root");
-    sel->initialize(outputPath, skimmedEvent, branchList, !isData);
+      TString outputPath(outputDir + "/" + sampleName + "_" + sel->name() + worker->label + ".root");
+      sel->initialize(outputPath, worker->skimmedEvent, branchList, !isData);
 
-    if (TString(sel->getPreskim()) != commonSelection) {
-      // this case is filtered out by ssw2.py
-      throw std::runtime_error("inconsistent preskims");
+      if (TString(sel->getPreskim()) != commonSelection) {
+        // this case is filtered out by ssw2.py
+        throw std::runtime_error("inconsistent preskims");
+      }
     }
+
+    // if the selectors register triggers, make sure the information is passed to the actual input event
+    worker->event.run = worker->skimmedEvent.run;
   }
 
-  // if the selectors register triggers, make sure the information is passed to the actual input event
-  event.run = skimmedEvent.run;
+  if (goodLumiFilter_) {
+    *workers[0]->stream << "Applying good lumi filter." << std::endl;
+    // each thread looks up its own copy
+    for (auto& worker : workers)
+      worker->goodLumiFilter.reset(new GoodLumiFilter(*goodLumiFilter_));
+  }
 
-  if (goodLumiFilter_)
-    *stream << "Applying good lumi filter." << std::endl;
+  if (commonSelection != "")
+    *workers[0]->stream << "Applying baseline selection \"" << commonSelection << "\"" << std::endl;
 
-  TChain preInput("events");
-  TChain mainInput("events");
-  TChain genInput("events");
-  int mainTreeNumber(-1);
+  // chains and formulas are set up in the main thread
+  for (auto& worker : workers) {
+    for (auto& path : paths_) {
+      worker->preInput.Add(path);
+      worker->mainInput.Add(path);
+      worker->genInput.Add(path);
+    }
+
+    if (commonSelection != "")
+      worker->preselection = new TTreeFormula("preselection", commonSelection, &worker->preInput);
+
+    worker->event.setStatus(worker->mainInput, branchList);
+    worker->event.setAddress(worker->mainInput, {"*"}, false);
 
-  for (auto& path : paths_) {
-    preInput.Add(path);
-    mainInput.Add(path);
-    genInput.Add(path);
+    worker->genInput.SetBranchStatus("*", false);
+    worker->genParticles.setAddress(worker->genInput);
+
+    worker->event.electrons.data.matchedGenContainer_ = &worker->genParticles;
+    worker->event.muons.data.matchedGenContainer_ = &worker->genParticles;
+    worker->event.taus.data.matchedGenContainer_ = &worker->genParticles;
+    worker->event.photons.data.matchedGenContainer_ = &worker->genParticles;
   }
 
-  TTreeFormula* preselection(0);
-  int preTreeNumber(-1);
-  if (commonSelection != "") {
-    *stream << "Applying baseline selection \"" << commonSelection << "\"" << std::endl;
+  auto start(SClock::now());
+
+  if (nThreads == 1)
+    runWorker_(*workers[0]);
+  else {
+    std::vector<std::thread> threads;
+    for (auto& worker : workers) {
+      SkimWorker* w(worker.get());
+      threads.emplace_back([this, w]() {
+          try {
+            this->runWorker_(*w);
+          }
+          catch (...) {
+            w->error = std::current_exception();
+          }
+        });
+    }
 
-    preselection = new TTreeFormula("preselection", commonSelection, &preInput);
+    for (auto& thread : threads)
+      thread.join();
   }
 
-  event.setStatus(mainInput, branchList);
-  event.setAddress(mainInput, {"*"}, false);
+  for (auto& worker : workers) {
+    delete worker->preselection;
+    worker->preselection = 0;
 
-  genInput.SetBranchStatus("*", false);
-  genParticles.setAddress(genInput);
+    for (auto* sel : *worker->selectors)
+      sel->finalize();
 
-  event.electrons.data.matchedGenContainer_ = &genParticles;
-  event.muons.data.matchedGenContainer_ = &genParticles;
-  event.taus.data.matchedGenContainer_ = &genParticles;
-  event.photons.data.matchedGenContainer_ = &genParticles;
+    if (worker->error)
+      std::rethrow_exception(worker->error);
+  }
+
+  // collect the preskim results; entry blocks are in order, so the lists stay sorted
+  preskimPassed_.clear();
+  for (auto& worker : workers) {
+    for (auto& tp : worker->preskimPassed) {
+      auto& entries(preskimPassed_[paths_[tp.first]]);
+      entries.insert(entries.end(), tp.second.begin(), tp.second.end());
+    }
+  }
+
+  if (nThreads > 1) {
+    // merge the per-thread outputs in the order of the entry blocks
+    for (auto* sel : selectors_[0]) {
+      TString outputPath(outputDir + "/" + sampleName + "_" + sel->name() + ".root");
+
+      TFileMerger merger(false, false);
+      merger.SetPrintLevel(0);
+      if (!merger.OutputFile(outputPath, "RECREATE"))
+        throw std::runtime_error(("Cannot open merge output " + outputPath).Data());
+
+      for (auto& worker : workers) {
+        TString partPath(outputDir + "/" + sampleName + "_" + sel->name() + worker->label + ".root");
+        if (!merger.AddFile(partPath, false))
+          throw std::runtime_error(("Cannot add merge input " + partPath).Data());
+      }
+
+      if (!merger.Merge())
+        throw std::runtime_error(("Failed to merge " + outputPath).Data());
+
+      for (auto& worker : workers)
+        gSystem->Unlink(outputDir + "/" + sampleName + "_" + sel->name() + worker->label + ".root");
+    }
+  }
+
+  if (printLevel_ > 0) {
+    auto now(SClock::now());
+    *workers[0]->stream << "Finished. Took " << std::chrono::duration_cast<std::chrono::seconds>(now - start).count() / 60. << " minutes in total. " << std::endl;
+  }
+
+  for (auto& worker : workers) {
+    if (worker->debugFile.is_open())
+      worker->debugFile.close();
+  }
+}
+
+void
+Skimmer::runWorker_(SkimWorker& _worker)
+{
+  auto& event(_worker.event);
+  auto& genParticles(_worker.genParticles);
+  auto& skimmedEvent(_worker.skimmedEvent);
+  auto& preInput(_worker.preInput);
+  auto& mainInput(_worker.mainInput);
+  auto& genInput(_worker.genInput);
+  auto* preselection(_worker.preselection);
+  auto* goodLumiFilter(_worker.goodLumiFilter.get());
+  auto& stream(*_worker.stream);
+  auto& debugFile(_worker.debugFile);
+  long const firstEntry(_worker.firstEntry);
+  long const nEntries(_worker.nEntries);
+
+  int mainTreeNumber(-1);
+  int preTreeNumber(-1);
+  std::vector<Long64_t> const* preskimIndex(0);
+  std::vector<Long64_t>* preskimPassed(0);
 
   auto now(SClock::now());
-  auto start(now);
 
   long iEntry(0);
-  while (iEntry++ != _nEntries) {
+  while (iEntry++ != nEntries) {
+    // jumps through the preskim index can go past the last entry
+    if (nEntries >= 0 && iEntry > nEntries)
+      break;
+
     if ((iEntry - 1) % printEvery_ == 0 && printLevel_ > 0) {
       auto past = now;
       now = SClock::now();
-      *stream << " " << iEntry << " (took " << std::chrono::duration_cast<std::chrono::milliseconds>(now - past).count() / 1000. << " s)" << std::endl;
+      stream << _worker.label << " " << iEntry << " (took " << std::chrono::duration_cast<std::chrono::milliseconds>(now - past).count() / 1000. << " s)" << std::endl;
     }
 
     if (preselection) {
-      if (preInput.LoadTree(_firstEntry + iEntry - 1) < 0)
+      long iGlobalEntry(firstEntry + iEntry - 1);
+      long iLocalEntry(preInput.LoadTree(iGlobalEntry));
+      if (iLocalEntry < 0)
         break;
 
       if (preTreeNumber != preInput.GetTreeNumber()) {
         preTreeNumber = preInput.GetTreeNumber();
         preselection->UpdateFormulaLeaves();
+
+        auto iItr(preskimIndex_.find(paths_[preTreeNumber]));
+        if (iItr == preskimIndex_.end()) {
+          preskimIndex = 0;
+          preskimPassed = &_worker.preskimPassed[preTreeNumber];
+        }
+        else {
+          preskimIndex = &iItr->second;
+          preskimPassed = 0;
+        }
       }
 
-      int nD(preselection->GetNdata());
-      int iD(0);
-      for (; iD != nD; ++iD) {
-        if (preselection->EvalInstance(iD) != 0.)
-          break;
+      if (preskimIndex) {
+        // jump to the next indexed entry, or to the beginning of the next tree
+        long treeStart(iGlobalEntry - iLocalEntry);
+        long next;
+        auto eItr(std::lower_bound(preskimIndex->begin(), preskimIndex->end(), iLocalEntry));
+        if (eItr == preskimIndex->end())
+          next = treeStart + preInput.GetTree()->GetEntries();
+        else
+          next = treeStart + *eItr;
+
+        if (next != iGlobalEntry) {
+          iEntry = next - firstEntry;
+          continue;
+        }
+      }
+      else {
+        int nD(preselection->GetNdata());
+        int iD(0);
+        for (; iD != nD; ++iD) {
+          if (preselection->EvalInstance(iD) != 0.)
+            break;
+        }
+        if (iD == nD)
+          continue;
+
+        preskimPassed->push_back(iLocalEntry);
       }
-      if (iD == nD)
-        continue;
     }
 
     try {
-      if (event.getEntry(mainInput, _firstEntry + iEntry - 1) <= 0)
+      if (event.getEntry(mainInput, firstEntry + iEntry - 1) <= 0)
         break;
     }
     catch (std::exception& _ex) {
-      *stream << "Error while processing " << mainInput.GetCurrentFile()->GetName() << std::endl;
+      stream << "Error while processing " << mainInput.GetCurrentFile()->GetName() << std::endl;
       throw;
     }
 
-    if (goodLumiFilter_ && !goodLumiFilter_->isGoodLumi(event.runNumber, event.lumiNumber))
+    if (goodLumiFilter && !goodLumiFilter->isGoodLumi(event.runNumber, event.lumiNumber))
       continue;
 
     if (mainTreeNumber != mainInput.GetTreeNumber()) {
@@ -265,7 +549,7 @@ Skimmer::run(char const* _outputDir, char const* _sampleName, bool isData, long
     }
 
     if (!event.isData) {
-      genParticles.getEntry(genInput, _firstEntry + iEntry - 1);
+      genParticles.getEntry(genInput, firstEntry + iEntry - 1);
       prepareEvent(event, skimmedEvent, &genParticles);
     }
     else
@@ -297,23 +581,9 @@ Skimmer::run(char const* _outputDir, char const* _sampleName, bool isData, long
       debugFile << ">>>>> Event " << iEntry << " done!!! <<<<<" << std::endl << std::endl;
     }
 
-    for (auto* sel : selectors_)
+    for (auto* sel : *_worker.selectors)
       sel->selectEvent(skimmedEvent);
   }
-
-  delete preselection;
-
-  for (auto* sel : selectors_)
-    sel->finalize();
-
-  if (printLevel_ > 0 && printLevel_ <= INFO) {
-    debugFile.close();
-  }
-
-  if (printLevel_ > 0) {
-    now = SClock::now();
-    *stream << "Finished. Took " << std::chrono::duration_cast<std::chrono::seconds>(now - start).count() / 60. << " minutes in total. " << std::endl;
-  }
 }
 
 void
@@ -1,38 +1,96 @@
 import os
 import sys
+import abc
 import time
+import shlex
+import shutil
+import tempfile
 import subprocess
+import multiprocessing
 
-class BatchManager(object):
-    def __init__(self, name):
-        self.name = name
+class Executor(object):
+    """
+    Interface of the batch backends. A task is a list of (job name, argument string) for one executable.
+    """
+
+    __metaclass__ = abc.ABCMeta
+
+    @abc.abstractmethod
+    def run(self, executable, name, jobs, options, noWait = False, autoResubmit = False, onComplete = None):
+        """
+        Run the jobs. Options is a dict of backend hints (requirements, aux_input). Unless noWait, block until all
+        jobs are finished and return the names of the failed jobs. If given, onComplete(job name, success) is
+        called from the waiting loop as each job finishes.
+        """
+
+        pass
+
+
+class CondorExecutor(Executor):
+    """
+    Submit to condor through condor-run and poll condor_q for completion. If condor_q fails maxQueryFailures
+    times in a row, the jobs not seen finishing are given up on and reported as failed.
+    """
+
+    maxQueryFailures = 30
+
+    def run(self, executable, name, jobs, options, noWait = False, autoResubmit = False, onComplete = None):
+        ## load condor-run
+        sys.path.append('/home/yiiyama/lib')
+        from condor_run import CondorRun
+
+        submitter = CondorRun(executable)
+        if 'requirements' in options:
+            submitter.requirements = options['requirements']
+        submitter.aux_input.extend(options.get('aux_input', []))
+
+        submitter.job_names = [jobName for jobName, _ in jobs]
+        submitter.job_args = [args for _, args in jobs]
 
-    def _submit(self, submitter, task, argTemplate, noWait = False, autoResubmit = False):
         submitter.logdir = '/local/' + os.environ['USER']
         submitter.hold_on_fail = True
 #        submitter.group = 'group_t3mit.urgent'
         submitter.min_memory = 1
 
-        clusterId = submitter.submit(name = self.name)
+        clusterId = submitter.submit(name = name)
 
-        if not noWait:
-            self._waitForCompletion(task, clusterId, argTemplate, autoResubmit)
+        if noWait:
+            return []
 
-    def _waitForCompletion(self, jobType, clusterId, argTemplate, autoResubmit):
-        print 'Waiting for all jobs to complete.'
+        return self._waitForCompletion(clusterId, [jobName for jobName, _ in jobs], autoResubmit, onComplete)
 
-        # indices of arguments to pick up from condor_q output lines
-        argsToExtract = []
-        for ia, a in enumerate(argTemplate.split()):
-            if a == '%s':
-                argsToExtract.append(ia)
+    def _waitForCompletion(self, clusterId, jobNames, autoResubmit, onComplete = None):
+        print 'Waiting for all jobs to complete.'
 
         heldJobs = []
+        # ProcIds not yet finished or held
+        remaining = set(range(len(jobNames)))
+
+        queryFailures = 0
 
         while True:
-            proc = subprocess.Popen(['condor_q', str(clusterId), '-af', 'ProcId', 'JobStatus', 'Arguments'], stdout = subprocess.PIPE, stderr = subprocess.PIPE)
+            proc = subprocess.Popen(['condor_q', str(clusterId), '-af', 'ProcId', 'JobStatus'], stdout = subprocess.PIPE, stderr = subprocess.PIPE)
             out, err = proc.communicate()
+            if proc.returncode != 0:
+                # an empty answer from a failed query would look like all jobs finished
+                queryFailures += 1
+                if queryFailures < self.maxQueryFailures:
+                    time.sleep(10)
+                    continue
+
+                sys.stdout.write('\n')
+                print 'condor_q failed %d times in a row (%s). Giving up on %d jobs.' % (queryFailures, err.strip(), len(remaining))
+                for procId in sorted(remaining):
+                    heldJobs.append(jobNames[procId])
+                    if onComplete is not None:
+                        onComplete(jobNames[procId], False)
+
+                return heldJobs
+
+            queryFailures = 0
+
             lines = out.split('\n')
+            inQueue = set()
 
             newline = False
 
@@ -40,13 +98,16 @@ class BatchManager(object):
             for line in lines:
                 if line.strip() == '':
                     continue
-    
+
                 words = line.split()
-    
+
                 procId, jobStatus = words[:2]
+                inQueue.add(int(procId))
+
                 if jobStatus == '5':
-                    args = tuple(words[3 + i] for i in argsToExtract)
-                    if args in heldJobs:
+                    # job names are in the order of ProcIds
+                    jobName = jobNames[int(procId)]
+                    if jobName in heldJobs:
                         continue
 
                     if newline:
@@ -54,7 +115,7 @@ class BatchManager(object):
                         sys.stdout.flush()
                         newline = False
 
-                    print 'Job %s is held' % str(args)
+                    print 'Job %s is held' % jobName
 
                     if autoResubmit:
                         print ' Resubmitting.'
@@ -64,19 +125,148 @@ class BatchManager(object):
                         print err.strip()
                         jobsInQueue += 1
                     else:
-                        heldJobs.append(args)
+                        heldJobs.append(jobName)
+                        remaining.discard(int(procId))
+                        if onComplete is not None:
+                            onComplete(jobName, False)
 
                 else:
                     jobsInQueue += 1
 
+            # jobs that left the queue are done; the caller checks their outputs
+            for procId in sorted(remaining - inQueue):
+                remaining.discard(procId)
+                if onComplete is not None:
+                    onComplete(jobNames[procId], True)
+
             sys.stdout.write('\r %d jobs in queue.' % jobsInQueue)
             sys.stdout.flush()
             newline = True
 
             if jobsInQueue == 0:
                 break
-    
+
             time.sleep(10)
 
-sys.stdout.write('\n')
-sys.stdout.flush()
+        sys.stdout.write('\n')
+        sys.stdout.flush()
+
+        return heldJobs
+
+
+def _runLocalJob(job):
+    """
+    Run one job of LocalExecutor in a subprocess, retrying on failure. Return (job name, attempts, exit code, log path).
+    Each attempt runs in a fresh working directory holding copies of the auxiliary inputs, removed afterwards.
+    """
+
+    executable, jobName, args, auxInput, logDir, maxAttempts = job
+
+    for attempt in range(maxAttempts):
+        logPath = '%s/%s.%d.log' % (logDir, jobName, attempt)
+
+        workDir = tempfile.mkdtemp(prefix = jobName + '.')
+        try:
+            for path in auxInput:
+                shutil.copy(path, workDir)
+
+            with open(logPath, 'w') as log:
+                proc = subprocess.Popen([sys.executable, executable] + shlex.split(args), stdout = log, stderr = subprocess.STDOUT, cwd = workDir)
+                returncode = proc.wait()
+        finally:
+            shutil.rmtree(workDir, ignore_errors = True)
+
+        if returncode == 0:
+            break
+
+    return jobName, attempt + 1, returncode, logPath
+
+
+class LocalExecutor(Executor):
+    """
+    Run the jobs as subprocesses on this machine, nproc at a time. Each attempt of a job writes its output to
+    logDir/(job name).(attempt).log. With autoResubmit, failed jobs are retried up to retries times.
+    """
+
+    def __init__(self, nproc = multiprocessing.cpu_count(), retries = 2):
+        self.nproc = nproc
+        self.retries = retries
+
+    def run(self, executable, name, jobs, options, noWait = False, autoResubmit = False, onComplete = None):
+        if noWait:
+            print 'Local jobs run in this process; waiting for completion.'
+
+        if os.path.isdir('/local/' + os.environ['USER']):
+            logDir = '/local/' + os.environ['USER'] + '/' + name
+        else:
+            logDir = '/tmp/' + os.environ['USER'] + '/' + name
+
+        try:
+            os.makedirs(logDir)
+        except OSError:
+            pass
+
+        # auxiliary inputs appear in the working directory of each job, as with condor
+        auxInput = list(options.get('aux_input', []))
+
+        if autoResubmit:
+            maxAttempts = self.retries + 1
+        else:
+            maxAttempts = 1
+
+        tasks = [(executable, jobName, args, auxInput, logDir, maxAttempts) for jobName, args in jobs]
+
+        print 'Running %d jobs in %d local processes. Logs in %s.' % (len(tasks), self.nproc, logDir)
+
+        failed = []
+        ndone = 0
+
+        pool = multiprocessing.Pool(max(1, min(self.nproc, len(tasks))))
+        try:
+            # progress is reported as each job finishes
+            for jobName, attempts, returncode, logPath in pool.imap_unordered(_runLocalJob, tasks):
+                ndone += 1
+
+                if returncode != 0:
+                    failed.append(jobName)
+                    sys.stdout.write('\n')
+                    print 'Job %s failed with exit code %d after %d attempt(s). See %s' % (jobName, returncode, attempts, logPath)
+                elif attempts > 1:
+                    sys.stdout.write('\n')
+                    print 'Job %s succeeded at attempt %d' % (jobName, attempts)
+
+                sys.stdout.write('\r %d/%d jobs finished, %d failed.' % (ndone, len(tasks), len(failed)))
+                sys.stdout.flush()
+
+                if onComplete is not None:
+                    onComplete(jobName, returncode == 0)
+
+        finally:
+            pool.close()
+            pool.join()
+
+        sys.stdout.write('\n')
+        sys.stdout.flush()
+
+        return failed
+
+
+class BatchManager(object):
+    def __init__(self, name, executor = None):
+        self.name = name
+        if executor is None:
+            self.executor = CondorExecutor()
+        else:
+            self.executor = executor
+
+    def _submit(self, executable, jobs, options = {}, noWait = False, autoResubmit = False, onComplete = None):
+        """
+        Run the list of (job name, argument string) with the executor.
+        """
+
+        failed = self.executor.run(executable, self.name, jobs, options, noWait = noWait, autoResubmit = autoResubmit, onComplete = onComplete)
+
+        if len(failed) != 0:
+            print '%d jobs did not complete:' % len(failed), ' '.join(failed)
+
+        return failed
@@ -11,16 +11,23 @@ sys.path.append(basedir)
 from datasets import allsamples
 import config
 import utils
+import eventindex
+import datasets
+sys.path.append(os.path.dirname(basedir) + '/common')
+import cutflowengine
 
 argParser = ArgumentParser(description = 'Print cut flow')
 argParser.add_argument('region', metavar = 'REGION', help = 'Control/signal region name.')
 argParser.add_argument('snames', metavar = 'SAMPLE', nargs = '+', help = 'Sample names.')
 argParser.add_argument('--events', '-E', action = 'store_true', dest = 'eventList', help = 'Print list of events instead of cutflow.')
 argParser.add_argument('--skim-dir', '-s', metavar = 'PATH', dest = 'skimDir', default = config.skimDir, help = 'Directory of skim files to read from.')
-argParser.add_argument('--flow', '-f', metavar = 'CUTS', nargs = '+', dest = 'cutflow', help = 'Cutflow. Can be "all" for --cut-results')
+argParser.add_argument('--flow', '-f', metavar = 'CUTS', nargs = '+', dest = 'cutflow', help = 'Cutflow. Can be "all" to use every decision branch.')
 argParser.add_argument('--cut-results', '-r', metavar = 'EVENTID', nargs = '+', dest = 'eventIds', help = 'Show results of the cuts on a specific event.')
 argParser.add_argument('--out', '-o', metavar = 'PATH', dest = 'outName', default = '', help = 'Output file name. Use "-" for stdout.')
 argParser.add_argument('--uw-format', '-U', action = 'store_true', dest = 'uwFormat', help = 'Print event list in run:event:lumi format.')
+argParser.add_argument('--n-minus-one', '-n', action = 'store_true', dest = 'nMinusOne', help = 'Also print the number of events passing all cuts but one.')
+argParser.add_argument('--by-sample', '-b', action = 'store_true', dest = 'bySample', help = 'Also print the cut flow of each sample.')
+argParser.add_argument('--jobs', '-j', metavar = 'N', dest = 'jobs', type = int, default = 1, help = 'Number of processes counting the original files with --skim-dir.')
 
 args = argParser.parse_args()
 sys.argv = []
@@ -30,9 +37,10 @@ ROOT.gROOT.SetBatch(True)
 
 data = False
 
-ntotal = 0
+ntotals = {} # {sample name: number of events before the skim}
 
 sampleNames = []
+filePaths = [] # [(sample name, skim path)]
 
 tree = ROOT.TChain('cutflow')
 for sample in allsamples.getmany(args.snames):
@@ -43,26 +51,22 @@ for sample in allsamples.getmany(args.snames):
 
     if args.skimDir == config.skimDir:
         # default skim directory -> assume nevents in DB is accurate
-        ntotal += sample.nevents
+        ntotals[sample.name] = sample.nevents
 
         filePath = utils.getSkimPath(sample.name, args.region)
 
     else:
-        # otherwise open the original files
-        for fname in sample.files():
-            source = ROOT.TFile.Open(fname)
-            counter = source.Get('counter')
-            if not counter:
-                source.Close()
-                continue
-    
-            ntotal += counter.GetBinContent(1)
-            source.Close()
+        # otherwise count the original files (counts are cached per file)
+        counts = datasets.countFiles(sample.files(), jobs = args.jobs)
+        ntotals[sample.name] = sum(nevents for nevents, _, _ in counts.values())
 
         filePath = args.skimDir + '/' + sample.name + '_' + args.region + '.root'
 
     print filePath
     tree.Add(filePath)
+    filePaths.append((sample.name, filePath))
+
+ntotal = sum(ntotals.values())
 
 if args.cutflow is None:
     if data:
@@ -123,6 +127,13 @@ else:
         cuts = tuple(cutstr.split(','))
         cutflow.append(cuts)
 
+if len(cutflow) != 0 and cutflow[0][0] == 'all':
+    cutflow = []
+    tree.LoadTree(0)
+    for branch in tree.GetListOfBranches():
+        if branch.GetName() not in cutflowengine.ID_BRANCHES:
+            cutflow.append((branch.GetName(),))
+
 if args.eventList:
     run = array.array('I', [0])
     lumi = array.array('I', [0])
@@ -184,10 +195,6 @@ elif args.eventIds is not None:
     lumi = array.array('I', [0])
     event = array.array('I', [0])
     
-    tree.SetBranchAddress('runNumber', run)
-    tree.SetBranchAddress('lumiNumber', lumi)
-    tree.SetBranchAddress('eventNumber', event)
-
     eventIds = []
     for sid in args.eventIds:
         if args.uwFormat:
@@ -200,38 +207,19 @@ elif args.eventIds is not None:
 
         eventIds.append((r, l, e))
 
-    if cutflow[0][0] == 'all':
-        cutflow = []
-        tree.LoadTree(0)
-        for branch in tree.GetListOfBranches():
-            if branch.GetName() != 'runNumber' and branch.GetName() != 'lumiNumber' and branch.GetName() != 'eventNumber':
-                cutflow.append((branch.GetName(),))
-
     results = {}
     for cuts in cutflow:
         for cut in cuts:
-            bit = array.array('B', [0])
-            tree.SetBranchAddress(cut, bit)
-            results[cut] = bit
+            results[cut] = array.array('B', [0])
 
-    sels = []
-    for eventId in eventIds:
-        sels.append('(runNumber == %d && lumiNumber == %d && eventNumber == %d)' % eventId)
-
-    tree.Draw('>>elist', ' || '.join(sels), 'entrylist')
-    elist = ROOT.gDirectory.Get('elist')
-
-    if elist.GetN() == 0:
-        print 'No event found:', eventIds
-        sys.exit(1)
-
-    outputLines = []
-
-    tree.SetEntryList(elist)
-    for iL in range(elist.GetN()):
-        iEntry = tree.GetEntryNumber(iL)
-        tree.GetEntry(iEntry)
+    def setAddresses(tree):
+        tree.SetBranchAddress('runNumber', run)
+        tree.SetBranchAddress('lumiNumber', lumi)
+        tree.SetBranchAddress('eventNumber', event)
+        for cut, bit in results.items():
+            tree.SetBranchAddress(cut, bit)
 
+    def printResults():
         outputLines.append('=== %d:%d:%d ===' % (run[0], lumi[0], event[0]))
        
         for cuts in cutflow:
@@ -241,34 +229,165 @@ elif args.eventIds is not None:
     
             outputLines.append('%s: %d' % (' && '.join(cuts), result))
 
+    outputLines = []
+
+    # use the event indices of the skims (eventindex.py --region) if all samples have an up-to-date one
+    located = None
+    if args.skimDir == config.skimDir:
+        located = {}
+        for sname in sampleNames:
+            index = eventindex.load(sname + '_' + args.region)
+            if index is None or index.treeName != 'cutflow':
+                located = None
+                break
+
+            found, _ = index.find(eventIds)
+            if len(index.stale(found.keys())) != 0:
+                located = None
+                break
+
+            located.update(found)
+
+    if located is not None:
+        if len(located) == 0:
+            print 'No event found:', eventIds
+            sys.exit(1)
+
+        for path, entries in sorted(located.items()):
+            source = ROOT.TFile.Open(path)
+            cutTree = source.Get('cutflow')
+            setAddresses(cutTree)
+
+            for _, iEntry in entries:
+                cutTree.GetEntry(iEntry)
+                printResults()
+
+            source.Close()
+
+    else:
+        setAddresses(tree)
+
+        sels = []
+        for eventId in eventIds:
+            sels.append('(runNumber == %d && lumiNumber == %d && eventNumber == %d)' % eventId)
+    
+        tree.Draw('>>elist', ' || '.join(sels), 'entrylist')
+        elist = ROOT.gDirectory.Get('elist')
+    
+        if elist.GetN() == 0:
+            print 'No event found:', eventIds
+            sys.exit(1)
+    
+        tree.SetEntryList(elist)
+        for iL in range(elist.GetN()):
+            iEntry = tree.GetEntryNumber(iL)
+            tree.GetEntry(iEntry)
+
+            printResults()
+
     if not args.outName:
         args.outName = '-'
 
 else:
-    def formLine(title, ncut, nprev):
+    def formLine(title, ncut, nprev, ntotal):
         return "%40s %15d %15.4f %15.4e %15.1e" % (title, ncut, float(ncut) / nprev, float(ncut) / ntotal, ROOT.TEfficiency.ClopperPearson(ntotal, ncut, 0.6826895, True) - float(ncut) / ntotal)
 
-    outputLines = []
+    def flowLines(ntotal, nskim, counts):
+        lines = []
+        lines.append('%40s %15s %15s %15s %15s' % ('Cut', 'Events', 'Events/Prev.', 'Events/Total', 'Stat.'))
+        lines.append(formLine('Total', ntotal, ntotal, ntotal))
+        lines.append(formLine('PhotonSkim', nskim, ntotal, ntotal))
 
-    outputLines.append('%40s %15s %15s %15s %15s' % ('Cut', 'Events', 'Events/Prev.', 'Events/Total', 'Stat.'))
+        prev = nskim
+        for icut, (cuts, nevt) in enumerate(zip(cutflow, counts)):
+            name = ' && '.join(cuts)
+            if icut != 0:
+                name = ' && ' + name
 
-    outputLines.append(formLine('Total', ntotal, ntotal))
+            lines.append(formLine(name, nevt, prev, ntotal))
+            prev = nevt
 
-    nevt = tree.GetEntries()
-    outputLines.append(formLine('PhotonSkim', nevt, ntotal))
+        return lines
 
-    expr = ''
-    for cuts in cutflow:
-        if expr == '':
-            name = ' && '.join(cuts)
-            expr = name
-        else:
-            name = ' && ' + ' && '.join(cuts)
-            expr += name
-    
-        prev = nevt
-        nevt = tree.GetEntries(expr)
-        outputLines.append(formLine(name, nevt, prev))
+    useEngine = cutflowengine.numpy is not None
+
+    if useEngine:
+        # decision bits are read once per skim file and cached
+        engine = cutflowengine.CutflowEngine(config.columnCacheDir + '/cutflow')
+        for sname, filePath in filePaths:
+            engine.addInputPath(filePath, sname)
+
+        branches = set(engine.branches())
+        expressions = [cut for cuts in cutflow for cut in cuts if cut not in branches]
+        if len(expressions) != 0:
+            # cuts that are not decision branches are evaluated by TTree::GetEntries
+            print 'Not decision branches, counting with TTree::GetEntries:', ' '.join(expressions)
+            useEngine = False
+
+    if useEngine:
+        def countFlow(sname = None):
+            return engine.flow(cutflow, sname)
+
+        def countTotal(sname = None):
+            return engine.total(sname)
+
+        def countNMinusOne():
+            return engine.nMinusOne(cutflow)
+
+    else:
+        sampleTrees = {}
+        if args.bySample:
+            for sname, filePath in filePaths:
+                sampleTrees[sname] = ROOT.TChain('cutflow')
+                sampleTrees[sname].Add(filePath)
+
+        def conjunction(cuts):
+            # cuts can be expressions with || or ?:
+            return ' && '.join('(%s)' % cut for cut in cuts)
+
+        def selectTree(sname):
+            if sname is None:
+                return tree
+            else:
+                return sampleTrees[sname]
+
+        def countFlow(sname = None):
+            counts = []
+            for icut in range(len(cutflow)):
+                counts.append(selectTree(sname).GetEntries(conjunction(sum(cutflow[:icut + 1], ()))))
+
+            return counts
+
+        def countTotal(sname = None):
+            return selectTree(sname).GetEntries()
+
+        def countNMinusOne():
+            counts = []
+            for icut in range(len(cutflow)):
+                others = sum([cuts for jcut, cuts in enumerate(cutflow) if jcut != icut], ())
+                if len(others) == 0:
+                    counts.append(tree.GetEntries())
+                else:
+                    counts.append(tree.GetEntries(conjunction(others)))
+
+            return counts
+
+    counts = countFlow()
+    outputLines = flowLines(ntotal, countTotal(), counts)
+
+    if args.bySample and len(sampleNames) > 1:
+        for sname in sampleNames:
+            outputLines.append('')
+            outputLines.append('=== %s ===' % sname)
+            outputLines.extend(flowLines(ntotals[sname], countTotal(sname), countFlow(sname)))
+
+    if args.nMinusOne and len(cutflow) != 0:
+        nfinal = counts[-1]
+
+        outputLines.append('')
+        outputLines.append('%40s %15s %15s' % ('N-1', 'Events', 'Eff.'))
+        for cuts, nevt in zip(cutflow, countNMinusOne()):
+            outputLines.append('%40s %15d %15.4f' % (' && '.join(cuts), nevt, float(nfinal) / nevt if nevt != 0 else 0.))
 
     if args.outName == '':
         args.outName = 'cutflow_' + args.region + '_' + '+'.join(sampleNames) + '.list'
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+
+"""
+Stand-in for the combine executable, for testing ModelScan.py without a CMSSW + combine installation.
+Accepts the combine command line (combine -M Asymptotic CARD [-n NAME] [-m MASS]) and writes
+higgsCombine{NAME}.{METHOD}.mH{MASS}.root with the limit tree in the current directory.
+The observed limit is read from the environment variable LIMITSTANDIN_R (default 1) and the expected
+quantiles are fixed fractions of it.
+"""
+
+import os
+import sys
+import array
+from argparse import ArgumentParser
+
+argParser = ArgumentParser(description = 'Stand-in limit tool')
+argParser.add_argument('card', metavar = 'PATH', help = 'Data card.')
+argParser.add_argument('--method', '-M', metavar = 'METHOD', dest = 'method', default = 'Asymptotic', help = 'Limit method.')
+argParser.add_argument('--name', '-n', metavar = 'NAME', dest = 'name', default = 'Test', help = 'Output name.')
+argParser.add_argument('--mass', '-m', metavar = 'MASS', dest = 'mass', default = '120', help = 'Mass hypothesis.')
+
+args = argParser.parse_args()
+sys.argv = []
+
+if not os.path.exists(args.card):
+    print 'Card', args.card, 'not found'
+    sys.exit(1)
+
+import ROOT
+
+robs = float(os.environ.get('LIMITSTANDIN_R', '1.'))
+
+# quantileExpected: limit / observed
+quantiles = [(0.025, 0.5), (0.16, 0.7), (0.5, 1.), (0.84, 1.4), (0.975, 1.9), (-1., 1.)]
+
+outFile = ROOT.TFile.Open('higgsCombine%s.%s.mH%s.root' % (args.name, args.method, args.mass), 'recreate')
+
+limit = array.array('d', [0.])
+quantileExpected = array.array('f', [0.])
+
+tree = ROOT.TTree('limit', 'limit')
+tree.Branch('limit', limit, 'limit/D')
+tree.Branch('quantileExpected', quantileExpected, 'quantileExpected/F')
+
+for quantile, scale in quantiles:
+    limit[0] = robs * scale
+    quantileExpected[0] = quantile
+    tree.Fill()
+
+outFile.cd()
+tree.Write()
+outFile.Close()
+
+print ' -- Asymptotic -- '
+print 'Observed Limit: r < %.4f' % robs
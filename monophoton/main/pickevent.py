@@ -5,11 +5,7 @@ import os
 import re
 import tempfile
 
-from batch import BatchManager
-
-## load condor-run
-sys.path.append('/home/yiiyama/lib')
-from condor_run import CondorRun
+from batch import BatchManager, LocalExecutor
 
 logger = None
 
@@ -32,6 +28,7 @@ class PickEvent(object):
         self.outDir = PickEvent.config['outDir'] + '/' + sample.name
 
         self.eventIds = []
+        self.entries = None # {path: [(event ID, entry)]} if the events were located through the event index
 
     def setupSkim(self):
         """
@@ -67,6 +64,31 @@ class PickEvent(object):
                     else:
                         self.eventIds.append((int(matches.group(1)), int(matches.group(2)), int(matches.group(3))))
 
+    def lookupIndex(self):
+        """
+        Locate the events in the event index of the sample. Return False if the sample has no index or any of the
+        files holding the events changed since indexing.
+        """
+
+        index = eventindex.load(self.sample.name)
+        if index is None:
+            logger.debug('No event index for %s', self.sample.name)
+            return False
+
+        located, missing = index.find(self.eventIds)
+
+        stale = index.stale(located.keys())
+        if len(stale) != 0:
+            logger.warning('Event index for %s is out of date (%s changed). Scanning the files.', self.sample.name, stale[0])
+            return False
+
+        for eventId in missing:
+            logger.info('%d:%d:%d is not in %s', eventId[0], eventId[1], eventId[2], self.sample.name)
+
+        self.entries = located
+
+        return True
+
     def executeSkim(self):
         """
         Execute the skim.
@@ -76,7 +98,40 @@ class PickEvent(object):
     
         skimmer.setPrintEvery(PickEvent.config['printEvery'])
         skimmer.setPrintLevel(PickEvent.config['printLevel'])
-    
+
+        tmpDir = tempfile.mkdtemp()
+
+        if self.entries is not None:
+            for path, entries in self.entries.items():
+                for eventId, entry in entries:
+                    logger.debug('Add entry: %s %d', path, entry)
+                    skimmer.addEntry(path, entry)
+
+            logger.debug('Skimmer.runEntries(%s)', tmpDir)
+            skimmer.runEntries(tmpDir)
+
+        else:
+            self.scan(skimmer, tmpDir)
+
+        for eventId in self.eventIds:
+            tmpName = tmpDir + ('/%d_%d_%d.root' % eventId)
+            logger.debug('Checking output ' + tmpName)
+            if not os.path.exists(tmpName):
+                continue
+
+            outName = self.outDir + ('/%d_%d_%d.root' % eventId)
+
+            logger.info('Copying output to %s', outName)
+            shutil.copy(tmpName, outName)
+
+        logger.info('Removing %s', tmpDir)
+        shutil.rmtree(tmpDir)
+
+    def scan(self, skimmer, tmpDir):
+        """
+        Run the skimmer over all input files.
+        """
+
         if self.manual:
             for path in self.files:
                 skimmer.addPath(path)
@@ -93,37 +148,19 @@ class PickEvent(object):
         for eventId in self.eventIds:
             skimmer.addEvent(*eventId)
 
-        tmpDir = tempfile.mkdtemp()
-
         logger.debug('Skimmer.run(%s, %d)', tmpDir, PickEvent.config['nentries'])
         skimmer.run(tmpDir, PickEvent.config['nentries'])
 
-        for eventId in self.eventIds:
-            tmpName = tmpDir + ('/%d_%d_%d.root' % eventId)
-            logger.debug('Checking output ' + tmpName)
-            if not os.path.exists(tmpName):
-                continue
-
-            outName = self.outDir + ('/%d_%d_%d.root' % eventId)
-
-            logger.info('Copying output to %s', outName)
-            shutil.copy(tmpName, outName)
-
-        logger.info('Removing %s', tmpDir)
-        shutil.rmtree(tmpDir)
-
 
 class PickEventBatchManager(BatchManager):
-    def __init__(self, pickers, skipMissing, readRemote):
-        BatchManager.__init__(self, 'pickevent')
+    def __init__(self, pickers, skipMissing, readRemote, executor = None):
+        BatchManager.__init__(self, 'pickevent', executor)
 
         self.pickers = pickers # list of SlimSkimWeight objects to manage
         self.skipMissing = skipMissing
         self.readRemote = readRemote
 
     def submitSkim(self, noWait, autoResubmit = False):
-        submitter = CondorRun(os.path.realpath(__file__))
-
         argTemplate = '%s -f %s'
     
         if self.skipMissing:
@@ -132,6 +169,9 @@ class PickEventBatchManager(BatchManager):
         if self.readRemote:
             argTemplate += ' -R'
 
+        jobs = []
+        auxInput = []
+
         for picker in self.pickers:
             eventList = tempfile.NamedTemporaryFile(delete = False)
             for eventId in picker.eventIds:
@@ -143,11 +183,10 @@ class PickEventBatchManager(BatchManager):
             # event list will appear in the pwd of the job
             argTemp = argTemplate + ' -l ' + os.path.basename(listName)
 
-            submitter.aux_input.append(listName)
+            auxInput.append(listName)
 
             for fileset in picker.filesets:
-                submitter.job_args.append(argTemp % (picker.sample.name, fileset))
-                submitter.job_names.append('%s_%s' % (picker.sample.name, fileset))
+                jobs.append(('%s_%s' % (picker.sample.name, fileset), argTemp % (picker.sample.name, fileset)))
     
                 # clean up old .log files
                 logpath = '/local/' + os.environ['USER'] + '/ssw2/' + picker.sample.name + '_' + fileset + '.0.log'
@@ -157,7 +196,7 @@ class PickEventBatchManager(BatchManager):
                 except:
                     pass
 
-        self._submit(submitter, 'skim', argTemplate, noWait, autoResubmit)
+        return self._submit(os.path.realpath(__file__), jobs, {'aux_input': auxInput}, noWait, autoResubmit)
 
 
 if __name__ == '__main__':
@@ -176,6 +215,7 @@ if __name__ == '__main__':
     argParser.add_argument('--filesets', '-f', metavar = 'ID', dest = 'filesets', nargs = '+', default = [], help = 'Fileset id to run on.')
     argParser.add_argument('--files', '-i', metavar = 'PATH', dest = 'files', nargs = '+', default = [], help = 'Directly run on files.')
     argParser.add_argument('--batch', '-B', action = 'store_true', dest = 'batch', help = 'Use condor-run to run.')
+    argParser.add_argument('--local-jobs', '-J', metavar = 'N', dest = 'localJobs', type = int, default = 0, help = '(With batch option) Run the jobs in N processes on this machine instead of condor.')
     argParser.add_argument('--nentries', '-N', metavar = 'N', dest = 'nentries', type = int, default = -1, help = 'Maximum number of entries.')
     argParser.add_argument('--no-wait', '-W', action = 'store_true', dest = 'noWait', help = '(With batch option) Don\'t wait for job completion.')
     argParser.add_argument('--print-every', '-e', metavar = 'NEVENTS', dest = 'printEvery', type = int, default = 10000, help = 'Print frequency.')
@@ -184,6 +224,7 @@ if __name__ == '__main__':
     argParser.add_argument('--resubmit', '-S', action = 'store_true', dest = 'autoResubmit', help = '(Without no-wait option) Automatically release held jobs.')
     argParser.add_argument('--skip-missing', '-K', action = 'store_true', dest = 'skipMissing', help = 'Skip missing files in skim.')
     argParser.add_argument('--uw-format', '-U', action = 'store_true', dest = 'uwFormat', help = 'Print event list in run:event:lumi format.')
+    argParser.add_argument('--no-index', '-X', action = 'store_true', dest = 'noIndex', help = 'Scan the input files even if the sample has an event index.')
     
     args = argParser.parse_args()
     sys.argv = []
@@ -222,6 +263,7 @@ if __name__ == '__main__':
     ## import the monophoton config
     sys.path.append(basedir)
     import config
+    import eventindex
 
     ## set up logger
     printLevel = getattr(logging, args.printLevel.upper())
@@ -287,25 +329,38 @@ if __name__ == '__main__':
         for eventList in args.eventLists:
             picker.readEventList(eventList, args.uwFormat)
 
+        if not args.noIndex and not files and len(args.filesets) == 0 and args.nentries < 0:
+            picker.lookupIndex()
+
         pickers.append(picker)
 
     if args.batch:
+        # samples located through the index are picked locally
+        for picker in pickers:
+            if picker.entries is not None:
+                print 'Picking events of', picker.sample.name, 'from the event index.'
+                picker.executeSkim()
+
+        pickers = [picker for picker in pickers if picker.entries is None]
+
+    if args.batch and len(pickers) != 0:
         ## job submission only
         print 'Submitting jobs.'
 
-        ## load condor-run
-        sys.path.append('/home/yiiyama/lib')
-        from condor_run import CondorRun
+        if args.localJobs > 0:
+            executor = LocalExecutor(args.localJobs)
+        else:
+            executor = None
 
-        batchManager = PickEventBatchManager(pickers, args.skipMissing, args.readRemote)
+        batchManager = PickEventBatchManager(pickers, args.skipMissing, args.readRemote, executor)
         batchManager.submitSkim(args.noWait, args.autoResubmit)
 
-        if args.noWait:
+        if args.noWait and args.localJobs == 0:
             print 'Jobs have been submitted.'
         else:
             print 'All jobs finished.'
 
-    else:
+    elif not args.batch:
         print 'Picking events.'
         for picker in pickers:
             picker.executeSkim()
@@ -6,14 +6,81 @@ import os
 import math
 import re
 import collections
+import hashlib
 
 import ROOT
 
-def makePlotter(sourceName, plotConfig, group, sample, lumi, printLevel):
-    global ROOT
-    plotter = ROOT.MultiDraw()
-    plotter.addInputPath(sourceName)
+class FillPass(object):
+    """
+    One MultiDraw pass over a single skim file. The plots are recorded as MultiDraw.addPlot arguments
+    so that the pass can be executed either in this process or in a worker process (see runPasses).
+    """
+
+    def __init__(self, name, sourceName, baseSel = '', fullSel = '', constWeight = None, prescale = 1):
+        self.name = name
+        self.sourceName = sourceName
+        self.baseSel = baseSel
+        self.fullSel = fullSel
+        self.constWeight = constWeight
+        self.prescale = prescale
+        self.plots = [] # [(hist, expr, cut, applyBaseline, applyFullSel, reweight, overflowMode)]
+
+    # set to a directory path to fill with the columnar backend (common/columndraw.py) instead of MultiDraw
+    columnCacheDir = ''
+
+    def addPlot(self, hist, expr, cut, applyBaseline, applyFullSel, reweight, overflowMode):
+        self.plots.append((hist, expr, cut, applyBaseline, applyFullSel, reweight, overflowMode))
+
+    def hists(self):
+        return [plot[0] for plot in self.plots]
+
+    def subset(self, indices):
+        """
+        Return a pass over the same source with only the plots at the given indices.
+        """
+
+        fillPass = FillPass(self.name, self.sourceName, baseSel = self.baseSel, fullSel = self.fullSel, constWeight = self.constWeight, prescale = self.prescale)
+        fillPass.plots = [self.plots[i] for i in indices]
+
+        return fillPass
+
+    def fill(self, printLevel = 0, hists = None):
+        """
+        Run the MultiDraw. If hists is given, fill them instead of the recorded histograms.
+        """
+
+        if len(self.plots) == 0:
+            return
+
+        if hists is None:
+            hists = self.hists()
 
+        if FillPass.columnCacheDir:
+            from columndraw import ColumnDraw
+            plotter = ColumnDraw(FillPass.columnCacheDir)
+        else:
+            plotter = ROOT.MultiDraw()
+
+        plotter.addInputPath(self.sourceName)
+        plotter.setBaseSelection(self.baseSel)
+        plotter.setFullSelection(self.fullSel)
+
+        if self.constWeight is not None:
+            plotter.setConstantWeight(self.constWeight)
+
+        if self.prescale != 1:
+            plotter.setPrescale(self.prescale)
+
+        plotter.setPrintLevel(printLevel)
+
+        for hist, plot in zip(hists, self.plots):
+            plotter.addPlot(hist, *plot[1:])
+
+        if plotter.numObjs() != 0:
+            plotter.fillPlots()
+
+
+def makeFillPass(name, sourceName, plotConfig, group, sample, lumi, printLevel):
     cuts = []
     if plotConfig.baseline.strip():
         if group.altbaseline.strip():
@@ -27,42 +94,239 @@ def makePlotter(sourceName, plotConfig, group, sample, lumi, printLevel):
         print '      Baseline selection:', baseSel
         print '      Full selection:', plotConfig.fullSelection.strip()
 
-    plotter.setBaseSelection(baseSel)
-    plotter.setFullSelection(plotConfig.fullSelection.strip())
+    fillPass = FillPass(name, sourceName, baseSel = baseSel, fullSel = plotConfig.fullSelection.strip())
 
     if not sample.data:
-        plotter.setConstantWeight(lumi)
+        fillPass.constWeight = lumi
 
     if group == plotConfig.obs:
-        plotter.setPrescale(plotConfig.prescales[sample])
+        fillPass.prescale = plotConfig.prescales[sample]
 
-    plotter.setPrintLevel(printLevel)
+    return fillPass
 
-    return plotter
-    
 
-def fillPlots(plotConfig, group, plotdefs, sourceDir, outFile, lumi = 0., postscale = 1., printLevel = 0, altSourceDir = ''):
+class HistCache(object):
+    """
+    On-disk cache of filled (unscaled) histograms.
+    There is one ROOT file per combination of source file and pass-wide settings (selections, weight, prescale),
+    named after the hash of these. The file holds a stamp of the source mtime and size and the histograms, keyed by
+    the hash of expression, cut, reweight, overflow mode, and binning. A file whose stamp does not match the
+    source is discarded as a whole.
+    """
+
+    def __init__(self, cacheDir):
+        self.cacheDir = cacheDir
+        self.hits = 0
+        self.misses = 0
+
+        if not os.path.isdir(self.cacheDir):
+            os.makedirs(self.cacheDir)
+
+    def _path(self, fillPass):
+        key = '\n'.join([
+            os.path.realpath(fillPass.sourceName),
+            fillPass.baseSel,
+            fillPass.fullSel,
+            repr(fillPass.constWeight),
+            str(fillPass.prescale)
+        ])
+
+        return self.cacheDir + '/' + hashlib.sha1(key).hexdigest() + '.root'
+
+    def _stamp(self, fillPass):
+        stat = os.stat(fillPass.sourceName)
+        return '%s %d' % (repr(stat.st_mtime), stat.st_size)
+
+    def _plotKey(self, plot):
+        hist = plot[0]
+
+        binning = []
+        for axis in [hist.GetXaxis(), hist.GetYaxis(), hist.GetZaxis()][:hist.GetDimension()]:
+            binning.append(' '.join(repr(axis.GetBinLowEdge(iX)) for iX in range(1, axis.GetNbins() + 2)))
+
+        key = '\n'.join([hist.ClassName()] + [str(p) for p in plot[1:]] + binning)
+
+        return 'h_' + hashlib.sha1(key).hexdigest()
+
+    def load(self, fillPass):
+        """
+        Add the cached contents to the histograms of the pass. Returns the indices of plots not found in the cache.
+        """
+
+        path = self._path(fillPass)
+
+        if not os.path.exists(path):
+            self.misses += len(fillPass.plots)
+            return range(len(fillPass.plots))
+
+        source = ROOT.TFile.Open(path)
+        stamp = source.Get('stamp')
+
+        if not stamp or stamp.GetTitle() != self._stamp(fillPass):
+            source.Close()
+            self.misses += len(fillPass.plots)
+            return range(len(fillPass.plots))
+
+        missing = []
+        for iP, plot in enumerate(fillPass.plots):
+            cached = source.Get(self._plotKey(plot))
+            if cached:
+                plot[0].Add(cached)
+                self.hits += 1
+            else:
+                missing.append(iP)
+                self.misses += 1
+
+        source.Close()
+
+        return missing
+
+    def store(self, fillPass):
+        """
+        Write the (freshly filled) histograms of the pass into the cache.
+        """
+
+        if len(fillPass.plots) == 0:
+            return
+
+        path = self._path(fillPass)
+        stamp = self._stamp(fillPass)
+
+        mode = 'recreate'
+        if os.path.exists(path):
+            cacheFile = ROOT.TFile.Open(path)
+            cachedStamp = cacheFile.Get('stamp')
+            if cachedStamp and cachedStamp.GetTitle() == stamp:
+                mode = 'update'
+            cacheFile.Close()
+
+        cacheFile = ROOT.TFile.Open(path, mode)
+        if mode == 'recreate':
+            cacheFile.WriteTObject(ROOT.TNamed('stamp', stamp))
+
+        for plot in fillPass.plots:
+            cacheFile.WriteTObject(plot[0], self._plotKey(plot), 'Overwrite')
+
+        cacheFile.Close()
+
+
+# passes are handed to the worker processes through fork - only the index is sent over the pipe
+workerPasses = []
+
+def fillInWorker(args):
+    iPass, printLevel, outPath = args
+
+    fillPass = workerPasses[iPass]
+
+    # fill detached copies of the (empty) histograms and save them to a temporary file
+    hists = []
+    for iH, hist in enumerate(fillPass.hists()):
+        clone = hist.Clone('h%d' % iH)
+        clone.SetDirectory(0)
+        hists.append(clone)
+
+    fillPass.fill(printLevel, hists)
+
+    outFile = ROOT.TFile.Open(outPath, 'recreate')
+    for hist in hists:
+        outFile.WriteTObject(hist)
+    outFile.Close()
+
+    return iPass
+
+
+def runPasses(passes, printLevel = 0, jobs = 1, cache = None):
+    """
+    Execute the fill passes. With jobs > 1, passes are run in a pool of worker processes and the
+    filled histograms are added back to the original (empty) histograms in this process.
+    If a HistCache is given, only the plots missing in the cache are filled, and are then stored.
+    """
+
+    if cache is not None:
+        missingPasses = []
+        for fillPass in passes:
+            missing = cache.load(fillPass)
+            if len(missing) != 0:
+                missingPasses.append(fillPass.subset(missing))
+
+        runPasses(missingPasses, printLevel = printLevel, jobs = jobs)
+
+        for fillPass in missingPasses:
+            cache.store(fillPass)
+
+        return
+
+    if jobs <= 1:
+        for fillPass in passes:
+            print '   ', fillPass.name, '(%s)' % fillPass.sourceName
+            fillPass.fill(printLevel)
+
+        return
+
+    import multiprocessing
+    import tempfile
+    import shutil
+
+    # progress counters from concurrent passes would only garble the output
+    if printLevel <= 0:
+        workerPrintLevel = -1
+    else:
+        workerPrintLevel = printLevel
+
+    del workerPasses[:]
+    workerPasses.extend(passes)
+
+    tmpDir = tempfile.mkdtemp(prefix = 'plot_')
+
+    try:
+        pool = multiprocessing.Pool(jobs)
+        workerArgs = [(iPass, workerPrintLevel, tmpDir + '/pass_%d.root' % iPass) for iPass in range(len(passes))]
+
+        for iPass in pool.imap_unordered(fillInWorker, workerArgs):
+            fillPass = passes[iPass]
+            print '   ', fillPass.name, '(%s)' % fillPass.sourceName
+
+            source = ROOT.TFile.Open(workerArgs[iPass][2])
+            for iH, hist in enumerate(fillPass.hists()):
+                hist.Add(source.Get('h%d' % iH))
+
+            source.Close()
+
+        pool.close()
+        pool.join()
+
+    finally:
+        del workerPasses[:]
+        shutil.rmtree(tmpDir)
+
+
+def setupPlots(plotConfig, group, plotdefs, sourceDir, outFile, lumi = 0., printLevel = 0, altSourceDir = ''):
+    """
+    Book the histograms for the group and define the fill passes.
+    Returns ({(sample, plotdef, variation, direction): histogram}, [FillPass])
+    """
+
     if group.region:
         region = group.region
     else:
         region = plotConfig.name
 
     histograms = collections.OrderedDict() # {(sample, plotdef, variation, direction): histogram}
+    passes = []
 
-    # run the Plotter for each sample
+    # one pass for each sample
     for sample in group.samples:
         sourceName = utils.getSkimPath(sample.name, region, sourceDir, altSourceDir)
 
         dname = sample.name + '_' + region
 
-        print '   ', dname, '(%s)' % sourceName
-
         if not os.path.exists(sourceName):
             sys.stderr.write('File ' + sourceName + ' does not exist.\n')
             raise RuntimeError('InvalidSource')
 
-        plotter = makePlotter(sourceName, plotConfig, group, sample, lumi, printLevel)
-        varPlotters = {} # additional plotters for variations of sample type
+        fillPass = makeFillPass(dname, sourceName, plotConfig, group, sample, lumi, printLevel)
+        passes.append(fillPass)
+        varPasses = {} # additional passes for variations of sample type
 
         for plotdef in plotdefs:
             if not outFile.GetDirectory(plotdef.name):
@@ -97,7 +361,7 @@ def fillPlots(plotConfig, group, plotdefs, sourceDir, outFile, lumi = 0., postsc
                 overflowMode = ROOT.Plot.kNoOverflowBin
 
             # nominal distribution
-            plotter.addPlot(
+            fillPass.addPlot(
                 hist,
                 plotdef.formExpression(),
                 cut.strip(),
@@ -139,15 +403,16 @@ def fillPlots(plotConfig, group, plotdefs, sourceDir, outFile, lumi = 0., postsc
 
                     if variation.regions is not None:
                         try:
-                            varPlotter = varPlotters[hist.GetName()]
+                            varPass = varPasses[hist.GetName()]
                         except KeyError:
                             varSourceName = utils.getSkimPath(sample.name, variation.regions[iv], sourceDir, altSourceDir)
-                            varPlotter = makePlotter(varSourceName, plotConfig, group, sample, lumi, printLevel)
-                            varPlotters[hist.GetName()] = varPlotter
+                            varPass = makeFillPass(sample.name + '_' + variation.regions[iv], varSourceName, plotConfig, group, sample, lumi, printLevel)
+                            varPasses[hist.GetName()] = varPass
+                            passes.append(varPass)
                     else:
-                        varPlotter = plotter
+                        varPass = fillPass
 
-                    varPlotter.addPlot(
+                    varPass.addPlot(
                         hist,
                         expr,
                         cut.strip(),
@@ -157,13 +422,26 @@ def fillPlots(plotConfig, group, plotdefs, sourceDir, outFile, lumi = 0., postsc
                         overflowMode
                     )
 
-        # setup complete. Fill all plots in one go
-        if plotter.numObjs() != 0:
-            plotter.fillPlots()
+    return histograms, passes
+
+
+def fillPlots(plotConfig, group, plotdefs, sourceDir, outFile, lumi = 0., postscale = 1., printLevel = 0, altSourceDir = '', jobs = 1, cache = None):
+    histograms, passes = setupPlots(plotConfig, group, plotdefs, sourceDir, outFile, lumi = lumi, printLevel = printLevel, altSourceDir = altSourceDir)
+
+    runPasses(passes, printLevel = printLevel, jobs = jobs, cache = cache)
+
+    finalizePlots(plotConfig, group, plotdefs, outFile, histograms, postscale = postscale)
 
-        for varname, varPlotter in varPlotters.items():
-            if varPlotter.numObjs() != 0:
-                varPlotter.fillPlots()
+
+def finalizePlots(plotConfig, group, plotdefs, outFile, histograms, postscale = 1.):
+    """
+    Scale and clean the filled sample histograms and write the group aggregates.
+    """
+
+    if group.region:
+        region = group.region
+    else:
+        region = plotConfig.name
 
     if group.norm >= 0.:
         normalization = sum(hist.GetBinContent(1) for (_, plotdef, variation, direction), hist in histograms.items() if plotdef.name == 'count' and variation is None)
@@ -434,7 +712,7 @@ def printChi2(stack, plotdef, plotConfig, precision = '.2f'):
 
 def printCanvas(canvas, plotdef, plotConfig):
     """
-    Print the canvas content as pdf and png.
+    Print the canvas content as pdf and png. Returns a short description of the printed versions.
     """
 
     eil = ROOT.gErrorIgnoreLevel
@@ -489,11 +767,11 @@ def printCanvas(canvas, plotdef, plotConfig):
         simple._needUpdate = False
         simple.printWeb(plotDir, plotdef.name)
 
-        sys.stdout.write('    main')
+        status = 'main'
         if logy:
-            sys.stdout.write(' (log)')
+            status += ' (log)'
         else:
-            sys.stdout.write(' (lin)')
+            status += ' (lin)'
 
         if addLinear:
             plotPad.SetLogy(False)
@@ -503,10 +781,7 @@ def printCanvas(canvas, plotdef, plotConfig):
             yaxis.SetWmax(plotPad.GetUymax())
             simple.printWeb(plotDir, plotdef.name + 'Linear', logy = False)
 
-            sys.stdout.write(' (lin)')
-
-        sys.stdout.write('\n')
-        sys.stdout.flush()
+            status += ' (lin)'
 
         # cleanup the mess
         for obj in garbage:
@@ -518,11 +793,11 @@ def printCanvas(canvas, plotdef, plotConfig):
         # normal, (partially) unblinded distributions
         canvas.printWeb(plotDir, plotdef.name, drawLegend = False)
 
-        sys.stdout.write('    main')
+        status = 'main'
         if logy:
-            sys.stdout.write(' (log)')
+            status += ' (log)'
         else:
-            sys.stdout.write(' (lin)')
+            status += ' (lin)'
 
         if addLinear:
             canvas.ylimits = (0., -1.)
@@ -532,13 +807,187 @@ def printCanvas(canvas, plotdef, plotConfig):
             canvas._needUpdate = True
             canvas.printWeb(plotDir, plotdef.name + 'Linear', logy = False)
 
-            sys.stdout.write(' (lin)')
-
-        sys.stdout.write('\n')
-        sys.stdout.flush()
+            status += ' (lin)'
 
     ROOT.gErrorIgnoreLevel = eil
 
+    return status
+
+
+def makeCanvas(plotConfig):
+    canvas = DataMCCanvas()
+
+    nentries = (1 + len(plotConfig.bkgGroups) + len(plotConfig.signalPoints))
+    ncolumns = math.ceil(float(nentries) / 5.) 
+    xmin = 0.35 if ncolumns > 2 else 0.55
+    canvas.legend.setPosition(xmin, SimpleCanvas.YMAX - 0.01 - 0.035 * 5, 0.92, SimpleCanvas.YMAX - 0.01)
+
+    return canvas
+
+
+_codeDigest = None
+
+def renderDigest(plotdef, plotConfig, lumi, entries):
+    """
+    Hash of everything that goes into the image of the plot: the histograms (list of (role, title, color, hist)),
+    the plot definition, the luminosity label, and the source of this script and plotstyle.
+    """
+
+    global _codeDigest
+
+    if _codeDigest is None:
+        import plotstyle
+        code = hashlib.sha1()
+        for path in [os.path.realpath(__file__), os.path.splitext(plotstyle.__file__)[0] + '.py']:
+            with open(path) as source:
+                code.update(source.read())
+
+        _codeDigest = code.hexdigest()
+
+    digest = hashlib.sha1(_codeDigest)
+
+    for attr in ['name', 'title', 'unit', 'binning', 'blind', 'sensitive', 'overflow', 'logy', 'ymin', 'ymax']:
+        digest.update(repr(getattr(plotdef, attr)))
+
+    digest.update(plotdef.formSelection(plotConfig))
+    digest.update(repr(lumi))
+
+    for role, title, color, hist in entries:
+        digest.update(repr((role, title, color)))
+        for iCell in range(hist.GetNcells()):
+            digest.update('%r %r' % (hist.GetBinContent(iCell), hist.GetBinError(iCell)))
+
+    return digest.hexdigest()
+
+
+def renderPlot(canvas, plotdef, plotConfig, inDir, lumi, asimov = ''):
+    """
+    Draw one plot to the web directory unless the images there were made from the same inputs.
+    Returns a status line.
+    """
+
+    if plotdef.ndim() == 1:
+        drawOpt = 'HIST'
+    elif plotdef.ndim() == 2:
+        drawOpt = 'LEGO4 F 0'
+
+    entries = []
+
+    for group in plotConfig.bkgGroups:
+        title = group.title
+        if group.scale != 1.:
+            title += (' #times %.1f' % group.scale)
+        entries.append(('bkg', title, group.color, inDir.Get(group.name + '_syst')))
+
+    # plot signal distributions for sensitive plots
+    if plotdef.sensitive:
+        for sspec in plotConfig.signalPoints:
+            title = sspec.title
+            if sspec.group.scale != 1.:
+                title += (' #times %.1f' % sspec.group.scale)
+            entries.append(('sig', title, sspec.color, inDir.Get('samples/' + sspec.name + '_' + plotConfig.name)))
+
+    # observed distributions
+    obshist = inDir.Get('data_obs')
+    if obshist:
+        entries.append(('obs', plotConfig.obs.title, None, obshist))
+
+    if asimov:
+        plotdef.name += asimov.capitalize()
+
+    digest = renderDigest(plotdef, plotConfig, lumi, entries)
+
+    # images to be produced and the hash of their inputs
+    targetDir = WEBDIR + '/' + plotDir
+    names = [plotdef.name]
+    if plotdef.logy is None:
+        names.append(plotdef.name + 'Linear')
+
+    digestPath = targetDir + '/.' + plotdef.name + '.hash'
+
+    if os.path.exists(digestPath) and all(os.path.exists(targetDir + '/' + name + '.' + ext) for name in names for ext in ['pdf', 'png']):
+        with open(digestPath) as source:
+            if source.read().strip() == digest:
+                return 'unchanged'
+
+    canvas.Clear(full = True)
+    canvas.lumi = lumi
+
+    for role, title, color, hist in entries:
+        formatHist(hist, plotdef)
+        if role == 'bkg':
+            canvas.addStacked(hist, title = title, color = color, drawOpt = drawOpt)
+        elif role == 'sig':
+            canvas.addSignal(hist, title = title, color = color, drawOpt = drawOpt)
+        else:
+            canvas.addObs(hist, title = title)
+
+    status = printCanvas(canvas, plotdef, plotConfig)
+
+    with open(digestPath, 'w') as output:
+        output.write(digest + '\n')
+
+    return status
+
+
+# plots are handed to the worker processes through fork - only the indices are sent over the pipe
+workerRenders = []
+
+def renderInWorker(indices):
+    plotdefs, plotConfig, histPath, lumis, asimov = workerRenders
+
+    if histPath:
+        # the file of the parent process must not be read concurrently
+        histFile = ROOT.TFile.Open(histPath)
+    else:
+        histFile = ROOT.gROOT
+
+    canvas = makeCanvas(plotConfig)
+
+    results = []
+    for iPlot in indices:
+        plotdef = plotdefs[iPlot]
+        name = plotdef.name
+        status = renderPlot(canvas, plotdef, plotConfig, histFile.GetDirectory(name), lumis[iPlot], asimov = asimov)
+        results.append((name, status))
+
+    if histPath:
+        histFile.Close()
+
+    return results
+
+
+def renderPlots(plotdefs, plotConfig, histFile, histPath, lumis, asimov = '', jobs = 1):
+    """
+    Draw the plots. With jobs > 1, the plots are split into jobs batches drawn in forked worker processes,
+    each reading from its own handle of the histogram file at histPath (or from the forked memory if histPath is empty).
+    """
+
+    if jobs <= 1 or len(plotdefs) <= 1:
+        canvas = makeCanvas(plotConfig)
+        for plotdef, lumi in zip(plotdefs, lumis):
+            name = plotdef.name
+            print ' ', name, renderPlot(canvas, plotdef, plotConfig, histFile.GetDirectory(name), lumi, asimov = asimov)
+
+        return
+
+    import multiprocessing
+
+    del workerRenders[:]
+    workerRenders.extend([plotdefs, plotConfig, histPath, lumis, asimov])
+
+    batches = [range(iBatch, len(plotdefs), jobs) for iBatch in range(min(jobs, len(plotdefs)))]
+
+    pool = multiprocessing.Pool(len(batches))
+    try:
+        for results in pool.imap_unordered(renderInWorker, batches):
+            for name, status in results:
+                print ' ', name, status
+
+    finally:
+        pool.close()
+        pool.join()
+
 
 if __name__ == '__main__':
 
@@ -552,13 +1001,17 @@ if __name__ == '__main__':
     argParser.add_argument('--bin-by-bin', '-y', metavar = 'PLOT', dest = 'bbb', default = '', help = 'Print out bin-by-bin breakdown of the backgrounds and observation.')
     argParser.add_argument('--blind', '-B', action = 'store_true', dest = 'blind', help = 'Do not plot the observed distribution at all.')
     argParser.add_argument('--unblind', '-U', action = 'store_true', dest = 'unblind', help = 'Ignore the blind option of plot configs.')
+    argParser.add_argument('--cache', '-C', action = 'store_true', dest = 'useCache', help = 'Reuse histograms filled in previous runs from the histogram cache (config.histCacheDir) and fill only the missing ones.')
     argParser.add_argument('--chi2', '-x', metavar = 'PLOT', dest = 'chi2', default = '', help = 'Compute the chi2 for the plot.')
-    argParser.add_argument('--clear-dir', '-R', action = 'store_true', dest = 'clearDir', help = 'Clear the plot directory first.')
+    argParser.add_argument('--clear-dir', '-R', action = 'store_true', dest = 'clearDir', help = 'Clear the plot directory first. Otherwise plots whose inputs did not change since they were last drawn are not redrawn.')
+    argParser.add_argument('--columnar', '-c', action = 'store_true', dest = 'columnar', help = 'Fill with the vectorized columnar backend where the expressions allow (column cache in config.columnCacheDir).')
     argParser.add_argument('--hist-file', '-o', metavar = 'PATH', dest = 'histFile', default = '', help = 'Histogram output file.')
+    argParser.add_argument('--jobs', '-j', metavar = 'N', dest = 'jobs', type = int, default = 1, help = 'Number of parallel processes for filling and for drawing the histograms.')
+    argParser.add_argument('--prefetch', '-F', action = 'store_true', dest = 'prefetch', help = 'Copy the skims of the config to the local skim cache (config.skimCacheDir) before filling.')
     argParser.add_argument('--list-samples', '-L', action = 'store_true', dest = 'listSamples', help = 'List the samples in the given plot config and exit.')
     argParser.add_argument('--plot', '-p', metavar = 'NAME', dest = 'plots', nargs = '+', default = [], help = 'Limit plotting to specified set of plots.')
     argParser.add_argument('--plot-dir', '-d', metavar = 'PATH', dest = 'plotDir', default = '', help = 'Specify a directory under {webdir} to save images. Use "-" for no output.')
-    argParser.add_argument('--print-level', '-m', metavar = 'LEVEL', dest = 'printLevel', default = 0, help = 'Verbosity of the script.')
+    argParser.add_argument('--print-level', '-m', metavar = 'LEVEL', dest = 'printLevel', type = int, default = 0, help = 'Verbosity of the script.')
     argParser.add_argument('--replot', '-P', action = 'store_true', dest = 'replot', default = '', help = 'Do not fill histograms. Need --hist-file.')
     argParser.add_argument('--skim-dir', '-i', metavar = 'PATH', dest = 'skimDir', help = 'Input skim directory.')
     
@@ -578,6 +1031,7 @@ if __name__ == '__main__':
     from main.plotconfig_ggh import getConfigGGH
     import config
     import utils
+    import skimcache
 
     ##################################
     ## PARSE COMMAND-LINE ARGUMENTS ##
@@ -699,7 +1153,17 @@ if __name__ == '__main__':
 
     if not args.replot:
         ROOT.gROOT.LoadMacro(basedir + '/../common/MultiDraw.cc+')
+
+        if args.columnar:
+            sys.path.append(basedir + '/../common')
+            FillPass.columnCacheDir = config.columnCacheDir
     
+        if args.prefetch and skimcache.defaultCache() is None:
+            print 'config.skimCacheDir is not set; not prefetching.'
+        elif args.prefetch:
+            skims = skimcache.configSkims(plotConfig, allSignal = args.allSignal)
+            skimcache.defaultCache().prefetch([args.skimDir + '/' + sname + '_' + region + '.root' for sname, region in skims], jobs = max(args.jobs, 4))
+
         print 'Filling plots for %s..' % plotConfig.name
 
         # for data-driven background estimates under presence of prescales
@@ -721,10 +1185,37 @@ if __name__ == '__main__':
             # if args.asimov, we'll make the data_obs plot below
             groups.append(plotConfig.obs)
     
-        for group in groups:
-            print ' ', group.name
+        if args.useCache:
+            cache = HistCache(config.histCacheDir)
+        else:
+            cache = None
+
+        if args.jobs > 1:
+            # book everything first so that the passes of all groups share one worker pool
+            setups = []
+            passes = []
+            for group in groups:
+                histograms, groupPasses = setupPlots(plotConfig, group, plotdefs, args.skimDir, histFile, lumi = effLumi, printLevel = args.printLevel, altSourceDir = localSkimDir)
+                setups.append((group, histograms))
+                passes.extend(groupPasses)
+
+            print '  %d passes in %d processes' % (len(passes), args.jobs)
+            runPasses(passes, printLevel = args.printLevel, jobs = args.jobs, cache = cache)
 
-            fillPlots(plotConfig, group, plotdefs, args.skimDir, histFile, lumi = effLumi, postscale = postscale, printLevel = args.printLevel, altSourceDir = localSkimDir)
+            for group, histograms in setups:
+                finalizePlots(plotConfig, group, plotdefs, histFile, histograms, postscale = postscale)
+
+        else:
+            for group in groups:
+                print ' ', group.name
+
+                fillPlots(plotConfig, group, plotdefs, args.skimDir, histFile, lumi = effLumi, postscale = postscale, printLevel = args.printLevel, altSourceDir = localSkimDir, jobs = 1, cache = cache)
+
+        if cache is not None:
+            print 'Histogram cache: %d hits, %d misses' % (cache.hits, cache.misses)
+
+        if skimcache.defaultCache() is not None:
+            print skimcache.defaultCache().report()
    
         # Save a background total histogram (for display purpose) for each plotdef
         for plotdef in plotdefs:
@@ -798,13 +1289,6 @@ if __name__ == '__main__':
 
     print 'Drawing plots..'
 
-    canvas = DataMCCanvas()
-
-    nentries = (1 + len(plotConfig.bkgGroups) + len(plotConfig.signalPoints))
-    ncolumns = math.ceil(float(nentries) / 5.) 
-    xmin = 0.35 if ncolumns > 2 else 0.55
-    canvas.legend.setPosition(xmin, SimpleCanvas.YMAX - 0.01 - 0.035 * 5, 0.92, SimpleCanvas.YMAX - 0.01)
-
     if args.plotDir:
         if args.plotDir == '-':
             plotDir = ''
@@ -817,85 +1301,32 @@ if __name__ == '__main__':
         for plot in os.listdir(WEBDIR + '/' + plotDir):
             os.remove(WEBDIR + '/' + plotDir + '/' + plot)
 
+    graphicPlots = []
+
     for plotdef in plotdefs:
         if plotdef.name != 'count' and plotdef.name != args.bbb and plotdef.name != args.chi2:
-            graphic = True
-        else:
-            graphic = False
+            if plotDir:
+                graphicPlots.append(plotdef)
 
-        if not plotDir and graphic:
-            # nothing to do
             continue
 
         print ' ', plotdef.name
 
-        if graphic:
-            if plotdef.ndim() == 1:
-                drawOpt = 'HIST'
-            elif plotdef.ndim() == 2:
-                drawOpt = 'LEGO4 F 0'
-
-            # set up canvas
-            canvas.Clear(full = True)
-
-            isSensitive = plotdef.sensitive
-
-        else:
-            counters = {}
-            isSensitive = True
-    
-        if isSensitive:
-            canvas.lumi = effLumi
-            # for data-driven background estimates under presence of prescales
-            # multiply the yields by 1/postscale
-            postscale = fullLumi / effLumi
-        else:
-            canvas.lumi = fullLumi
-            postscale = 1.
+        counters = {}
 
         inDir = histFile.GetDirectory(plotdef.name)
 
-        # fetch and format background groups
+        # fetch background groups
         for group in plotConfig.bkgGroups:
-            ghist = inDir.Get(group.name + '_syst')
-
-            if graphic:
-                formatHist(ghist, plotdef)
-                title = group.title
-                if group.scale != 1.:
-                    title += (' #times %.1f' % group.scale)
-                canvas.addStacked(ghist, title = title, color = group.color, drawOpt = drawOpt)
-            else:
-                counters[group.name] = ghist
-
-        # background total used for uncertainty display
-        bkgTotal = inDir.Get('bkgtotal_syst')
-        if graphic:
-            formatHist(bkgTotal, plotdef)
+            counters[group.name] = inDir.Get(group.name + '_syst')
 
-        # plot signal distributions for sensitive plots
-        if isSensitive:
-            for sspec in plotConfig.signalPoints:
-                shist = inDir.Get('samples/' + sspec.name + '_' + plotConfig.name)
-
-                if graphic:
-                    formatHist(shist, plotdef)
-                    title = sspec.title
-                    if sspec.group.scale != 1.:
-                        title += (' #times %.1f' % sspec.group.scale)
-                    canvas.addSignal(shist, title = title, color = sspec.color, drawOpt = drawOpt)
-                else:
-                    counters[sspec.name] = shist
+        for sspec in plotConfig.signalPoints:
+            counters[sspec.name] = inDir.Get('samples/' + sspec.name + '_' + plotConfig.name)
 
         # observed distributions
         obshist = inDir.Get('data_obs')
-
         if obshist:
-            if graphic:
-                formatHist(obshist, plotdef)
-                canvas.addObs(obshist, title = plotConfig.obs.title)
-            else:    
-                counters['data_obs'] = obshist
+            counters['data_obs'] = obshist
 
         if plotdef.name == 'count':
             printCounts(counters, plotConfig)
@@ -903,8 +1334,13 @@ if __name__ == '__main__':
             printBinByBin(counters, plotdef, plotConfig)
         elif plotdef.name == args.chi2:
             printChi2(counters, plotdef, plotConfig)
-        else:
-            if args.asimov:
-                plotdef.name += args.asimov.capitalize()
 
-            printCanvas(canvas, plotdef, plotConfig)
+    # sensitive plots are drawn with the luminosity of the (prescaled) observed data
+    lumis = [effLumi if plotdef.sensitive else fullLumi for plotdef in graphicPlots]
+
+    if args.histFile:
+        histPath = args.histFile
+    else:
+        histPath = ''
+
+    renderPlots(graphicPlots, plotConfig, histFile, histPath, lumis, asimov = args.asimov, jobs = args.jobs)
@@ -4,17 +4,16 @@ import sys
 import os
 import subprocess
 import collections
+import hashlib
+import json
+import time
+import shutil
+import multiprocessing
 
-from batch import BatchManager
-
-## load condor-run
-sys.path.append('/home/yiiyama/lib')
-from condor_run import CondorRun
+from batch import BatchManager, LocalExecutor
 
 logger = None
 
-padd = os.environ['CMSSW_BASE'] + '/bin/' + os.environ['SCRAM_ARCH'] + '/padd'
-
 class SkimSlimWeight(object):
 
     config = {}
@@ -125,17 +124,24 @@ class SkimSlimWeight(object):
         if self.sample.book != 'pandaf/004':
             skimmer.setCompatibilityMode(True)
 
+        def makeSelectors():
+            selectors = []
+            for rname, selgen in self.selectors.items():
+                if type(selgen) is tuple: # has modifiers
+                    selector = selgen[0](self.sample, rname)
+                    for mod in selgen[1:]:
+                        mod(self.sample, selector)
+                else:
+                    selector = selgen(self.sample, rname)
+
+                selector.setUseTimers(SkimSlimWeight.config['timer'])
+                selectors.append(selector)
+
+            return selectors
+
         # can eventually think of submitting jobs separately for different preskims
         bypreskim = collections.defaultdict(list)
-        for rname, selgen in self.selectors.items():
-            if type(selgen) is tuple: # has modifiers
-                selector = selgen[0](self.sample, rname)
-                for mod in selgen[1:]:
-                    mod(self.sample, selector)
-            else:
-                selector = selgen(self.sample, rname)
-
-            selector.setUseTimers(SkimSlimWeight.config['timer'])
+        for selector in makeSelectors():
             skimmer.addSelector(selector)
 
             bypreskim[selector.getPreskim()].append(selector)
@@ -148,6 +154,21 @@ class SkimSlimWeight(object):
 
             raise RuntimeError('invalid configuration')
 
+        nThreads = SkimSlimWeight.config['threads']
+        if nThreads > 1 and any(s.className() == 'NormalizingSelector' for s in sum(bypreskim.values(), [])):
+            # the normalization is computed per output file and would be wrong after merging the thread outputs
+            logger.warning('NormalizingSelector cannot be run in multiple threads. Using one thread.')
+            nThreads = 1
+
+        # each thread needs its own set of selectors
+        threadSelectors = []
+        for iThread in range(1, nThreads):
+            for selector in makeSelectors():
+                skimmer.addSelector(selector, iThread)
+                threadSelectors.append(selector)
+
+        skimmer.setNThreads(nThreads)
+
         if self.sample.data and SkimSlimWeight.config['json']:
             logger.info('Good lumi filter: %s', SkimSlimWeight.config['json'])
             skimmer.setGoodLumiFilter(makeGoodLumiFilter(SkimSlimWeight.config['json']))
@@ -172,19 +193,38 @@ class SkimSlimWeight(object):
 
         tmpOutDir = self.tmpDir + '/' + self.sample.name
     
+        preskim = bypreskim.keys()[0] if len(bypreskim) != 0 else ''
+
         for fileset, fnames in paths.items():
             print 'Fileset', fileset
 
+            nentries = SkimSlimWeight.config['nentries']
+            firstEntry = SkimSlimWeight.config['firstEntry']
+
             skimmer.clearPaths()
+            newIndices = {}
             for fname in fnames:
                 skimmer.addPath(fname)
 
+                indexPath = self.preskimIndexPath(fname, preskim)
+                if indexPath is None:
+                    continue
+
+                if os.path.exists(indexPath):
+                    logger.debug('Using preskim index %s for %s', indexPath, fname)
+                    skimmer.loadPreskimIndex(fname, indexPath)
+                else:
+                    newIndices[fname] = indexPath
+
             outNameBase = self.getOutNameBase(fileset)
-            nentries = SkimSlimWeight.config['nentries']
-            firstEntry = SkimSlimWeight.config['firstEntry']
     
             logger.debug('Skimmer.run(%s, %s, %s, %d, %d)', tmpOutDir, outNameBase, self.sample.data, nentries, firstEntry)
             skimmer.run(tmpOutDir, outNameBase, self.sample.data, nentries, firstEntry)
+
+            # the list of passing entries is complete only if the files were read through
+            if nentries < 0 and firstEntry == 0:
+                for fname, indexPath in newIndices.iteritems():
+                    self.savePreskimIndex(skimmer, fname, indexPath)
     
             for rname in self.selectors:
                 outName = outNameBase + '_' + rname + '.root'
@@ -197,7 +237,54 @@ class SkimSlimWeight(object):
                     logger.info('Removing %s/%s', tmpOutDir, outName)
                     os.remove(tmpOutDir + '/' + outName)
 
+    @staticmethod
+    def preskimIndexPath(path, preskim):
+        """
+        Path of the index of entries in the input file that pass the preskim. The key includes the
+        modification time and the size of the file, so an index is never used on a changed input.
+        Returns None if the file cannot be indexed.
+        """
+
+        if preskim == '' or SkimSlimWeight.config['noPreskimIndex'] or not SkimSlimWeight.config['preskimIndexDir']:
+            return None
+
+        if not os.path.exists(path):
+            # remote file
+            return None
+
+        stat = os.stat(path)
+        key = '%s\n%d\n%d\n%s' % (os.path.realpath(path), int(stat.st_mtime), stat.st_size, preskim)
+
+        return SkimSlimWeight.config['preskimIndexDir'] + '/' + hashlib.sha1(key).hexdigest() + '.idx'
+
+    @staticmethod
+    def savePreskimIndex(skimmer, path, indexPath):
+        indexDir = os.path.dirname(indexPath)
+        if not os.path.isdir(indexDir):
+            try:
+                os.makedirs(indexDir)
+            except OSError:
+                if not os.path.isdir(indexDir):
+                    raise
+
+        # write to a temporary file and rename, as concurrent jobs may index the same file
+        tmpPath = indexPath + '.%d' % os.getpid()
+        if skimmer.savePreskimIndex(path, tmpPath):
+            os.rename(tmpPath, indexPath)
+            logger.debug('Saved preskim index %s for %s', indexPath, path)
+        elif os.path.exists(tmpPath):
+            os.remove(tmpPath)
+
     def setupMerge(self):
+        self.makeTmpDir()
+
+        for rname in list(self.selectors):
+            if not self.prepareMergeOutput(rname):
+                self.selectors.pop(rname)
+    
+        return True
+
+    def makeTmpDir(self):
         if not os.path.exists(self.tmpDir):
             try:
                 os.makedirs(self.tmpDir)
@@ -206,45 +293,56 @@ class SkimSlimWeight(object):
                 if not os.path.exists(self.tmpDir):
                     raise
 
-        for rname in list(self.selectors):
-            outNameBase = self.sample.name + '_' + rname
-            outName = outNameBase + '.root'
-            outPath = SkimSlimWeight.config['skimDir'] + '/' + outName
-        
-            if SkimSlimWeight.config['skipExisting']:
-                if os.path.exists(outPath) and os.stat(outPath).st_size != 0:
-                    logger.info('Output files for %s already exist. Skipping merge.', outNameBase)
-                    self.selectors.pop(rname)
+    def prepareMergeOutput(self, rname):
+        """
+        Remove the old merged output of the selector. Return False if the merge is to be skipped because the output
+        exists and skipExisting is set.
+        """
 
-            elif not SkimSlimWeight.config['testRun']:
+        outNameBase = self.sample.name + '_' + rname
+        outName = outNameBase + '.root'
+        outPath = SkimSlimWeight.config['skimDir'] + '/' + outName
+    
+        if SkimSlimWeight.config['skipExisting']:
+            if os.path.exists(outPath) and os.stat(outPath).st_size != 0:
+                logger.info('Output files for %s already exist. Skipping merge.', outNameBase)
+                return False
+
+        elif not SkimSlimWeight.config['testRun']:
+            for path in [outPath, outPath.replace('.root', '.manifest.json')]:
                 try:
-                    os.remove(outPath)
+                    os.remove(path)
                 except:
                     pass
-    
+
         return True
 
     def executeMerge(self):
         inDir = SkimSlimWeight.config['skimDir'] + '/' + self.sample.name
 
+        jobs = []
+
         for rname in self.selectors:
-            for fileset in self.filesets:
-                fname = inDir + '/' + self.sample.name + '_' + fileset + '_' + rname + '.root'
+            inpaths = [inDir + '/' + self.sample.name + '_' + fileset + '_' + rname + '.root' for fileset in self.filesets]
+            for fname in inpaths:
                 if not os.path.exists(fname) or os.stat(fname).st_size == 0:
                     raise RuntimeError('Missing input file', fname)
         
-            outNameBase = self.sample.name + '_' + rname
-            outName = outNameBase + '.root'
-        
-            mergePath = self.tmpDir + '/' + outName
+            mergePath = self.tmpDir + '/' + self.sample.name + '_' + rname + '.root'
+
+            logger.debug('merge %s %s', mergePath, ' '.join(inpaths))
+            jobs.append((inpaths, mergePath))
+
+        # selectors are merged in parallel
+        results = mergeMany(jobs, nproc = SkimSlimWeight.config['mergeProcs'])
+
+        for (inpaths, mergePath), success in zip(jobs, results):
+            if not success:
+                raise RuntimeError('Merge failed', mergePath)
+
+            outName = os.path.basename(mergePath)
             outPath = SkimSlimWeight.config['skimDir'] + '/' + outName
-        
-            logger.debug('%s %s %s', padd, mergePath, ' '.join(inDir + '/' + self.sample.name + '_' + fileset + '_' + rname + '.root' for fileset in self.filesets))
-            proc = subprocess.Popen([padd, mergePath] + [inDir + '/' + self.sample.name + '_' + fileset + '_' + rname + '.root' for fileset in self.filesets], stdout = subprocess.PIPE, stderr = subprocess.PIPE)
-            out, err = proc.communicate()
-            print out.strip()
-            print err.strip()
-        
+
             if SkimSlimWeight.config['testRun']:
                 logger.info('Output at %s', mergePath)
             else:
@@ -253,18 +351,251 @@ class SkimSlimWeight(object):
                 logger.info('Removing %s', mergePath)
                 os.remove(mergePath)
 
+                if SkimSlimWeight.config['eventIndex']:
+                    logger.info('Indexing events of %s', outPath)
+                    eventindex.update(outName.replace('.root', ''), [outPath], treeName = 'cutflow')
+
+
+class MergePipeline(object):
+    """
+    Merge the skim outputs while the skim jobs are running. The outputs of finished filesets are merged in groups
+    of groupSize into partial files in the temporary directory, partial files again in groups of groupSize, and the
+    remaining pieces of a (sample, selector) into the final skim as soon as its last fileset is done. A manifest
+    (sample)_(selector).manifest.json next to each merged skim lists the fileset outputs it was made from.
+    Existing merged skims are skipped or removed as in SkimSlimWeight.setupMerge, without touching the selectors of
+    the skim jobs.
+    """
+
+    def __init__(self, ssws, groupSize, nproc = 1):
+        self.groupSize = max(2, groupSize)
+        self.pool = multiprocessing.Pool(max(1, nproc))
+
+        self.targets = [] # list of dicts, one per (sample, selector)
+        self.jobTargets = collections.defaultdict(list) # {job name: [(target, fileset)]}
+        self.nParts = 0
+
+        for ssw in ssws:
+            if ssw.manual or SkimSlimWeight.config['outSuffix'] or len(ssw.sample.filesets()) == 1:
+                # skim output is already the final file
+                continue
+
+            allFilesets = ssw.sample.filesets()
+            if not set(allFilesets) >= set(ssw.filesets):
+                continue
+
+            ssw.makeTmpDir()
+
+            for rname in ssw.selectors:
+                if not ssw.prepareMergeOutput(rname):
+                    continue
+
+                target = {
+                    'ssw': ssw,
+                    'rname': rname,
+                    'name': ssw.sample.name + '_' + rname,
+                    'waiting': set(),
+                    'pieces': [], # [(level, path, [filesets])]
+                    'running': [], # [(async result, level, path, [filesets], [input pieces])]
+                    'final': None, # (async result, path, [filesets]) once started
+                    'done': False,
+                    'failed': False
+                }
+
+                for fileset in allFilesets:
+                    if fileset in ssw.filesets:
+                        target['waiting'].add(fileset)
+                        self.jobTargets[ssw.sample.name + '_' + fileset].append((target, fileset))
+                    elif self._filesetPath(target, fileset) is not None:
+                        # kept from a previous skim (--skip-existing)
+                        target['pieces'].append((0, self._filesetPath(target, fileset), [fileset]))
+                    else:
+                        logger.warning('Fileset %s of %s is neither skimmed nor present. Not merging.', fileset, target['name'])
+                        target['failed'] = True
+                        break
+
+                self.targets.append(target)
+
+        for target in self.targets:
+            self._schedule(target)
+
+    def jobDone(self, jobName, success):
+        """
+        Callback for the batch executor.
+        """
+
+        for target, fileset in self.jobTargets.pop(jobName, []):
+            target['waiting'].discard(fileset)
+
+            path = self._filesetPath(target, fileset)
+            if not success or path is None:
+                logger.error('Skim of %s fileset %s failed. Not merging.', target['name'], fileset)
+                target['failed'] = True
+            else:
+                target['pieces'].append((0, path, [fileset]))
+
+        self.poll()
+
+    def poll(self):
+        """
+        Collect finished merges and start the ones that became possible.
+        """
+
+        for target in self.targets:
+            if target['done']:
+                continue
+
+            running = []
+            for result, level, path, filesets, inputs in target['running']:
+                if not result.ready():
+                    running.append((result, level, path, filesets, inputs))
+                elif result.get():
+                    self._removeParts(inputs)
+                    target['pieces'].append((level, path, filesets))
+                else:
+                    logger.error('Partial merge %s failed.', path)
+                    target['failed'] = True
+
+            target['running'] = running
+
+            if target['final'] is not None and target['final'][0].ready():
+                self._finalize(target)
+            else:
+                self._schedule(target)
+
+    def finish(self):
+        """
+        Wait for the remaining merges. Return the names of the merged skims that could not be produced.
+        """
+
+        for target in self.targets:
+            if len(target['waiting']) != 0:
+                # job never reported back
+                target['failed'] = True
+
+        while True:
+            self.poll()
+            if all(target['done'] or (target['failed'] and len(target['running']) == 0) for target in self.targets):
+                break
+
+            time.sleep(1)
+
+        self.pool.close()
+        self.pool.join()
+
+        failed = []
+        for target in self.targets:
+            if target['failed']:
+                self._removeParts(target['pieces'])
+                failed.append(target['name'])
+
+        return failed
+
+    def _filesetName(self, target, fileset):
+        ssw = target['ssw']
+        return ssw.outDir + '/' + ssw.getOutNameBase(fileset) + '_' + target['rname'] + '.root'
+
+    def _filesetPath(self, target, fileset):
+        path = self._filesetName(target, fileset)
+        if not os.path.exists(path) or os.stat(path).st_size == 0:
+            return None
+
+        return path
+
+    def _schedule(self, target):
+        if target['failed'] or target['final'] is not None:
+            return
+
+        # merge groupSize pieces of the same level into one piece of the next level
+        bylevel = collections.defaultdict(list)
+        for piece in target['pieces']:
+            bylevel[piece[0]].append(piece)
+
+        pieces = []
+        for level, group in sorted(bylevel.items()):
+            while len(group) >= self.groupSize:
+                inputs = group[:self.groupSize]
+                group = group[self.groupSize:]
+                self._start(target, level + 1, inputs)
+
+            pieces.extend(group)
+
+        target['pieces'] = pieces
+
+        if len(target['waiting']) == 0 and len(target['running']) == 0:
+            path = target['ssw'].tmpDir + '/' + target['name'] + '.root'
+            filesets = sorted(sum((piece[2] for piece in pieces), []))
+            logger.info('Final merge of %s from %d pieces', target['name'], len(pieces))
+            result = self.pool.apply_async(mergeFiles, ([piece[1] for piece in pieces], path))
+            target['final'] = (result, path, filesets)
+
+    def _start(self, target, level, inputs):
+        self.nParts += 1
+        path = target['ssw'].tmpDir + '/' + target['name'] + '.part%d.root' % self.nParts
+        filesets = sum((piece[2] for piece in inputs), [])
+
+        logger.debug('merge %s %s', path, ' '.join(piece[1] for piece in inputs))
+        result = self.pool.apply_async(mergeFiles, ([piece[1] for piece in inputs], path))
+        target['running'].append((result, level, path, filesets, inputs))
+
+    def _finalize(self, target):
+        result, mergePath, filesets = target['final']
+        target['done'] = True
+
+        if not result.get():
+            logger.error('Merge of %s failed.', target['name'])
+            target['failed'] = True
+            return
+
+        self._removeParts(target['pieces'])
+        target['pieces'] = []
+
+        outName = os.path.basename(mergePath)
+        outPath = SkimSlimWeight.config['skimDir'] + '/' + outName
+
+        if SkimSlimWeight.config['testRun']:
+            logger.info('Output at %s', mergePath)
+            return
+
+        logger.info('Copying output to %s', outPath)
+        shutil.copy(mergePath, SkimSlimWeight.config['skimDir'])
+        logger.info('Removing %s', mergePath)
+        os.remove(mergePath)
+
+        manifest = {'output': outPath, 'sample': target['ssw'].sample.name, 'selector': target['rname'], 'inputs': []}
+        for fileset in filesets:
+            path = self._filesetName(target, fileset)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                # removed since it was merged; the manifest keeps the name but cannot vouch for the content
+                logger.warning('Fileset output %s disappeared after merging.', path)
+                manifest['inputs'].append({'fileset': fileset, 'path': path, 'mtime': None, 'size': None})
+                continue
+
+            manifest['inputs'].append({'fileset': fileset, 'path': path, 'mtime': int(stat.st_mtime), 'size': stat.st_size})
+
+        with open(outPath.replace('.root', '.manifest.json'), 'w') as out:
+            json.dump(manifest, out, indent = 1)
+
+        if SkimSlimWeight.config['eventIndex']:
+            logger.info('Indexing events of %s', outPath)
+            eventindex.update(outName.replace('.root', ''), [outPath], treeName = 'cutflow')
+
+    def _removeParts(self, pieces):
+        # level-0 pieces are the fileset outputs and are kept
+        for level, path, _ in pieces:
+            if level != 0 and os.path.exists(path):
+                os.remove(path)
+
 
 class SSWBatchManager(BatchManager):
-    def __init__(self, ssws):
-        BatchManager.__init__(self, 'ssw2')
+    def __init__(self, ssws, executor = None):
+        BatchManager.__init__(self, 'ssw2', executor)
 
         self.ssws = ssws # list of SlimSkimWeight objects to manage
         self.catalogDir = ''
 
     def submitMerge(self, args):
-        submitter = CondorRun(os.path.realpath(__file__))
-        submitter.requirements = 'OpSysAndVer == "SL6" && UidDomain == "mit.edu"'
-
         arguments = []
 
         for ssw in self.ssws:
@@ -284,15 +615,12 @@ class SSWBatchManager(BatchManager):
         if self.catalogDir:
             argTemplate += ' -c ' + self.catalogDir
 
-        submitter.job_args = [argTemplate % arg for arg in arguments]
-        submitter.job_names = ['%s_%s' % arg for arg in arguments]
+        jobs = [('%s_%s' % arg, argTemplate % arg) for arg in arguments]
+        options = {'requirements': 'OpSysAndVer == "SL6" && UidDomain == "mit.edu"'}
 
-        self._submit(submitter, 'merge', argTemplate, args.noWait, args.autoResubmit)
-
-    def submitSkim(self, args):
-        submitter = CondorRun(os.path.realpath(__file__))
-        submitter.requirements = 'OpSysAndVer == "SL6"'
+        return self._submit(os.path.realpath(__file__), jobs, options, args.noWait, args.autoResubmit)
 
+    def submitSkim(self, args, onComplete = None):
         argTemplate = '%s -f %s'
     
         if args.skipMissing:
@@ -307,10 +635,11 @@ class SSWBatchManager(BatchManager):
         if args.openTimeout is not None:
             argTemplate += ' -m ' + str(args.openTimeout)
 
+        jobs = []
+
         for ssw in self.ssws:
             for fileset in ssw.filesets:
-                submitter.job_args.append(argTemplate % (ssw.sample.name, fileset) + ' -s ' + ' '.join(ssw.selectors.keys()))
-                submitter.job_names.append('%s_%s' % (ssw.sample.name, fileset))
+                jobs.append(('%s_%s' % (ssw.sample.name, fileset), argTemplate % (ssw.sample.name, fileset) + ' -s ' + ' '.join(ssw.selectors.keys())))
     
                 # clean up old .log files
                 logpath = '/local/' + os.environ['USER'] + '/ssw2/' + ssw.sample.name + '_' + fileset + '.0.log'
@@ -320,7 +649,9 @@ class SSWBatchManager(BatchManager):
                 except:
                     pass
 
-        self._submit(submitter, 'skim', argTemplate, args.noWait, args.autoResubmit)
+        options = {'requirements': 'OpSysAndVer == "SL6"'}
+
+        return self._submit(os.path.realpath(__file__), jobs, options, args.noWait, args.autoResubmit, onComplete = onComplete)
     
 
 if __name__ == '__main__':
@@ -346,6 +677,7 @@ if __name__ == '__main__':
     argParser.add_argument('--first-entry', '-t', metavar = 'ENTRY', dest = 'firstEntry', type = int, default = 0, help = 'First entry number to process.')
     argParser.add_argument('--suffix', '-x', metavar = 'SUFFIX', dest = 'outSuffix', default = '', help = 'Output file suffix.')
     argParser.add_argument('--batch', '-B', action = 'store_true', dest = 'batch', help = 'Use condor-run to run.')
+    argParser.add_argument('--local-jobs', '-J', metavar = 'N', dest = 'localJobs', type = int, default = 0, help = '(With batch option) Run the jobs in N processes on this machine instead of condor.')
     argParser.add_argument('--skip-existing', '-X', action = 'store_true', dest = 'skipExisting', help = 'Do not run skims on files that already exist.')
     argParser.add_argument('--merge', '-M', action = 'store_true', dest = 'merge', help = 'Merge the fragments without running any skim jobs.')
     argParser.add_argument('--selectors', '-s', metavar = 'SELNAME', dest = 'selnames', nargs = '*', default = None, help = 'Selectors to process. With --list, print the selectors configured with the samples.')
@@ -356,6 +688,11 @@ if __name__ == '__main__':
     argParser.add_argument('--resubmit', '-S', action = 'store_true', dest = 'autoResubmit', help = '(Without no-wait option) Automatically release held jobs.')
     argParser.add_argument('--skip-missing', '-K', action = 'store_true', dest = 'skipMissing', help = 'Skip missing files in skim.')
     argParser.add_argument('--open-timeout', '-m', metavar = 'SECONDS', dest = 'openTimeout', type = int, help = 'Timeout for opening input files. Open is attempted every 30 seconds.')
+    argParser.add_argument('--no-preskim-index', '-I', action = 'store_true', dest = 'noPreskimIndex', help = 'Evaluate the preskim on every entry and do not read or write the preskim indices.')
+    argParser.add_argument('--pipeline', '-P', metavar = 'N', dest = 'pipeline', type = int, default = 0, help = '(With batch option) Merge the skim outputs while the jobs run, N filesets or partial merges at a time.')
+    argParser.add_argument('--event-index', '-V', action = 'store_true', dest = 'eventIndex', help = '(With --merge or --pipeline) Update the event indices of the merged skims for cutflow.py --cut-results.')
+    argParser.add_argument('--threads', '-n', metavar = 'N', dest = 'threads', type = int, default = 1, help = 'Split the entries of each skim over N threads.')
+    argParser.add_argument('--merge-procs', '-G', metavar = 'N', dest = 'mergeProcs', type = int, default = 1, help = '(With --merge or --pipeline) Number of parallel merge processes.')
     argParser.add_argument('--test-run', '-E', action = 'store_true', dest = 'testRun', help = 'Don\'t copy the output files to the production area. Sets --filesets to 0000 by default.')
     
     args = argParser.parse_args()
@@ -371,6 +708,10 @@ if __name__ == '__main__':
             logger.error('Cannot use batch mode with individual files.')
             sys.exit(1)
 
+    if args.pipeline > 0 and (not args.batch or args.merge or args.noWait):
+        print 'Pipeline merging requires batch mode without merge and no-wait.'
+        sys.exit(1)
+
     ## directories to include
     thisdir = os.path.dirname(os.path.realpath(__file__))
     basedir = os.path.dirname(thisdir)
@@ -479,6 +820,10 @@ if __name__ == '__main__':
     ## load good lumi filter
     sys.path.append(monoxdir + '/common')
     from goodlumi import makeGoodLumiFilter
+    from rootmerge import mergeFiles, mergeMany
+
+    if args.eventIndex:
+        import eventindex
 
     ## construct and run SkimSlimWeight objects
     ssws = []
@@ -513,20 +858,31 @@ if __name__ == '__main__':
         ## job submission only
         print 'Submitting jobs.'
        
-        batchManager = SSWBatchManager(ssws)
+        if args.localJobs > 0:
+            batchManager = SSWBatchManager(ssws, LocalExecutor(args.localJobs))
+        else:
+            batchManager = SSWBatchManager(ssws)
+
         if args.catalog:
             batchManager.catalogDir = args.catalog
 
         if args.merge:
-            batchManager.submitMerge(args)
+            failed = batchManager.submitMerge(args)
+        elif args.pipeline > 0:
+            pipeline = MergePipeline(ssws, args.pipeline, nproc = args.mergeProcs)
+            failed = batchManager.submitSkim(args, onComplete = pipeline.jobDone)
+            failed += pipeline.finish()
         else:
-            batchManager.submitSkim(args)
+            failed = batchManager.submitSkim(args)
 
-        if args.noWait:
+        if args.noWait and args.localJobs == 0:
             print 'Jobs have been submitted.'
         else:
             print 'All jobs finished.'
 
+        if len(failed) != 0:
+            sys.exit(1)
+
     else:
         if args.merge:
             print 'Merging.'
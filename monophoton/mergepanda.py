@@ -11,9 +11,16 @@ import array
 import shutil
 import string
 import random
+import sqlite3
 import subprocess
+import multiprocessing
 import mysql.connector as mc
 from argparse import ArgumentParser
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
     
 argParser = ArgumentParser(description = 'Plot and count')
 argParser.add_argument('indir', metavar = 'PATH', help = 'Input directory name.')
@@ -24,12 +31,19 @@ argParser.add_argument('--log', '-l', metavar = 'PATH', dest = 'logdir', default
 argParser.add_argument('--num-merge', '-n', metavar = 'N', dest = 'nmerge', type = int, default = 50, help = 'Number of input files per output.')
 argParser.add_argument('--num-out', '-o', metavar = 'N', dest = 'nout', type = int, default = 0, help = 'Number of output files to make. 0 = continue until all input are consumed.')
 argParser.add_argument('--edm', '-E', action = 'store_true', dest = 'edm', help = 'Merge EDM input using cmsRun merge.py.')
+argParser.add_argument('--daemon', '-D', action = 'store_true', dest = 'daemon', help = 'Keep running, watching the input directory for new files.')
+argParser.add_argument('--workers', '-j', metavar = 'N', dest = 'nworkers', type = int, default = 4, help = '(With --daemon) Number of processes validating the inputs.')
+argParser.add_argument('--max-wait', '-w', metavar = 'SECONDS', dest = 'maxwait', type = int, default = 1800, help = '(With --daemon) Merge an incomplete batch when its first input has waited this long.')
+argParser.add_argument('--sqlite', '-q', metavar = 'PATH', dest = 'sqlite', default = '', help = 'Use an SQLite file instead of the MySQL bookkeeping database.')
 
 args = argParser.parse_args()
 sys.argv = []
 
 import ROOT
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))) + '/common')
+from rootmerge import mergeFiles
+
 if not os.path.isdir(args.logdir):
     try:
         os.makedirs(args.logdir)
@@ -41,6 +55,9 @@ if args.edm:
 else:
     keynames = set(['ElectronTriggerObject', 'MuonTriggerObject', 'PhotonTriggerObject', 'RecoilCategory', 'events', 'runs', 'lumiSummary', 'hlt', 'hNPVReco', 'hNPVTrue', 'hSumW', 'eventcounter'])
 
+# inputs modified more recently than this (seconds) may still be being written
+settleTime = 300
+
 def rm(infile, path = ''):
     if not path:
         path = infile.GetName()
@@ -109,54 +126,76 @@ def distinct(events1, events2):
 
     return result
 
-def writepanda(inpaths, outfname):
-    output = ROOT.TFile.Open(outfname, 'recreate')
-
-    chain = ROOT.TChain('events')
-    for inpath in inpaths:
-        chain.Add(inpath)
-
-    output.cd()
-    events = chain.CloneTree()
-    events.Write()
-    chain = None
+def validate(inpath):
+    """
+    Check that the input is complete and distinct from its post-processed copies. Returns (inpath, status) with
+    status 'valid', 'bad' (cannot be read), or 'duplicate' (overlaps with a post-processed copy).
+    Bad and duplicate inputs are moved to garbage. The claim of a bad input is released, while that of a duplicate
+    is kept so that the input is logged with the output it was claimed for.
+    """
+
+    instuff = opensanitize(inpath)
+    if not instuff:
+        return inpath, 'bad'
+
+    infile, inevents = instuff
+
+    if args.postdir:
+        fname = os.path.basename(inpath)
+        dname = args.postdir + '/' + fname.replace('.root', '')
+        pnames = []
+        if os.path.isdir(dname):
+            for pname in os.listdir(dname):
+                pnames.append(dname + '/' + pname)
+
+        elif os.path.exists(args.postdir + '/' + fname):
+            pnames.append(args.postdir + '/' + fname)
+
+        for pname in pnames:
+            pstuff = opensanitize(pname)
+            if not pstuff:
+                continue
 
-    chain = ROOT.TChain('lumiSummary')
-    for inpath in inpaths:
-        chain.Add(inpath)
+            pfile, pevents = pstuff
 
-    output.cd()
-    lumiSummary = chain.CloneTree()
-    lumiSummary.Write()
-    chain = None
+            isdistinct = distinct(inevents, pevents)
+            if not isdistinct:
+                rm(infile)
 
-    hists_to_merge = {}
+            pfile.Close()
+            if not isdistinct:
+                return inpath, 'duplicate'
 
-    for inpath in inpaths:
-        source = ROOT.TFile.Open(inpath)
+    infile.Close()
 
-        for key in source.GetListOfKeys():
-            if key.GetClassName() == 'TH1D':
-                try:
-                    source.cd()
-                    hists_to_merge[key.GetName()].Add(key.ReadObj())
-                except KeyError:
-                    output.cd()
-                    hists_to_merge[key.GetName()] = key.ReadObj().Clone()
+    return inpath, 'valid'
 
-            elif key.GetClassName() == 'TTree' and inpath == inpaths[0]:
-                output.cd()
-                key.ReadObj().CloneTree().Write()
+def retire(inpath):
+    """
+    Move a merged input to the post-process directory or delete it.
+    """
 
-        source.Close()
+    if args.postdir:
+        fname = os.path.basename(inpath)
+        pdirname = args.postdir + '/' + fname.replace('.root', '')
+        pname = args.postdir + '/' + fname
+        if os.path.isdir(pdirname):
+            idx = len(os.listdir(pdirname))
+            os.rename(inpath, pdirname + ('/%d_%s' % (idx, fname)))
+        elif os.path.exists(pname):
+            os.mkdir(pdirname)
+            os.rename(pname, pdirname + '/0_' + fname)
+            os.rename(inpath, pdirname + '/1_' + fname)
+        else:
+            os.rename(inpath, pname)
 
-    output.cd()
-    events.Write()
-    lumiSummary.Write()
-    for hist in hists_to_merge.itervalues():
-        hist.Write()
+    else:
+        os.unlink(inpath)
 
-    output.Close()
+def writepanda(inpaths, outfname):
+    # only the event and lumi trees are concatenated; other trees are taken from the first input
+    if not mergeFiles(inpaths, outfname, chainTrees = ['events', 'lumiSummary']):
+        return False
 
     source = ROOT.TFile.Open(outfname)
     if not source:
@@ -224,19 +263,248 @@ class SynchDB(object):
             self.dbconn = None
 
 
-iout = 0
+class SQLiteSynchDB(SynchDB):
+    """
+    Stand-in for the MySQL bookkeeping database. A write transaction takes the role of the table locks.
+    """
 
-while True:
-    if iout == args.nout:
-        break
+    def __init__(self, path):
+        SynchDB.__init__(self)
+        self.path = path
+
+    def connect(self):
+        self.dbconn = sqlite3.connect(self.path, timeout = 600., isolation_level = None)
+        self.cursor = self.dbconn.cursor()
+        self.cursor.execute('CREATE TABLE IF NOT EXISTS `inputs` (`path` TEXT, `outpath` TEXT)')
+        self.cursor.execute('CREATE TABLE IF NOT EXISTS `logs` (`path` TEXT, `outpath` TEXT)')
+        self.cursor.execute('BEGIN IMMEDIATE')
+
+    def execute(self, query, *args):
+        self.cursor.execute(query.replace('%s', '?'), args)
 
+    def close(self):
+        if self.cursor:
+            self.cursor.execute('COMMIT')
+            self.cursor.close()
+            self.cursor = None
+
+        if self.dbconn:
+            self.dbconn.close()
+            self.dbconn = None
+
+
+def makedb():
+    if args.sqlite:
+        return SQLiteSynchDB(args.sqlite)
+    else:
+        return SynchDB()
+
+def makeoutname():
     while True:
         outbase = ''.join(random.sample(string.hexdigits, 16)) + '.root'
         outname = args.outdir + '/' + outbase
         if not os.path.exists(outname):
-            break
+            return outbase, outname
+
+
+class DirectoryWatcher(object):
+    """
+    Stream of files appearing in a directory. Uses inotify through pyinotify if available, otherwise
+    re-lists the directory only when its modification time changes. Files present at start are reported
+    at the first poll.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._seen = set()
+        self._mtime = 0.
+        self._events = []
+        self._notifier = None
+
+        if pyinotify is not None:
+            wm = pyinotify.WatchManager()
+            self._notifier = pyinotify.Notifier(wm, default_proc_fun = lambda event: self._events.append(event.pathname))
+            wm.add_watch(path, pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO)
+
+    def _list(self):
+        mtime = os.stat(self.path).st_mtime
+        if mtime == self._mtime:
+            return []
+
+        self._mtime = mtime
+
+        names = set(os.listdir(self.path))
+        new = names - self._seen
+        # forget removed files so that a file with the same name is reported again
+        self._seen = names
+
+        return [self.path + '/' + name for name in sorted(new)]
+
+    def poll(self, timeout):
+        """
+        Return the list of new paths, waiting up to timeout seconds for at least one.
+        """
+
+        if self._notifier is not None:
+            if len(self._seen) == 0 and self._mtime == 0.:
+                paths = self._list()
+                if len(paths) != 0:
+                    return paths
+
+            if self._notifier.check_events(timeout * 1000):
+                self._notifier.read_events()
+                self._notifier.process_events()
+
+            paths = self._events
+            self._events = []
+            return paths
+
+        start = time.time()
+        while True:
+            paths = self._list()
+            if len(paths) != 0 or time.time() - start > timeout:
+                return paths
+
+            time.sleep(min(10., timeout))
 
-    db = SynchDB()
+
+def rundaemon():
+    """
+    Merge inputs as they appear. Inputs are claimed in the bookkeeping database in one transaction per
+    batch, validated in a process pool, and released or logged in one transaction per output.
+    """
+
+    watcher = DirectoryWatcher(args.indir)
+    pool = multiprocessing.Pool(args.nworkers)
+
+    candidates = set() # new paths not yet old enough or not yet claimed
+    inpaths = [] # validated and claimed inputs for the current output
+    firstTime = 0.
+
+    outbase, outname = makeoutname()
+
+    iout = 0
+
+    try:
+        while iout != args.nout:
+            candidates.update(watcher.poll(60))
+
+            now = time.time()
+            ready = []
+            for inpath in sorted(candidates):
+                try:
+                    mtime = os.stat(inpath).st_mtime
+                except OSError:
+                    # gone
+                    candidates.remove(inpath)
+                    continue
+
+                if mtime < now - settleTime:
+                    ready.append(inpath)
+
+            ready = ready[:args.nmerge - len(inpaths)]
+
+            if len(ready) != 0:
+                # claim in one transaction
+                claimed = []
+
+                db = makedb()
+                db.connect()
+                try:
+                    for inpath in ready:
+                        candidates.remove(inpath)
+
+                        db.execute('SELECT COUNT(*) FROM `inputs` WHERE `path` = %s', inpath)
+                        if db.cursor.fetchall()[0][0] == 0:
+                            db.execute('INSERT INTO `inputs` VALUES (%s, %s)', inpath, outname)
+                            claimed.append(inpath)
+                finally:
+                    db.close()
+
+                unused = []
+                for inpath, status in pool.imap_unordered(validate, claimed):
+                    if status == 'valid':
+                        print '-->', inpath
+                        inpaths.append(inpath)
+                    elif status == 'bad':
+                        unused.append(inpath)
+
+                if len(unused) != 0:
+                    db.connect()
+                    try:
+                        for inpath in unused:
+                            db.execute('DELETE FROM `inputs` WHERE `path` = %s', inpath)
+                    finally:
+                        db.close()
+
+                if len(inpaths) != 0 and firstTime == 0.:
+                    firstTime = time.time()
+
+            if len(inpaths) == 0:
+                continue
+
+            if len(inpaths) < args.nmerge and time.time() - firstTime < args.maxwait:
+                continue
+
+            success = False
+            try:
+                if args.edm:
+                    success = writeedm(inpaths, '/tmp/' + outbase)
+                else:
+                    success = writepanda(inpaths, '/tmp/' + outbase)
+
+                if success:
+                    print outname
+                    shutil.copy('/tmp/' + outbase, outname)
+
+                    for inpath in inpaths:
+                        retire(inpath)
+
+            finally:
+                db = makedb()
+                db.connect()
+                try:
+                    if success:
+                        db.execute('INSERT INTO `logs` SELECT * FROM `inputs` WHERE `outpath` = %s', outname)
+                    db.execute('DELETE FROM `inputs` WHERE `outpath` = %s', outname)
+                finally:
+                    db.close()
+
+                if os.path.exists('/tmp/' + outbase):
+                    os.unlink('/tmp/' + outbase)
+
+            inpaths = []
+            firstTime = 0.
+            outbase, outname = makeoutname()
+
+            iout += 1
+
+    finally:
+        pool.close()
+        pool.join()
+
+        # release the claims of the unfinished output (also held by duplicates when inpaths is empty)
+        db = makedb()
+        db.connect()
+        try:
+            db.execute('DELETE FROM `inputs` WHERE `outpath` = %s', outname)
+        finally:
+            db.close()
+
+
+if args.daemon:
+    rundaemon()
+    sys.exit(0)
+
+iout = 0
+
+while True:
+    if iout == args.nout:
+        break
+
+    outbase, outname = makeoutname()
+
+    db = makedb()
 
     try:
         inpaths = []
@@ -248,7 +516,7 @@ while True:
     
             db.connect()
     
-            if os.path.exists(inpath) and os.stat(inpath).st_mtime < time.time() - 300:
+            if os.path.exists(inpath) and os.stat(inpath).st_mtime < time.time() - settleTime:
                 db.execute('SELECT COUNT(*) FROM `inputs` WHERE `path` = %s', inpath)
                 if db.cursor.fetchall()[0][0] == 0:
                     db.execute('INSERT INTO `inputs` VALUES (%s, %s)', inpath, outname)
@@ -259,44 +527,11 @@ while True:
             if not do_open:
                 continue
 
-            instuff = opensanitize(inpath)
-            if not instuff:
+            _, status = validate(inpath)
+            if status == 'bad':
                 unused.append(inpath)
+            if status != 'valid':
                 continue
-
-            infile, inevents = instuff
-    
-            if args.postdir:
-                dname = args.postdir + '/' + fname.replace('.root', '')
-                pnames = []
-                if os.path.isdir(dname):
-                    for pname in os.listdir(dname):
-                        pnames.append(dname + '/' + pname)
-
-                elif os.path.exists(args.postdir + '/' + fname):
-                    pnames.append(args.postdir + '/' + fname)
-
-                isdistinct = True
-
-                for pname in pnames:
-                    pstuff = opensanitize(pname)
-                    if not pstuff:
-                        continue
-
-                    pfile, pevents = pstuff
-
-                    if not distinct(inevents, pevents):
-                        isdistinct = False
-                        rm(infile)
-
-                    pfile.Close()
-                    if not isdistinct:
-                        break
-
-                if not isdistinct:
-                    continue
-
-            infile.Close()
     
             print '-->', inpath
             inpaths.append(inpath)
@@ -325,22 +560,7 @@ while True:
             db.connect()
     
             for inpath in inpaths:
-                if args.postdir:
-                    fname = os.path.basename(inpath)
-                    pdirname = args.postdir + '/' + fname.replace('.root', '')
-                    pname = args.postdir + '/' + fname
-                    if os.path.isdir(pdirname):
-                        idx = len(os.listdir(pdirname))
-                        os.rename(inpath, pdirname + ('/%d_%s' % (idx, fname)))
-                    elif os.path.exists(pname):
-                        os.mkdir(pdirname)
-                        os.rename(pname, pdirname + '/0_' + fname)
-                        os.rename(inpath, pdirname + '/1_' + fname)
-                    else:
-                        os.rename(inpath, pname)
-    
-                else:
-                    os.unlink(inpath)
+                retire(inpath)
 
             for path in unused:
                 db.execute('DELETE FROM `inputs` WHERE `path` = %s', path)
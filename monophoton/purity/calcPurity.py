@@ -4,6 +4,8 @@ import os
 import sys
 import collections
 import time
+import math
+import multiprocessing
 import ROOT
 
 thisdir = os.path.dirname(os.path.realpath(__file__))
@@ -30,6 +32,10 @@ QUICKFIT = False # just run one main fit
 FORCEHIST = True # redraw input histograms
 ITERATIVE = False # use iterative method instead of SignalSubtraction.cc
 DOTOYS = True
+TOYJOBS = multiprocessing.cpu_count() # number of processes fitting the toys
+TOYPLOTS = False # save the histogram and the fit plots of each toy
+SAVETOYS = False # save per-toy results to toys/toys.npz
+TOYSEED = 4357 # seed of the toy templates, fixed (as the default gRandom seed was) so that the toys are reproducible
 
 ### take inputs and make sure they match a selection
 loc = sys.argv[1] # barrel, endcap
@@ -338,7 +344,7 @@ def plotSSFit(fitter, purity, nReal, name = '', pdir = plotDir):
 
     canvas.printWeb(pdir, 'ssfit_' + name + '_logy', rList = [iFit, iTarget], logy = True)
     
-def runSSFit(datasb, mcsb, sbRatio, name = '', pdir = plotDir, mcsig = hMCSignal):
+def runSSFit(datasb, mcsb, sbRatio, name = '', pdir = plotDir, mcsig = hMCSignal, plot = True):
     if not ITERATIVE:
         ssfitter.initialize(hDataTarg, mcsig, datasb, mcsb, sbRatio)
         ssfitter.fit()
@@ -348,16 +354,15 @@ def runSSFit(datasb, mcsb, sbRatio, name = '', pdir = plotDir, mcsig = hMCSignal
         nFake = ssfitter.getNbkg(cutBin)
         aveSig = s.StatUncert(nReal, nFake)
 
-        if name:
-            if not 'toy' in name:
-                plotSSFit(ssfitter, purity, nReal, name, pdir)
+        if name and plot:
+            plotSSFit(ssfitter, purity, nReal, name, pdir)
 
     else:
         skims = ['Target', 'Signal', 'Contam', 'Sideband']
         hists = [hDataTarg, mcsig, mcsb, datasb]
         rooVar = ROOT.RooRealVar(var.name, var.title, var.binning[1], var.binning[2])
-        templates = [s.HistToTemplate(hist, rooVar, skims[iH], 'v0_'+inputKey, pdir) for iH, hist in enumerate(hists)]
-        (purity, aveSig, nReal, nFake) = s.SignalSubtraction(skims, hists, templates, sbRatio, var.name, rooVar, var.cuts[pid], inputKey, pdir)
+        templates = [s.HistToTemplate(hist, rooVar, skims[iH], 'v0_'+inputKey, pdir, _plot = plot) for iH, hist in enumerate(hists)]
+        (purity, aveSig, nReal, nFake) = s.SignalSubtraction(skims, hists, templates, sbRatio, var.name, rooVar, var.cuts[pid], inputKey, pdir, _plot = plot)
 
 
     return FitResult(purity, aveSig, nReal, nFake)
@@ -421,7 +426,43 @@ print '\n'
 
 NTOYS = 200
 
+def makeToyHist(counts, name = 'toyhist'):
+    """
+    Background template with bin contents replaced by one row of the multinomial draw.
+    """
+
+    toyHist = hDataBkgNom.Clone(name)
+    toyHist.Reset()
+    for iBin, count in enumerate(counts):
+        toyHist.SetBinContent(iBin + 1, count)
+        toyHist.SetBinError(iBin + 1, math.sqrt(count))
+
+    toyHist.SetEntries(counts.sum())
+
+    return toyHist
+
+def fitToy(iToy):
+    """
+    Fit the iToy-th row of toyCounts. Run in the worker processes, which inherit the templates and toyCounts.
+    """
+
+    toyHist = makeToyHist(toyCounts[iToy])
+
+    if TOYPLOTS:
+        toyHist.Draw()
+
+        tempName = os.path.join(toysDir, 'toy%d' % (iToy + 1))
+        canvas.SaveAs(tempName+'.pdf')
+        canvas.SaveAs(tempName+'.png')
+        canvas.SaveAs(tempName+'.C')
+
+    toyResult = runSSFit(toyHist, hMCSBNom, nominalRatio, 'toy%d' % (iToy + 1), pdir = toysDir, plot = TOYPLOTS)
+
+    return toyResult.purity, toyResult.nReal
+
 if DOTOYS:
+    import numpy
+
     ### Get background stat uncertainty
     toyPlot = ROOT.TH1F("toyplot","Impurity Difference from Background Template Toys", 200, -0.010, 0.010)
     toyPlotYield = ROOT.TH1F("toyplotyield","True Photon Yield Difference from Background Template Toys", 200, -1000, 1000)
@@ -432,30 +473,33 @@ if DOTOYS:
     eventsToGenerate = int(hDataBkgNom.GetSumOfWeights())
     print eventsToGenerate
 
-    for iToy in range(1, NTOYS + 1):
-        print "\n###############\n#### Toy "+str(iToy)+" ####\n###############\n"
+    # FillRandom samples the in-range bins in proportion to their contents; the bin counts of NTOYS such toys
+    # are one multinomial draw of shape (NTOYS, nbins)
+    template = numpy.array([max(hDataBkgNom.GetBinContent(iBin), 0.) for iBin in range(1, hDataBkgNom.GetNbinsX() + 1)])
+    toyCounts = numpy.random.RandomState(TOYSEED).multinomial(eventsToGenerate, template / template.sum(), size = NTOYS).astype(numpy.float64)
 
-        toyHist = hDataBkgNom.Clone('toyhist')
-        toyHist.Reset()
-        toyHist.FillRandom(hDataBkgNom, eventsToGenerate)
+    print 'Fitting', NTOYS, 'toys in', TOYJOBS, 'processes'
 
-        toyHist.Draw()
+    if TOYJOBS > 1:
+        pool = multiprocessing.Pool(TOYJOBS)
+        toyResults = pool.map(fitToy, range(NTOYS))
+        pool.close()
+        pool.join()
+    else:
+        toyResults = map(fitToy, range(NTOYS))
 
-        tempName = os.path.join(toysDir, 'toy%d' % iToy)
-        canvas.SaveAs(tempName+'.pdf')
-        canvas.SaveAs(tempName+'.png')
-        canvas.SaveAs(tempName+'.C')
+    toyResults = numpy.array(toyResults, dtype = numpy.float64)
 
-        toyResult = runSSFit(toyHist, hMCSBNom, nominalRatio, 'toy%d' % iToy, pdir = toysDir)
+    purityDiffs = toyResults[:, 0] - nominalResult.purity
+    yieldDiffs = toyResults[:, 1] - nominalResult.nReal
 
-        purityDiff = toyResult.purity - nominalResult.purity
-        print "Purity diff is:", purityDiff
+    for purityDiff, yieldDiff in zip(purityDiffs, yieldDiffs):
         toyPlot.Fill(purityDiff)
-
-        yieldDiff = toyResult.nReal - nominalResult.nReal
-        print "Yield diff is:", yieldDiff
         toyPlotYield.Fill(yieldDiff)
 
+    if SAVETOYS:
+        numpy.savez_compressed(os.path.join(toysDir, 'toys.npz'), counts = toyCounts, purity = toyResults[:, 0], nReal = toyResults[:, 1])
+
     bkgdUncertainty = toyPlot.GetStdDev()
     bkgdUncYield = toyPlotYield.GetStdDev()
 
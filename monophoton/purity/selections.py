@@ -33,6 +33,9 @@ sphLumi = sum(allsamples[s].lumi for s in sphData)
 
 lowpt = True
 
+# fill templates with the vectorized backend (common/columndraw.py) where the expressions allow
+columnar = False
+
 ### Various load-time operations ###
 
 versionDir =  config.histDir + '/purity/' + Version
@@ -46,6 +49,9 @@ ROOT.gROOT.ProcessLine("double cutvalue;")
 
 ROOT.gROOT.LoadMacro(basedir + '/../common/MultiDraw.cc+')
 
+sys.path.append(basedir + '/../common')
+from columndraw import ColumnDraw
+
 ### Statics ###
 
 Tunes = ['Spring15', 'Spring16', 'GJetsCWIso', 'ZGCWIso']
@@ -191,7 +197,10 @@ def getVariable(vname, tune, location):
 class HistExtractor(object):
     def __init__(self, name, snames, variable):
         self.name = name
-        self.plotter = ROOT.MultiDraw()
+        if columnar:
+            self.plotter = ColumnDraw(config.columnCacheDir)
+        else:
+            self.plotter = ROOT.MultiDraw()
         for sname in snames:
             if lowpt:
                 self.plotter.addInputPath(utils.getSkimPath(sname, 'ph75'))
@@ -277,7 +286,7 @@ def StatUncert(nReal, nFake):
 ######### Legacy Iterative Code ##########
 ##########################################
 
-def HistToTemplate(_hist,_var,_skim,_selName,_plotDir):
+def HistToTemplate(_hist,_var,_skim,_selName,_plotDir,_plot = True):
     # remove negative weights
     for bin in range(_hist.GetNbinsX()+1):
         binContent = _hist.GetBinContent(bin)
@@ -293,6 +302,9 @@ def HistToTemplate(_hist,_var,_skim,_selName,_plotDir):
     tempname = 'template_'+_skim+'_'+_selName
     print _var
     temp = ROOT.RooDataHist(tempname, tempname, ROOT.RooArgList(_var), _hist)
+
+    if not _plot:
+        return temp
     
     canvas = ROOT.TCanvas()
     frame = _var.frame()
@@ -311,7 +323,7 @@ def HistToTemplate(_hist,_var,_skim,_selName,_plotDir):
     return temp
 
 # Fitting function
-def FitTemplates(_name,_title,_var,_cut,_datahist,_sigtemp,_bkgtemp):
+def FitTemplates(_name,_title,_var,_cut,_datahist,_sigtemp,_bkgtemp,_plot = True):
     nEvents = _datahist.sumEntries()
     sigpdf = ROOT.RooHistPdf('sig', 'sig', ROOT.RooArgSet(_var), _sigtemp) #, 2)
     bkgpdf = ROOT.RooHistPdf('bkg', 'bkg', ROOT.RooArgSet(_var), _bkgtemp) #, 2)
@@ -320,21 +332,6 @@ def FitTemplates(_name,_title,_var,_cut,_datahist,_sigtemp,_bkgtemp):
     model = ROOT.RooAddPdf("model", "model", ROOT.RooArgList(sigpdf, bkgpdf), ROOT.RooArgList(nsig, nbkg))
     model.fitTo(_datahist) # , Extended(True), Minimizer("Minuit2", "migrad"))
     
-    canvas = ROOT.TCanvas()
-
-    frame = _var.frame()
-    frame.SetTitle(_title)
-    # frame.SetMinimum(0.001)
-    # frame.SetMaximum(10000)
-
-    _datahist.plotOn(frame, ROOT.RooFit.Name("data"))
-    model.plotOn(frame, ROOT.RooFit.Name("Fit"))
-    model.plotOn(frame, ROOT.RooFit.Components('bkg'),ROOT.RooFit.Name("fake"),ROOT.RooFit.LineStyle(ROOT.kDashed),ROOT.RooFit.LineColor(ROOT.kGreen))
-    model.plotOn(frame, ROOT.RooFit.Components('sig'),ROOT.RooFit.Name("real"),ROOT.RooFit.LineStyle(ROOT.kDashed),ROOT.RooFit.LineColor(ROOT.kRed))
-
-    
-    frame.Draw("goff")
-    
     _var.setRange("selection",0.0,_cut)
     
     fReal = float(sigpdf.createIntegral(ROOT.RooArgSet(_var), "selection").getVal()) / float(sigpdf.createIntegral(ROOT.RooArgSet(_var)).getVal())
@@ -356,6 +353,24 @@ def FitTemplates(_name,_title,_var,_cut,_datahist,_sigtemp,_bkgtemp):
     downSig = purity - lower;
     aveSig = float(upSig + downSig) / 2.0;
 
+    if not _plot:
+        return (purity, aveSig, nReal, nFake)
+
+    canvas = ROOT.TCanvas()
+
+    frame = _var.frame()
+    frame.SetTitle(_title)
+    # frame.SetMinimum(0.001)
+    # frame.SetMaximum(10000)
+
+    _datahist.plotOn(frame, ROOT.RooFit.Name("data"))
+    model.plotOn(frame, ROOT.RooFit.Name("Fit"))
+    model.plotOn(frame, ROOT.RooFit.Components('bkg'),ROOT.RooFit.Name("fake"),ROOT.RooFit.LineStyle(ROOT.kDashed),ROOT.RooFit.LineColor(ROOT.kGreen))
+    model.plotOn(frame, ROOT.RooFit.Components('sig'),ROOT.RooFit.Name("real"),ROOT.RooFit.LineStyle(ROOT.kDashed),ROOT.RooFit.LineColor(ROOT.kRed))
+
+    
+    frame.Draw("goff")
+
     text = ROOT.TLatex()
     text.DrawLatexNDC(0.525,0.8,"Purity: "+str(round(purity,3))+'#pm'+str(round(aveSig,3))) 
 
@@ -381,7 +396,7 @@ def FitTemplates(_name,_title,_var,_cut,_datahist,_sigtemp,_bkgtemp):
 
     return (purity, aveSig, nReal, nFake)
 
-def SignalSubtraction(_skims,_initialHists,_initialTemplates,_isoRatio,_varName,_var,_cut,_inputKey,_plotDir):
+def SignalSubtraction(_skims,_initialHists,_initialTemplates,_isoRatio,_varName,_var,_cut,_inputKey,_plotDir,_plot = True):
     ''' initialHists = [ fit template, signal template, subtraction template, background template ]'''
     nIter = 0
     purities = [ (1,1,1,1) ]
@@ -396,7 +411,7 @@ def SignalSubtraction(_skims,_initialHists,_initialTemplates,_isoRatio,_varName,
         dataName = os.path.join(WEBDIR + '/' + _plotDir,"purity_"+"v"+str(nIter)+"_"+_inputKey )
         
         print _var
-        dataPurity = FitTemplates(dataName, dataTitle, _var, _cut, templates[0], templates[1], templates[-1])
+        dataPurity = FitTemplates(dataName, dataTitle, _var, _cut, templates[0], templates[1], templates[-1], _plot = _plot)
        
         """
         sbTotal = templates[3].sumEntries()
@@ -431,14 +446,14 @@ def SignalSubtraction(_skims,_initialHists,_initialTemplates,_isoRatio,_varName,
         hists.append(contamHist)
 
         print _var
-        contamTemp = HistToTemplate(contamHist,_var,_skims[2],"v"+str(nIter)+"_"+_inputKey,_plotDir)
+        contamTemp = HistToTemplate(contamHist,_var,_skims[2],"v"+str(nIter)+"_"+_inputKey,_plotDir,_plot = _plot)
         templates.append(contamTemp)
     
         backHist = hists[3].Clone()
         backHist.Add(contamHist, -1)
         hists.append(backHist)
 
-        backTemp = HistToTemplate(backHist,_var,_skims[3],"v"+str(nIter)+"_"+_inputKey,_plotDir)
+        backTemp = HistToTemplate(backHist,_var,_skims[3],"v"+str(nIter)+"_"+_inputKey,_plotDir,_plot = _plot)
         templates.append(backTemp)
 
     """
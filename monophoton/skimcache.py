@@ -0,0 +1,345 @@
+#!/usr/bin/env python
+
+"""
+Managed local copies of the skim files.
+
+Skims are copied to config.skimCacheDir (disabled if empty), keeping their mtime, so that a cached copy is
+valid exactly when its size and mtime match the source. Copies mirror the full path of the source under the cache
+directory, so that skims of the same name in different directories do not collide. The access time of a copy is set whenever it is handed
+out and is the key of the least-recently-used eviction that keeps the cache under config.skimCacheQuota.
+utils.getSkimPath returns valid copies transparently; copies are made only by prefetch.
+
+Each process appends its hit / miss counts to <cache>/stats.log at exit.
+
+Usage:
+  skimcache.py SAMPLE [...] -R REGION [...]  prefetch the skims of each sample in each region
+  skimcache.py --config CONFIG               prefetch the skims read by plot.py CONFIG
+  skimcache.py --report                      print the cache content and the accumulated hit / miss counts
+"""
+
+import os
+import sys
+import time
+import shutil
+import atexit
+import multiprocessing
+
+thisdir = os.path.dirname(os.path.realpath(__file__))
+if thisdir not in sys.path:
+    sys.path.append(thisdir)
+
+import config
+
+def fetchFile(job):
+    """
+    Copy source to target through a temporary file. Return (source, success).
+    """
+
+    source, target = job
+
+    tmpPath = target + '.tmp%d' % os.getpid()
+    try:
+        try:
+            os.makedirs(os.path.dirname(target))
+        except OSError:
+            pass
+
+        shutil.copy2(source, tmpPath)
+        # a new copy counts as just used
+        os.utime(tmpPath, (time.time(), os.stat(tmpPath).st_mtime))
+        os.rename(tmpPath, target)
+    except (IOError, OSError):
+        if os.path.exists(tmpPath):
+            os.remove(tmpPath)
+
+        return source, False
+
+    return source, True
+
+def formatSize(nbytes):
+    for unit in ['B', 'kB', 'MB', 'GB']:
+        if nbytes < 1024.:
+            return '%.1f %s' % (nbytes, unit)
+
+        nbytes /= 1024.
+
+    return '%.1f TB' % nbytes
+
+
+class SkimCache(object):
+    def __init__(self, cacheDir, quota):
+        self.cacheDir = cacheDir
+        self.quota = quota
+
+        self.hits = 0
+        self.misses = 0
+        self.hitBytes = 0
+        self.missBytes = 0
+
+    def cachePath(self, source):
+        return self.cacheDir + '/' + os.path.abspath(source).lstrip('/')
+
+    def isValid(self, source):
+        """
+        True if there is a copy of source with the same size and mtime.
+        """
+
+        try:
+            sstat = os.stat(source)
+            cstat = os.stat(self.cachePath(source))
+        except OSError:
+            return False
+
+        return cstat.st_size == sstat.st_size and int(cstat.st_mtime) == int(sstat.st_mtime)
+
+    def lookup(self, source):
+        """
+        Return the path of the valid copy of source, or source itself.
+        """
+
+        if self.isValid(source):
+            path = self.cachePath(source)
+            stat = os.stat(path)
+            # mark as recently used; mtime is kept for the validation
+            os.utime(path, (time.time(), stat.st_mtime))
+
+            self.hits += 1
+            self.hitBytes += stat.st_size
+
+            return path
+
+        self.misses += 1
+        if os.path.exists(source):
+            self.missBytes += os.stat(source).st_size
+
+        return source
+
+    def content(self):
+        """
+        List of (path, size, last access) of the cached files, least recently used first.
+        """
+
+        files = []
+        for dirpath, dirnames, filenames in os.walk(self.cacheDir):
+            for name in filenames:
+                if not name.endswith('.root'):
+                    continue
+
+                stat = os.stat(dirpath + '/' + name)
+                files.append((dirpath + '/' + name, stat.st_size, stat.st_atime))
+
+        files.sort(key = lambda f: f[2])
+
+        return files
+
+    def evict(self, needed, keep = []):
+        """
+        Remove least recently used files until needed bytes fit in the quota. Files in keep are not removed.
+        Return the number of bytes that still do not fit.
+        """
+
+        files = self.content()
+        used = sum(f[1] for f in files)
+
+        for path, size, _ in files:
+            if used + needed <= self.quota:
+                break
+
+            if path in keep:
+                continue
+
+            print 'Evicting', path
+            os.remove(path)
+            used -= size
+
+        return max(0, used + needed - self.quota)
+
+    def prefetch(self, sources, jobs = 1):
+        """
+        Copy the sources that have no valid copy, jobs at a time, evicting old files as necessary.
+        Sources that would not fit in the quota are skipped. Return the list of sources not cached.
+        """
+
+        try:
+            os.makedirs(self.cacheDir)
+        except OSError:
+            pass
+
+        missing = []
+        for source in sources:
+            if not os.path.exists(source):
+                print 'Source', source, 'does not exist'
+            elif not self.isValid(source) and source not in missing:
+                missing.append(source)
+
+        keep = [self.cachePath(source) for source in sources]
+
+        toFetch = []
+        needed = 0
+        for source in missing:
+            size = os.stat(source).st_size
+            if self.evict(needed + size, keep = keep) != 0:
+                print 'Quota exceeded; not caching', source
+                continue
+
+            # stale copy
+            if os.path.exists(self.cachePath(source)):
+                os.remove(self.cachePath(source))
+
+            toFetch.append((source, self.cachePath(source)))
+            needed += size
+
+        if len(toFetch) != 0:
+            print 'Fetching %d files (%s) in %d processes' % (len(toFetch), formatSize(needed), jobs)
+
+        if jobs > 1 and len(toFetch) > 1:
+            pool = multiprocessing.Pool(min(jobs, len(toFetch)))
+            try:
+                results = pool.map(fetchFile, toFetch)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = map(fetchFile, toFetch)
+
+        failed = [source for source, success in results if not success]
+        for source in failed:
+            print 'Failed to copy', source
+
+        return [source for source in sources if not self.isValid(source)]
+
+    def report(self):
+        return 'Skim cache: %d hits (%s read locally), %d misses (%s read from source)' % (self.hits, formatSize(self.hitBytes), self.misses, formatSize(self.missBytes))
+
+    def saveStats(self):
+        if self.hits + self.misses == 0 or not os.path.isdir(self.cacheDir):
+            return
+
+        with open(self.cacheDir + '/stats.log', 'a') as log:
+            log.write('%d %d %d %d %d\n' % (int(time.time()), self.hits, self.misses, self.hitBytes, self.missBytes))
+
+
+_defaultCache = None
+
+def defaultCache():
+    """
+    The cache configured in config, or None if config.skimCacheDir is empty.
+    """
+
+    global _defaultCache
+
+    if _defaultCache is None and config.skimCacheDir:
+        _defaultCache = SkimCache(config.skimCacheDir, config.skimCacheQuota)
+        atexit.register(_defaultCache.saveStats)
+
+    return _defaultCache
+
+def configSkims(plotConfig, allSignal = False):
+    """
+    List of (sample name, region) read by plot.py for the plot config.
+    """
+
+    groups = list(plotConfig.bkgGroups)
+    if allSignal:
+        groups += plotConfig.sigGroups
+
+    skims = []
+
+    def add(sname, region):
+        if (sname, region) not in skims:
+            skims.append((sname, region))
+
+    for group in groups + [plotConfig.obs]:
+        if group.region:
+            region = group.region
+        else:
+            region = plotConfig.name
+
+        for sample in group.samples:
+            add(sample.name, region)
+            for variation in group.variations:
+                if variation.regions is not None:
+                    for vregion in variation.regions:
+                        add(sample.name, vregion)
+
+    if not allSignal:
+        for sspec in plotConfig.signalPoints:
+            add(sspec.sample.name, plotConfig.name)
+
+    return skims
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    argParser = ArgumentParser(description = 'Prefetch skims to the local cache.')
+    argParser.add_argument('snames', metavar = 'SAMPLE', nargs = '*', help = 'Samples to fetch.')
+    argParser.add_argument('--region', '-R', metavar = 'REGION', dest = 'regions', nargs = '+', default = [], help = 'Regions of the samples to fetch.')
+    argParser.add_argument('--config', '-c', metavar = 'CONFIG', dest = 'config', default = '', help = 'Fetch the skims of a plot config.')
+    argParser.add_argument('--all-signal', '-S', action = 'store_true', dest = 'allSignal', help = '(With --config) Include all signal points.')
+    argParser.add_argument('--jobs', '-j', metavar = 'N', dest = 'jobs', type = int, default = 4, help = 'Number of parallel copies.')
+    argParser.add_argument('--quota', '-q', metavar = 'GB', dest = 'quota', type = float, default = 0., help = 'Override config.skimCacheQuota.')
+    argParser.add_argument('--report', '-r', action = 'store_true', dest = 'report', help = 'Print the cache content and the accumulated hit / miss counts.')
+
+    args = argParser.parse_args()
+    sys.argv = []
+
+    if not config.skimCacheDir:
+        print 'config.skimCacheDir is not set.'
+        sys.exit(1)
+
+    cache = SkimCache(config.skimCacheDir, config.skimCacheQuota)
+    if args.quota > 0.:
+        cache.quota = int(args.quota * 1024 ** 3)
+
+    if args.report:
+        files = cache.content()
+        for path, size, atime in reversed(files):
+            print '%-60s %10s  %s' % (os.path.relpath(path, cache.cacheDir), formatSize(size), time.strftime('%Y-%m-%d %H:%M', time.localtime(atime)))
+
+        print '%d files, %s of %s' % (len(files), formatSize(sum(f[1] for f in files)), formatSize(cache.quota))
+
+        counts = [0] * 4
+        if os.path.exists(cache.cacheDir + '/stats.log'):
+            with open(cache.cacheDir + '/stats.log') as log:
+                for line in log:
+                    for i, count in enumerate(line.split()[1:]):
+                        counts[i] += int(count)
+
+        print 'Since start of log: %d hits (%s saved), %d misses (%s read from source)' % (counts[0], formatSize(counts[2]), counts[1], formatSize(counts[3]))
+
+        sys.exit(0)
+
+    if len(args.snames) != 0 and len(args.regions) == 0:
+        print 'Samples given without --region.'
+        sys.exit(1)
+
+    skims = []
+
+    if args.config:
+        from main.plotconfig import getConfig
+        from main.plotconfig_vbf import getConfigVBF
+        from main.plotconfig_ggh import getConfigGGH
+
+        plotConfig = getConfig(args.config)
+        if plotConfig is None:
+            plotConfig = getConfigVBF(args.config)
+        if plotConfig is None:
+            plotConfig = getConfigGGH(args.config)
+        if plotConfig is None:
+            print 'Unknown configuration', args.config
+            sys.exit(1)
+
+        skims.extend(configSkims(plotConfig, allSignal = args.allSignal))
+
+    for sname in args.snames:
+        for region in args.regions:
+            skims.append((sname, region))
+
+    sources = [config.skimDir + '/' + sname + '_' + region + '.root' for sname, region in skims]
+
+    notCached = cache.prefetch(sources, jobs = args.jobs)
+
+    print '%d of %d skims cached' % (len(sources) - len(notCached), len(sources))
+    for source in notCached:
+        print ' not cached:', source
@@ -4,8 +4,9 @@ import sys
 import os
 import array
 import math
-import random
 import collections
+import multiprocessing
+import numpy
 
 thisdir = os.path.dirname(os.path.realpath(__file__))
 basedir = os.path.dirname(thisdir)
@@ -13,11 +14,13 @@ sys.path.append(basedir)
 from datasets import allsamples
 from plotstyle import SimpleCanvas
 from tp.efake_conf import lumiSamples, outputName, outputDir, roofitDictsDir, getBinning, PRODUCT
+import tp.efake_toys as efake_toys
 
 dataType = sys.argv[1]
 binningName = sys.argv[2]
 
 ADDFIT = False
+NPROC = multiprocessing.cpu_count() # processes for the toy fits of ADDFIT
 
 binningTitle, binning, fitBins = getBinning(binningName)
 
@@ -269,54 +272,23 @@ if ADDFIT:
     ntoys = 200
     npx = 100
 
-    variations = []
-    for _ in range(npx):
-        variations.append([])
+    central = [result.GetBinContent(iBin + 1) for iBin in range(result.GetNbinsX())]
+    errors = [math.sqrt(stat * stat + syst * syst) for stat, syst in zip(staterrs, systerrs)]
 
-    power.SetNpx(npx)
-
-    for _ in range(ntoys):
-        toy = result.Clone('toy')
-        toy.Reset()
-
-        psyst = random.gauss(0., 1.)
-
-        for iBin in range(result.GetNbinsX()):
-            stat = staterrs[iBin]
-            syst = systerrs[iBin]
-
-            systShift = syst * psyst
-            statShift = stat * random.gauss(0., 1.)
-
-            toy.SetBinContent(iBin + 1, result.GetBinContent(iBin + 1) + systShift + statShift)
-            toy.SetBinError(iBin + 1, math.sqrt(stat * stat + syst * syst))
-
-        # power is cloned in addObject above - we can modify its parameters
-        toy.Fit(power)
-
-        gr = ROOT.TGraph(power)
-        for ix in range(npx):
-            variations[ix].append(gr.GetY()[ix])
-
-    gup = ROOT.TGraph(npx)
-    gdown = ROOT.TGraph(npx)
+    # power is cloned in addObject above - we can modify its parameters
+    toyContents = efake_toys.throwShifts(central, staterrs, systerrs, ntoys)
+    params = efake_toys.fitToys(result, toyContents, errors, power, nproc = NPROC)
 
     power.SetParameters(*original)
 
-    for ix, var in enumerate(variations):
-        x = (power.GetXmax() - power.GetXmin()) / npx * ix + power.GetXmin()
-        ynom = power.Eval(x)
-        
-        var.sort()
-        iy = 0
-        while iy < ntoys and var[iy] < ynom:
-            iy += 1
+    xvals = numpy.linspace(power.GetXmin(), power.GetXmax(), npx, endpoint = False)
+    variations = efake_toys.powerLaw(params, xvals)
+    ynom = efake_toys.powerLaw(original, xvals)[0]
 
-        up = var[int((ntoys - iy) * 0.68 + iy)]
-        down = var[int(iy * 0.32)]
+    down, up = efake_toys.bands(ynom, variations)
 
-        gup.SetPoint(ix, x, up)
-        gdown.SetPoint(ix, x, down)
+    gup = ROOT.TGraph(npx, xvals, up)
+    gdown = ROOT.TGraph(npx, xvals, down)
 
     gup.SetLineStyle(ROOT.kDashed)
     gup.SetLineColor(power.GetLineColor())
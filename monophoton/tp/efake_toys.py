@@ -0,0 +1,121 @@
+"""
+Batched toy studies for the efake measurement.
+
+Toy inputs are thrown as one array, the per-toy fits are distributed over forked worker processes, and
+the resulting variations are reduced to bands with array operations.
+
+Usage:
+  contents = throwShifts(central, staterrs, systerrs, ntoys)
+  params = fitToys(hist, contents, errors, fcn, nproc = 8)
+  down, up = bands(powerLaw(original, x)[0], powerLaw(params, x))
+"""
+
+import multiprocessing
+
+import numpy
+import ROOT
+
+_toyFunction = None
+
+def _callToy(itoy):
+    return _toyFunction(itoy)
+
+def mapToys(function, ntoys, nproc = 1):
+    """
+    Return [function(itoy) for itoy in range(ntoys)], evaluated in nproc processes.
+    The processes are forked at the time of the call and therefore see the current state of the caller
+    (workspaces, histograms, random seeds). Function must reseed any random generator per toy.
+    """
+
+    global _toyFunction
+
+    if nproc <= 1 or ntoys <= 1:
+        return map(function, range(ntoys))
+
+    _toyFunction = function
+
+    pool = multiprocessing.Pool(min(nproc, ntoys))
+    try:
+        return pool.map(_callToy, range(ntoys))
+    finally:
+        pool.close()
+        pool.join()
+        _toyFunction = None
+
+def throwShifts(central, staterrs, systerrs, ntoys, rng = numpy.random):
+    """
+    Array (ntoys, nbins) of toy bin contents. Each toy shifts the central values by one normal draw times
+    systerrs (fully correlated across bins) plus one independent normal draw per bin times staterrs.
+    """
+
+    central = numpy.asarray(central, dtype = numpy.float64)
+    staterrs = numpy.asarray(staterrs, dtype = numpy.float64)
+    systerrs = numpy.asarray(systerrs, dtype = numpy.float64)
+
+    psyst = rng.normal(size = (ntoys, 1))
+    pstat = rng.normal(size = (ntoys, central.shape[0]))
+
+    return central + systerrs * psyst + staterrs * pstat
+
+def fitToys(hist, contents, errors, fcn, option = 'QN0', nproc = 1):
+    """
+    Fit fcn to copies of hist whose bin contents are the rows of contents (errors can be a single row
+    shared by all toys). Every fit starts from the current parameters of fcn.
+    Returns the array (ntoys, npar) of fitted parameters; fcn itself is left unchanged.
+    """
+
+    contents = numpy.asarray(contents, dtype = numpy.float64)
+    errors = numpy.asarray(errors, dtype = numpy.float64)
+    if errors.ndim == 1:
+        errors = numpy.tile(errors, (contents.shape[0], 1))
+
+    npar = fcn.GetNpar()
+    start = [fcn.GetParameter(ip) for ip in range(npar)]
+
+    toy = hist.Clone('toy')
+    toy.SetDirectory(0)
+
+    def fitOne(itoy):
+        toy.Reset()
+        for iBin in range(contents.shape[1]):
+            toy.SetBinContent(iBin + 1, contents[itoy, iBin])
+            toy.SetBinError(iBin + 1, errors[itoy, iBin])
+
+        fcn.SetParameters(*start)
+        toy.Fit(fcn, option)
+
+        return [fcn.GetParameter(ip) for ip in range(npar)]
+
+    params = numpy.array(mapToys(fitOne, contents.shape[0], nproc = nproc), dtype = numpy.float64)
+
+    fcn.SetParameters(*start)
+
+    return params
+
+def powerLaw(params, x):
+    """
+    Matrix (ntoys, npx) of [0] + [1] * (x - [2])^[3] for parameter rows params (ntoys, 4) and points x (npx).
+    """
+
+    params = numpy.atleast_2d(numpy.asarray(params, dtype = numpy.float64))
+    x = numpy.asarray(x, dtype = numpy.float64)[numpy.newaxis, :]
+
+    return params[:, 0:1] + params[:, 1:2] * numpy.power(x - params[:, 2:3], params[:, 3:4])
+
+def bands(nominal, variations, coverage = 0.68):
+    """
+    One-sided bands around nominal (npx) from variations (ntoys, npx). For each point, up is the coverage
+    quantile of the toys above nominal and down is the coverage quantile (counted downward) of the toys below.
+    Returns (down, up).
+    """
+
+    ordered = numpy.sort(variations, axis = 0)
+    ntoys = ordered.shape[0]
+    columns = numpy.arange(ordered.shape[1])
+
+    nbelow = numpy.sum(ordered < nominal, axis = 0)
+
+    iup = numpy.minimum(((ntoys - nbelow) * coverage + nbelow).astype(int), ntoys - 1)
+    idown = (nbelow * (1. - coverage)).astype(int)
+
+    return ordered[idown, columns], ordered[iup, columns]
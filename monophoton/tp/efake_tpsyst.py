@@ -17,6 +17,7 @@ sys.path.append(basedir)
 import config
 from tp.efake_conf import outputDir, roofitDictsDir
 import tp.efake_plot as efake_plot
+import tp.efake_toys as efake_toys
 
 import ROOT
 
@@ -30,6 +31,10 @@ conf = sys.argv[4] # ee or eg
 alt = sys.argv[5] # nominal, altsig, or altbkg
 nToys = int(sys.argv[6])
 seed = int(sys.argv[7])
+try:
+    nproc = int(sys.argv[8])
+except IndexError:
+    nproc = 1
 
 outBaseName = '_'.join([
     'tpsyst',
@@ -87,8 +92,6 @@ else:
 
 mass = work.arg('mass')
 
-ROOT.RooRandom.randomGenerator().SetSeed(seed)
-
 output.cd()
 outhist = ROOT.TH1D('pull_' + alt + '_' + suffix, '', 100, -0.5, 0.5)
 
@@ -101,7 +104,10 @@ elif alt == 'altsig':
 elif alt == 'altbkg':
     altModel = work.pdf('model_altbkg_' + suffix)
 
-for _ in range(nToys):
+def throwToy(itoy):
+    # toys may run in separate processes - give each its own random sequence
+    ROOT.RooRandom.randomGenerator().SetSeed(seed * nToys + itoy + 1)
+
     # initialize
     itr = altpset.fwdIterator()
     while True:
@@ -173,10 +179,13 @@ for _ in range(nToys):
     normYield = work.var('nsignal').getVal() / nompset.find('ntarg').getVal()
     normOriginal = nompset.find('nsignal').getVal() / htarg.GetSumOfWeights()
 
-    outhist.Fill((normYield - normOriginal) / normOriginal)
-
     altHist.Delete()
 
+    return (normYield - normOriginal) / normOriginal
+
+for pull in efake_toys.mapToys(throwToy, nToys, nproc = nproc):
+    outhist.Fill(pull)
+
 output.cd()
 outhist.Write()
 
@@ -4,6 +4,8 @@
 import os
 import sys
 import array
+import collections
+import multiprocessing
 
 import ROOT
 ROOT.gROOT.SetBatch(True)
@@ -25,6 +27,7 @@ ROOT.gROOT.LoadMacro(basedir + '/../common/MultiDraw.cc+')
 
 REPLOT = False
 FITEFFICIENCY = False
+NPROC = 4 # number of input file sets read in parallel
 
 if len(sys.argv) > 1:
     omnames = [tuple(a.split('_')) for a in sys.argv[1:]]
@@ -34,31 +37,41 @@ else:
 outName = 'trigger'
 outDir = config.histDir + '/trigger'
 
-if not REPLOT:
-    ## FILL DISTRIBUTIONS AND GRAPHS
-    for omname in omnames:
-        oname = omname[0]
-        mname = omname[1]
+def fillGroup(group):
+    """
+    Fill the pass / base histograms of all measurements in the group in a single pass over the shared input
+    files and write one efficiency file per measurement.
+    """
+
+    paths, keys = group
+
+    plotter = ROOT.MultiDraw()
+    plotter.setWeightBranch('')
+
+    for path in paths:
+        plotter.addInputPath(path)
+
+    # measurements sharing the baseline use it as the base selection of the pass; otherwise each plot carries its own
+    baselines = set(measurements[(oname, mname)][2] for oname, mname, _ in keys)
+    if len(baselines) == 1:
+        plotter.setBaseSelection(baselines.pop())
+        foldBaseline = False
+    else:
+        foldBaseline = True
+
+    outputFiles = []
+
+    for oname, mname, tnames in keys:
         print oname, mname
 
-        snames, region, basesel, colname = measurements[(oname, mname)]
+        _, _, basesel, colname = measurements[(oname, mname)]
 
         outputFile = ROOT.TFile.Open(outDir + '/trigger_efficiency_%s_%s.root' % (oname, mname), 'recreate')
+        outputFiles.append((oname, tnames, outputFile))
 
-        # fill the histograms
-        plotter = ROOT.MultiDraw()
-        plotter.setWeightBranch('')
-    
-        for sample in allsamples.getmany(snames):
-            plotter.addInputPath(utils.getSkimPath(sample.name, region))
-    
-        plotter.setBaseSelection(basesel)
-    
         # make an empty histogram for each (trigger, variable) combination
-        histograms = []
-
         for tname, (passdef, commonsel, title, variables) in confs[oname].items():
-            if len(omname) > 2 and tname != omname[2]:
+            if tnames is not None and tname not in tnames:
                 continue
 
             trigDir = outputFile.mkdir(tname)
@@ -78,33 +91,32 @@ if not REPLOT:
                 trigDir.cd()
                 hpass = template.Clone(vname + '_pass')
                 hbase = template.Clone(vname + '_base')
-                histograms.extend([hpass, hbase])
     
                 sels = []
+                if foldBaseline:
+                    sels.append(basesel)
                 if commonsel:
                     sels.append(commonsel)
                 if denomdef:
                     sels.append(denomdef)
     
-                plotter.addPlot(hbase, vexpr, ' && '.join(sels), True)
+                plotter.addPlot(hbase, vexpr, ' && '.join('(%s)' % sel for sel in sels), True)
 
                 sels.append(passdef)
 
-                plotter.addPlot(hpass, vexpr, ' && '.join(sels), True)
+                plotter.addPlot(hpass, vexpr, ' && '.join('(%s)' % sel for sel in sels), True)
     
                 template.Delete()
     
-        plotter.fillPlots()
+    plotter.fillPlots()
     
-        # make efficiency graphs and save
+    # make efficiency graphs and save
+    for oname, tnames, outputFile in outputFiles:
         for tname, (_, _, _, variables) in confs[oname].items():
-            if len(omname) > 2 and tname != omname[2]:
+            if tnames is not None and tname not in tnames:
                 continue
 
-            print ' ', tname
             for vname in variables:
-                print '   ', vname
-
                 hpass = outputFile.Get(tname + '/' + vname + '_pass')
                 hbase = outputFile.Get(tname + '/' + vname + '_base')
                 eff = ROOT.TGraphAsymmErrors(hpass, hbase)
@@ -114,6 +126,41 @@ if not REPLOT:
                 eff.Write(vname + '_eff')
 
         outputFile.Close()
+
+if not REPLOT:
+    ## FILL DISTRIBUTIONS AND GRAPHS
+
+    # requested triggers per measurement (None = all)
+    requested = collections.OrderedDict()
+    for omname in omnames:
+        key = tuple(omname[:2])
+        if len(omname) > 2:
+            if key not in requested:
+                requested[key] = set()
+            if requested[key] is not None:
+                requested[key].add(omname[2])
+        else:
+            requested[key] = None
+
+    # group measurements by input file set
+    groups = collections.OrderedDict()
+    for (oname, mname), tnames in requested.items():
+        snames, region, _, _ = measurements[(oname, mname)]
+        paths = tuple(sorted(set(utils.getSkimPath(sample.name, region) for sample in allsamples.getmany(snames))))
+
+        if paths not in groups:
+            groups[paths] = []
+        groups[paths].append((oname, mname, tnames))
+
+    print 'Filling', len(requested), 'measurements from', len(groups), 'input file sets'
+
+    if NPROC > 1 and len(groups) > 1:
+        pool = multiprocessing.Pool(min(NPROC, len(groups)))
+        pool.map(fillGroup, groups.items())
+        pool.close()
+        pool.join()
+    else:
+        map(fillGroup, groups.items())
     
 ## PLOT GRAPHS
 
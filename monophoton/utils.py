@@ -1,12 +1,17 @@
 import os
 import config
+import skimcache
 
 def getSkimPath(sample, skim, primary = config.skimDir, alternative = config.localSkimDir):
     sourceName = os.path.join(primary, sample + '_' + skim + '.root')
     if alternative:
         altName = os.path.join(alternative, sample + '_' + skim + '.root')
         if os.path.exists(altName) and os.stat(altName).st_mtime > os.stat(sourceName).st_mtime:
-            sourceName = altName
+            return altName
+
+    cache = skimcache.defaultCache()
+    if cache is not None:
+        sourceName = cache.lookup(sourceName)
 
     return sourceName
 